@@ -56,26 +56,16 @@ with explore_right:
 
         # Create a checkbox that will control whether the map and data are stored in the session state
         if st.session_state.show_tags:
-            # check if  m and st_data already exist in the session state
-            if "st_data_freeze" in st.session_state:
-                # st_data already in session state
-                pass
-            else:
-                # Store the map and data in the session state
-                st.session_state["st_data_freeze"] = st.session_state.st_data
-                # get bbox
-                st.session_state["bbox"] = st_functions.bbox_from_st_data(
-                    st.session_state.st_data_freeze
-                )
-                # st.markdown(st.session_state["bbox"])
-                # query all nodes with tags in bbox
-                st.session_state["nodes"] = st_functions.get_nodes_with_tags_in_bbox(
-                    st.session_state.bbox
-                )
-                # get the tag content as a dictionary
-                st.session_state["tags_in_bbox"] = st_functions.count_tag_frequency_old(
-                    st.session_state.nodes
-                )
+            # get bbox of the current view
+            st.session_state["bbox"] = st_functions.bbox_from_st_data(
+                st.session_state.st_data
+            )
+            # query the nodes with tags in the tiles of the view we don't have yet
+            st_functions.fetch_viewport_delta(st.session_state.bbox)
+            # count the tags in view, once per view
+            tag_stats = st_functions.tag_statistics_for_view(st.session_state.bbox)
+            # get the tag content as a dictionary
+            st.session_state["tags_in_bbox"] = tag_stats.tag_frequency()
 
             # show a wordcloud of amenities in the search area
             generate_wordcloud()
@@ -96,7 +86,7 @@ with explore_right:
             }
             # filter the nodes in the bounding box which match the mask
             st.session_state.selected_nodes = st_functions.filter_nodes_with_tags(
-                st.session_state.nodes, st.session_state.mask
+                st.session_state.nodes_in_view, st.session_state.mask
             )
             ## Create colored circles for each of the above nodes
             st.session_state.circles = st_functions.create_circles_from_node_dict(
@@ -111,10 +101,14 @@ with explore_right:
             temporary_variables = [
                 "gdf",
                 "m",
-                "st_data_freeze",
                 "bbox",
                 "tags_in_bbox",
-                "nodes",
+                "nodes_in_view",
+                "nodes_store",
+                "nodes_version",
+                "tag_stats",
+                "tag_stats_key",
+                "fetched_tiles",
             ]
             for var in temporary_variables:
                 if var in st.session_state:
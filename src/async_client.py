@@ -0,0 +1,225 @@
+"""Asyncio counterpart of http_client.
+
+Lets agent executors and multi-place lookups overlap their network waits.
+Concurrency is capped per service so that we stay within the slots the
+public Overpass and Nominatim servers give us.
+"""
+import asyncio
+import json
+from time import monotonic
+
+import aiohttp
+
+from . import http_client
+from .overpass_cache import get_overpass_cache
+from .overpass_pool import FAILURE_STATUS, get_overpass_pool
+from .single_flight import geocode_flight, geocode_key, overpass_key
+
+
+# Maximum number of requests in flight per service, per event loop
+CONCURRENCY = {
+    "overpass": 2,
+    "nominatim": 1,
+}
+
+
+class ResponseError(ValueError):
+    """An answer that isn't a 200 with a json body. Keeps the http status."""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class AsyncOverpassClient:
+    """aiohttp session plus per-service semaphores. Bound to one event loop."""
+
+    def __init__(self):
+        self._session = None
+        # Identical overpass queries running on this loop share one task
+        self._inflight = {}
+        self.limits = {name: asyncio.Semaphore(n) for name, n in CONCURRENCY.items()}
+
+    @property
+    def session(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(headers=http_client.HEADERS)
+        return self._session
+
+    async def get_json(
+        self,
+        url: str,
+        params: dict = None,
+        service: str = None,
+        max_retries: int = http_client.MAX_RETRIES,
+    ):
+        """GET a url and parse the body as json, retrying on 429/504.
+
+        Raises:
+            ResponseError: if the status isn't 200 or the answer is empty or
+            not json
+        """
+        connect, read = http_client.timeout_for(url)
+        timeout = aiohttp.ClientTimeout(sock_connect=connect, sock_read=read)
+        limit = self.limits.get(service)
+        for attempt in range(max_retries + 1):
+            if limit is not None:
+                await limit.acquire()
+            try:
+                async with self.session.get(
+                    url, params=params, timeout=timeout
+                ) as response:
+                    status = response.status
+                    retry_after = response.headers.get("Retry-After")
+                    body = await response.read()
+            finally:
+                if limit is not None:
+                    limit.release()
+
+            if status not in http_client.RETRY_STATUS or attempt == max_retries:
+                break
+            # Wait outside the semaphore so other requests can use the slot
+            await asyncio.sleep(http_client.backoff_delay(attempt, retry_after))
+
+        if status != 200:
+            raise ResponseError(
+                status,
+                f"Overpass returned {status}: {body[:500].decode(errors='replace')}",
+            )
+        if not body:
+            raise ResponseError(status, "Empty response from Overpass API")
+        try:
+            return await asyncio.to_thread(json.loads, body)
+        except ValueError:
+            raise ResponseError(status, f"Invalid response ({status}): {body[:200]!r}")
+
+    async def overpass_query(self, query: str, url: str = None):
+        """Run an overpass query, going through the shared cache first.
+        Without a url, the query is routed through the overpass endpoint pool.
+
+        Returns:
+            data (dict): the parsed overpass answer
+        """
+        cache = get_overpass_cache()
+        data = await asyncio.to_thread(cache.get, query)
+        if data is not None:
+            return data
+
+        key = (url, overpass_key(query))
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch_overpass(query, url))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # shield so that one cancelled caller does not cancel the shared request
+        return await asyncio.shield(task)
+
+    async def _fetch_overpass(self, query: str, url: str):
+        params = {"data": query}
+        if url is not None:
+            data = await self.get_json(url, params=params, service="overpass")
+        else:
+            data = await self._fetch_from_pool(params)
+        await asyncio.to_thread(get_overpass_cache().put, query, data)
+        return data
+
+    async def _fetch_from_pool(self, params: dict):
+        """Same failover as EndpointPool.get: best endpoint first, next one on
+        connection errors and overloaded answers"""
+        pool = get_overpass_pool()
+        endpoints = await asyncio.to_thread(pool.ranked)
+        max_retries = 0 if len(endpoints) > 1 else http_client.MAX_RETRIES
+        last_error = None
+        for endpoint in endpoints:
+            start = monotonic()
+            try:
+                data = await self.get_json(
+                    endpoint.url,
+                    params=params,
+                    service="overpass",
+                    max_retries=max_retries,
+                )
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                pool.record_failure(endpoint)
+                last_error = e
+                continue
+            except ResponseError as e:
+                if e.status not in FAILURE_STATUS:
+                    # eg. a syntax error, another endpoint won't do better
+                    raise
+                pool.record_failure(endpoint)
+                last_error = e
+                continue
+            pool.record_success(endpoint, monotonic() - start)
+            return data
+        raise last_error or aiohttp.ClientError("No overpass endpoint available")
+
+    async def geocode_to_gdf(self, place: str):
+        """osmnx has no async api, so run the geocoder in a worker thread
+        while holding a Nominatim slot. Goes through the same single-flight
+        layer as the sync code, so concurrent sessions share the request."""
+        import osmnx as ox
+
+        async with self.limits["nominatim"]:
+            gdf = await asyncio.to_thread(
+                geocode_flight.do, geocode_key(place), ox.geocode_to_gdf, place
+            )
+        # The answer is shared with the other callers
+        return gdf.copy()
+
+    async def geocode_places(self, places: list):
+        """Geocode several places concurrently. Returns a list of GeoDataFrames
+        (or the exception raised for that place) in the same order as `places`."""
+        return await asyncio.gather(
+            *[self.geocode_to_gdf(place) for place in places], return_exceptions=True
+        )
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+# One client per running event loop. The client's session holds its loop,
+# so the entry is removed explicitly when the loop shuts down.
+_clients = {}
+
+
+async def _close_at_shutdown(loop, client):
+    """Async generator that is only finalized by loop.shutdown_asyncgens(),
+    which asyncio.run() calls before closing the loop"""
+    try:
+        yield
+    finally:
+        await client.close()
+        _clients.pop(loop, None)
+
+
+async def get_async_client():
+    """Return the client for the running event loop.
+    aiohttp sessions and asyncio semaphores cannot be shared between loops,
+    and each Streamlit script thread may run its own. The client's session
+    is closed when its loop shuts down."""
+    loop = asyncio.get_running_loop()
+    # Loops closed without shutting down their async generators
+    for closed in [other for other in _clients if other.is_closed()]:
+        del _clients[closed]
+    client = _clients.get(loop)
+    if client is None:
+        client = AsyncOverpassClient()
+        _clients[loop] = client
+        # Started here so the loop tracks it, kept on the client so it isn't
+        # finalized before the loop shuts down
+        client._closer = _close_at_shutdown(loop, client)
+        await client._closer.asend(None)
+    return client
+
+
+async def overpass_query(query: str):
+    client = await get_async_client()
+    return await client.overpass_query(query)
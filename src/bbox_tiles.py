@@ -0,0 +1,285 @@
+"""Quadtree tiling of bounding box fetches.
+
+A big bbox (eg. all of Pankow) in one overpass query times out. Instead the
+bbox is covered with tiles from a fixed, global quadtree grid, which are
+fetched in parallel and merged. Because the grid is fixed, the query for a
+tile is always the same text, so every tile is cached on its own by the
+overpass cache and overlapping places or a panned map reuse the tiles we
+already have. A tile that overpass can't answer in time is split in four.
+
+Tiles are sized from the density of the bbox, measured with one cheap
+`out count` query, and the tiles on the edge of the bbox are clipped to it,
+so we don't download the parts of them outside the bbox. Only the tiles
+fully inside the bbox are shared with other bboxes.
+
+bboxes are [S, W, N, E], like everywhere else in the app.
+"""
+import math
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from .oql import OQLSyntaxError, with_out_count
+from .overpass_cache import get_overpass_cache
+from .single_flight import overpass_flight, overpass_key
+from .overpass_stream import fetch_answer
+
+
+# Rough number of tagged nodes per km² in a dense city district, used when
+# the density of a bbox can't be counted
+DEFAULT_DENSITY = 1500
+# Keeps empty areas (forest, sea) from being fetched as one huge tile
+MIN_DENSITY = 1
+# Aim for tiles overpass can answer well within its timeout
+MAX_ELEMENTS_PER_TILE = 20000
+MIN_ZOOM = 6
+MAX_ZOOM = 18
+# Cost of one extra request, expressed as a number of downloaded elements
+REQUEST_OVERHEAD = 2000
+# Public overpass instances give us two slots
+MAX_PARALLEL_TILES = 2
+# A viewport is never covered with more tiles than this, coarser tiles are
+# used instead
+MAX_VIEWPORT_TILES = 16
+KM_PER_DEGREE = 111.32
+
+
+def tile_size(zoom: int):
+    """(lat, lon) size in degrees of a tile at a zoom level"""
+    return 180 / 2**zoom, 360 / 2**zoom
+
+
+def tile_bbox(tile):
+    zoom, x, y = tile
+    dlat, dlon = tile_size(zoom)
+    south = -90 + y * dlat
+    west = -180 + x * dlon
+    return [south, west, south + dlat, west + dlon]
+
+
+def bbox_area_km2(bbox: list):
+    south, west, north, east = bbox
+    mid_lat = math.radians((south + north) / 2)
+    return (
+        (north - south)
+        * KM_PER_DEGREE
+        * (east - west)
+        * KM_PER_DEGREE
+        * math.cos(mid_lat)
+    )
+
+
+def choose_zoom(bbox: list, density: float = DEFAULT_DENSITY, clip: bool = False):
+    """Pick the zoom with the cheapest expected fetch among those whose tiles
+    hold at most MAX_ELEMENTS_PER_TILE elements. Coarse tiles download a lot
+    outside the bbox (unless they are clipped), fine tiles pay the
+    per-request overhead many times."""
+    best_zoom, best_cost = MAX_ZOOM, None
+    for zoom in range(MIN_ZOOM, MAX_ZOOM + 1):
+        tiles = tiles_for_bbox(bbox, zoom)
+        elements_per_tile = bbox_area_km2(tile_bbox(tiles[0])) * density
+        if elements_per_tile > MAX_ELEMENTS_PER_TILE:
+            continue
+        if clip:
+            cost = len(tiles) * REQUEST_OVERHEAD + bbox_area_km2(bbox) * density
+        else:
+            cost = len(tiles) * (REQUEST_OVERHEAD + elements_per_tile)
+        if best_cost is None or cost < best_cost:
+            best_zoom, best_cost = zoom, cost
+    return best_zoom
+
+
+def tiles_for_bbox(bbox: list, zoom: int):
+    """All tiles at `zoom` that intersect the bbox"""
+    south, west, north, east = bbox
+    dlat, dlon = tile_size(zoom)
+    y_min = math.floor((south + 90) / dlat)
+    y_max = math.ceil((north + 90) / dlat) - 1
+    x_min = math.floor((west + 180) / dlon)
+    x_max = math.ceil((east + 180) / dlon) - 1
+    return [
+        (zoom, x, y)
+        for y in range(y_min, max(y_min, y_max) + 1)
+        for x in range(x_min, max(x_min, x_max) + 1)
+    ]
+
+
+def intersection(bbox: list, other: list):
+    """The overlap of two bboxes, or None"""
+    south, west = max(bbox[0], other[0]), max(bbox[1], other[1])
+    north, east = min(bbox[2], other[2]), min(bbox[3], other[3])
+    if south >= north or west >= east:
+        return None
+    return [south, west, north, east]
+
+
+def contains(bbox: list, other: list):
+    return (
+        bbox[0] <= other[0]
+        and bbox[1] <= other[1]
+        and bbox[2] >= other[2]
+        and bbox[3] >= other[3]
+    )
+
+
+def children(tile):
+    zoom, x, y = tile
+    return [(zoom + 1, 2 * x + dx, 2 * y + dy) for dy in (0, 1) for dx in (0, 1)]
+
+
+def parent(tile):
+    zoom, x, y = tile
+    return zoom - 1, x // 2, y // 2
+
+
+def viewport_zoom(bbox: list, density: float = DEFAULT_DENSITY):
+    """The zoom of the whole tiles that cover a map viewport: choose_zoom,
+    made coarser until at most MAX_VIEWPORT_TILES tiles cover the view"""
+    zoom = choose_zoom(bbox, density)
+    while zoom > MIN_ZOOM and len(tiles_for_bbox(bbox, zoom)) > MAX_VIEWPORT_TILES:
+        zoom -= 1
+    return zoom
+
+
+def is_covered(tile, fetched: set, max_zoom: int = None):
+    """Whether a tile, one of its parents or all of its children (down to
+    max_zoom, the finest zoom in `fetched`) are in `fetched`"""
+    if max_zoom is None:
+        max_zoom = max((t[0] for t in fetched), default=MIN_ZOOM)
+    ancestor = tile
+    while ancestor[0] >= MIN_ZOOM:
+        if ancestor in fetched:
+            return True
+        ancestor = parent(ancestor)
+    return is_covered_below(tile, fetched, max_zoom)
+
+
+def is_covered_below(tile, fetched: set, max_zoom: int):
+    if tile in fetched:
+        return True
+    return tile[0] < max_zoom and all(
+        is_covered_below(child, fetched, max_zoom) for child in children(tile)
+    )
+
+
+def fetch_query(query: str):
+    """Cached, coalesced fetch of one query. The answer is parsed while it
+    downloads, the body is never held in memory as a whole.
+
+    Raises:
+        ValueError: if overpass rejects the query
+    """
+    cache = get_overpass_cache()
+    data = cache.get(query)
+    if data is not None:
+        return data
+
+    def download():
+        data = fetch_answer(query)
+        cache.put(query, data)
+        return data
+
+    return overpass_flight.do(overpass_key(query), download)
+
+
+def is_incomplete(data: dict):
+    """Overpass reports timeouts and memory exhaustion as a runtime error remark"""
+    return "runtime error" in data.get("remark", "")
+
+
+def estimate_density(bbox: list, make_query):
+    """Elements per km² in the bbox, from an `out count` of the whole bbox.
+    Counting is cheap for overpass, and the count is cached like any answer.
+    Falls back to DEFAULT_DENSITY if the bbox can't be counted."""
+    try:
+        data = fetch_query(with_out_count(make_query(bbox)))
+    except (OQLSyntaxError, ValueError, requests.RequestException):
+        return DEFAULT_DENSITY
+    counts = [e for e in data.get("elements", []) if e.get("type") == "count"]
+    if is_incomplete(data) or not counts:
+        return DEFAULT_DENSITY
+    total = sum(int(e["tags"].get("total", 0)) for e in counts)
+    return max(total / max(bbox_area_km2(bbox), 1e-6), MIN_DENSITY)
+
+
+def fetch_tile(tile, make_query, clip_to: list = None):
+    """Fetch a tile, splitting it into its children if overpass gives up on it.
+    With clip_to, only the part of the tile inside that bbox is queried.
+    Returns a list of overpass answers."""
+    query_bbox = tile_bbox(tile)
+    if clip_to is not None and not contains(clip_to, query_bbox):
+        query_bbox = intersection(clip_to, query_bbox)
+        if query_bbox is None:
+            return []
+    data = fetch_query(make_query(query_bbox))
+    if is_incomplete(data) and tile[0] < MAX_ZOOM:
+        return [
+            d
+            for child in children(tile)
+            for d in fetch_tile(child, make_query, clip_to)
+        ]
+    return [data]
+
+
+def in_bbox(element, bbox):
+    # Ways and relations from "out body" have no coordinates, keep them
+    if "lat" not in element:
+        return True
+    south, west, north, east = bbox
+    return south <= element["lat"] <= north and west <= element["lon"] <= east
+
+
+def fetch_tiles(bbox: list, make_query, density: float = None, clip: bool = True):
+    """The overpass answers of the tiles covering a bbox, yielded as the
+    tiles come in, so they can be consumed while the others download.
+    Arguments as for fetch_bbox_tiled."""
+    if density is None:
+        density = estimate_density(bbox, make_query)
+    tiles = tiles_for_bbox(bbox, choose_zoom(bbox, density, clip))
+    yield from fetch_tile_answers(tiles, make_query, bbox if clip else None)
+
+
+def fetch_tile_answers(tiles: list, make_query, clip_to: list = None):
+    """The answers of some tiles, fetched in parallel and yielded in order
+    as they come in. See fetch_tile for clip_to."""
+    with ThreadPoolExecutor(max_workers=MAX_PARALLEL_TILES) as executor:
+        for tile_answers in executor.map(
+            lambda tile: fetch_tile(tile, make_query, clip_to), tiles
+        ):
+            yield from tile_answers
+
+
+def tile_elements(answers, bbox: list):
+    """The elements of tile answers, one at a time, deduplicated by
+    (type, id) and clipped to the bbox"""
+    seen = set()
+    for data in answers:
+        for element in data.get("elements", []):
+            key = (element["type"], element["id"])
+            if key not in seen and in_bbox(element, bbox):
+                seen.add(key)
+                yield element
+
+
+def fetch_bbox_tiled(bbox: list, make_query, density: float = None, clip: bool = True):
+    """Fetch a bbox as quadtree tiles and merge the answers.
+
+    Args:
+        bbox (list): [S, W, N, E]
+        make_query (callable): takes a tile bbox, returns the overpass query for it
+        density (float, optional): expected elements per km², used to size the
+            tiles. Counted with estimate_density if not given.
+        clip (bool, optional): query only the part of the edge tiles inside
+            the bbox
+
+    Returns:
+        data (dict): an overpass-style answer with the elements of all tiles,
+        deduplicated by (type, id) and clipped to the bbox
+    """
+    answers = list(fetch_tiles(bbox, make_query, density, clip))
+    merged = {k: v for k, v in answers[0].items() if k != "elements"} if answers else {}
+    merged["elements"] = list(tile_elements(answers, bbox))
+    remarks = [d["remark"] for d in answers if "remark" in d]
+    if remarks:
+        merged["remark"] = "; ".join(remarks)
+    return merged
@@ -0,0 +1,195 @@
+"""Overpass answers as two pandas tables: `elements` (type, id, lat, lon,
+one row per element) and `tags` (element, key, value, with categorical keys
+and values).
+
+    store = ElementStore.from_data(overpass_answer)
+    store.value_counts("amenity")           # {"bench": 40, "cafe": 12}
+    store.select("amenity", "cafe").to_dicts()
+"""
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+
+class ElementStore:
+    def __init__(self, elements: pd.DataFrame, tags: pd.DataFrame):
+        self.elements = elements
+        self.tags = tags
+
+    @classmethod
+    def from_elements(cls, elements):
+        """Build a store from any iterable of overpass elements, eg. an
+        OverpassStream. Only the columns are kept, not the dicts."""
+        types, ids, lats, lons = [], [], [], []
+        tag_elements, keys, values = [], [], []
+        for i, element in enumerate(elements):
+            types.append(element.get("type"))
+            ids.append(element.get("id", -1))
+            position = element if "lat" in element else element.get("center", {})
+            lats.append(position.get("lat", np.nan))
+            lons.append(position.get("lon", np.nan))
+            for key, value in element.get("tags", {}).items():
+                tag_elements.append(i)
+                keys.append(key)
+                values.append(value if isinstance(value, str) else str(value))
+
+        elements = pd.DataFrame(
+            {
+                "type": pd.Categorical(types),
+                "id": np.array(ids, dtype="int64"),
+                "lat": np.array(lats, dtype="float64"),
+                "lon": np.array(lons, dtype="float64"),
+            }
+        )
+        tags = pd.DataFrame(
+            {
+                "element": np.array(tag_elements, dtype="int64"),
+                "key": pd.Categorical(keys),
+                "value": pd.Categorical(values),
+            }
+        )
+        return cls(elements, tags)
+
+    @classmethod
+    def from_data(cls, data: dict):
+        """Build a store from an overpass answer (dict)"""
+        return cls.from_elements(data.get("elements", []))
+
+    @classmethod
+    def concat(cls, stores):
+        """One store with the elements of several, eg. of tiles fetched one
+        by one. An element in more than one store, by (type, id), is kept
+        once. The stores are not modified."""
+        element_frames, tag_frames = [], []
+        offset = 0
+        for store in stores:
+            labels = pd.Series(
+                np.arange(offset, offset + len(store.elements)),
+                index=store.elements.index,
+            )
+            element_frames.append(store.elements)
+            tag_frames.append(
+                pd.DataFrame(
+                    {
+                        "element": labels.loc[store.tags["element"]].to_numpy(),
+                        "key": store.tags["key"].array,
+                        "value": store.tags["value"].array,
+                    }
+                )
+            )
+            offset += len(store.elements)
+        if not element_frames:
+            return cls.from_elements([])
+
+        elements = _concat_frames(element_frames)
+        tags = _concat_frames(tag_frames)
+        duplicate = elements.duplicated(["type", "id"]).to_numpy()
+        if duplicate.any():
+            elements = elements[~duplicate]
+            tags = tags[~tags["element"].isin(np.flatnonzero(duplicate))]
+        return cls(elements, tags)
+
+    def __len__(self):
+        return len(self.elements)
+
+    def subset(self, labels):
+        """The store restricted to the elements with the given row labels"""
+        labels = pd.Index(labels)
+        return ElementStore(
+            self.elements.loc[self.elements.index.intersection(labels)],
+            self.tags[self.tags["element"].isin(labels)],
+        )
+
+    def of_type(self, osm_type: str):
+        return self.subset(self.elements.index[self.elements["type"] == osm_type])
+
+    def in_bbox(self, bbox: list):
+        """Elements inside a [S, W, N, E] bbox. Elements without coordinates
+        (eg. ways from "out body") are kept, like bbox_tiles.in_bbox."""
+        south, west, north, east = bbox
+        lat, lon = self.elements["lat"], self.elements["lon"]
+        inside = lat.isna() | (lat.between(south, north) & lon.between(west, east))
+        return self.subset(self.elements.index[inside])
+
+    def select(self, key: str, value: str = None):
+        """Elements that have the tag key, or key=value"""
+        mask = self.tags["key"] == key
+        if value is not None:
+            mask &= self.tags["value"] == value
+        return self.subset(self.tags.loc[mask, "element"].unique())
+
+    def key_counts(self):
+        """{key: number of elements with the key}, most frequent first"""
+        counts = self.tags["key"].value_counts()
+        return {key: int(n) for key, n in counts.items() if n > 0}
+
+    def value_counts(self, key: str):
+        """{value: number of elements with key=value}, most frequent first"""
+        counts = self.tags.loc[self.tags["key"] == key, "value"].value_counts()
+        return {value: int(n) for value, n in counts.items() if n > 0}
+
+    def tag_dicts(self):
+        """{row label: tags dict} for every element"""
+        tag_dicts = {label: {} for label in self.elements.index}
+        for label, key, value in zip(
+            self.tags["element"], self.tags["key"], self.tags["value"]
+        ):
+            tag_dicts[label][key] = value
+        return tag_dicts
+
+    def iter_points(self):
+        """(lat, lon, tags) of every element with coordinates"""
+        tag_dicts = self.tag_dicts()
+        located = self.elements[self.elements["lat"].notna()]
+        for label, lat, lon in zip(located.index, located["lat"], located["lon"]):
+            yield lat, lon, tag_dicts[label]
+
+    def to_dicts(self):
+        """The elements as overpass-style dicts, eg. to show them in a table"""
+        tag_dicts = self.tag_dicts()
+        elements = []
+        for label, row in zip(
+            self.elements.index, self.elements.itertuples(index=False)
+        ):
+            element = {"type": row.type, "id": int(row.id)}
+            if not np.isnan(row.lat):
+                if row.type == "node":
+                    element["lat"], element["lon"] = row.lat, row.lon
+                else:
+                    element["center"] = {"lat": row.lat, "lon": row.lon}
+            element["tags"] = tag_dicts[label]
+            elements.append(element)
+        return elements
+
+    def summary(self, features: list):
+        """Number of elements, unique names and elements with feature=yes"""
+        names = self.tags.loc[self.tags["key"] == "name", "value"]
+        special_features = {
+            feature: int(
+                ((self.tags["key"] == feature) & (self.tags["value"] == "yes")).sum()
+            )
+            for feature in features
+        }
+        return {
+            "num_elements": len(self.elements),
+            "num_unique_names": int(names.nunique()),
+            "special_features": special_features,
+        }
+
+
+def _concat_frames(frames: list):
+    """Concatenate tables, keeping their categorical columns categorical"""
+    frame = pd.concat(frames, ignore_index=True)
+    for column in frame.columns:
+        if isinstance(frames[0][column].dtype, pd.CategoricalDtype):
+            frame[column] = union_categoricals([f[column] for f in frames])
+    return frame
+
+
+def as_store(data):
+    """An ElementStore for a store, an overpass answer or a list of elements"""
+    if isinstance(data, ElementStore):
+        return data
+    if isinstance(data, dict):
+        return ElementStore.from_data(data)
+    return ElementStore.from_elements(data)
@@ -3,7 +3,6 @@ import os
 import json
 import pandas as pd
 import geopandas as gpd
-import requests
 from time import localtime, strftime
 import osmnx as ox
 import utm
@@ -11,6 +10,9 @@ from pyproj import CRS
 from shapely.geometry import Polygon, Point, MultiPolygon
 import streamlit as st
 import re
+from src import http_client
+from src.oql import canonical_or_cleaned
+from src.geo_distance import haversine
 
 
 class ChatBot:
@@ -202,12 +204,7 @@ class ChatBot:
             _type_: _description_
         """
         # Calculate the distance between two points
-        gdf["distance"] = gdf.apply(
-            lambda row: ox.distance.great_circle_vec(
-                lat, lon, row["geometry"].y, row["geometry"].x
-            ),
-            axis=1,
-        )
+        gdf["distance"] = haversine(lat, lon, gdf["geometry"].y, gdf["geometry"].x)
         return gdf
 
     def save_to_json(self, file_path: str, this_run_name: str, log: dict):
@@ -279,11 +276,9 @@ class ChatBot:
         in this example, a complex query is likely to fail, so it is better to run
         a first query for bike parking in Kreuzberk and a second one for tech parks in Kreuzberg
         """
-        overpass_url = "http://overpass-api.de/api/interpreter"
-
         # Check that the query is properly formatted
-        generated_query = generated_query.replace("\n", "").replace("_", "")
-        response = requests.get(overpass_url, params={"data": generated_query})
+        generated_query = canonical_or_cleaned(generated_query)
+        response = http_client.overpass_get(generated_query)
         if response.content:
             try:
                 data = response.json()
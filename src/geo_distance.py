@@ -0,0 +1,86 @@
+"""Great circle distances and nearest neighbour search over overpass results.
+
+haversine() works on scalars and NumPy arrays alike, so a whole column of
+points is measured in one call. PointIndex puts the points of an overpass
+answer (nodes, and ways or relations that have a center) into a BallTree
+with the haversine metric. k-nearest and within-radius lookups then take
+milliseconds and don't need another overpass query:
+
+    index = PointIndex(overpass_answer)
+    index.nearest(52.52, 13.40, k=3)
+    index.within(52.52, 13.40, radius=500)
+"""
+import numpy as np
+from sklearn.neighbors import BallTree
+
+from .element_store import as_store
+
+
+# Same radius as osmnx.distance.great_circle_vec
+EARTH_RADIUS = 6_371_009  # metres
+
+
+def haversine(lat1, lon1, lat2, lon2, earth_radius: float = EARTH_RADIUS):
+    """Great circle distance in metres between points given in degrees.
+    Arguments can be scalars or arrays, which are broadcast."""
+    lat1, lon1, lat2, lon2 = (
+        np.radians(np.asarray(a)) for a in (lat1, lon1, lat2, lon2)
+    )
+    a = (
+        np.sin((lat2 - lat1) / 2) ** 2
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    )
+    return 2 * earth_radius * np.arcsin(np.sqrt(a))
+
+
+class PointIndex:
+    def __init__(self, data):
+        """
+        Args:
+            data: an overpass answer, a list of elements or an ElementStore
+        """
+        self.source = data
+        store = as_store(data)
+        located = store.elements["lat"].notna()
+        self.store = store.subset(store.elements.index[located])
+        coords = self.store.elements[["lat", "lon"]].to_numpy()
+        self.tree = (
+            BallTree(np.radians(coords), metric="haversine") if len(coords) else None
+        )
+        self._elements = None
+
+    def __len__(self):
+        return len(self.store)
+
+    def elements(self):
+        if self._elements is None:
+            self._elements = self.store.to_dicts()
+        return self._elements
+
+    def _results(self, positions, distances):
+        elements = self.elements()
+        return [
+            {**elements[i], "distance": round(float(d), 1)}
+            for i, d in zip(positions, distances)
+        ]
+
+    def nearest(self, lat: float, lon: float, k: int = 1):
+        """The k elements closest to a point, closest first, with their
+        distance in metres"""
+        if self.tree is None:
+            return []
+        k = min(k, len(self))
+        distances, positions = self.tree.query(np.radians([[lat, lon]]), k=k)
+        return self._results(positions[0], distances[0] * EARTH_RADIUS)
+
+    def within(self, lat: float, lon: float, radius: float):
+        """All elements within `radius` metres of a point, closest first"""
+        if self.tree is None:
+            return []
+        positions, distances = self.tree.query_radius(
+            np.radians([[lat, lon]]),
+            r=radius / EARTH_RADIUS,
+            return_distance=True,
+            sort_results=True,
+        )
+        return self._results(positions[0], distances[0] * EARTH_RADIUS)
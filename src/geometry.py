@@ -0,0 +1,110 @@
+"""Geometry helpers that measure places: areas in their local UTM zone and
+the distance from a place's centroid to its farthest vertex."""
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+import shapely
+import utm
+from geopandas import GeoDataFrame
+from pyproj import CRS, Transformer
+
+
+def gdf_data(row, original_crs):
+    """Get the area of a polygon
+    can take a row of a gdf"""
+    return projected_areas(GeoDataFrame([row], crs=original_crs)).iloc[0]
+
+
+def utm_epsg(lat, lon):
+    """EPSG code of the WGS 84 UTM zone of a point"""
+    zone = utm.latlon_to_zone_number(lat, lon)
+    return (32700 if lat < 0 else 32600) + zone
+
+
+@lru_cache(maxsize=None)
+def utm_transformer(source_crs, epsg: int):
+    """One transformer and unit name per (source crs, UTM zone)"""
+    target = CRS.from_epsg(epsg)
+    transformer = Transformer.from_crs(source_crs, target, always_xy=True)
+    return transformer, target.axis_info[0].unit_name
+
+
+def projected_areas(gdf: GeoDataFrame, lat_col="lat", lon_col="lon"):
+    """Area of every geometry in its local UTM zone.
+
+    Rows are grouped by UTM zone and each group is projected in one
+    vectorized call, reusing one transformer per zone.
+
+    Returns:
+        pd.DataFrame: "area" and "unit" columns, with the index of gdf
+    """
+    areas = pd.Series(np.nan, index=gdf.index, dtype="float64")
+    units = pd.Series("", index=gdf.index, dtype="object")
+    if gdf.empty:
+        return pd.DataFrame({"area": areas, "unit": units})
+    if lat_col in gdf and lon_col in gdf:
+        lats, lons = gdf[lat_col].to_numpy(), gdf[lon_col].to_numpy()
+    else:
+        centroids = gdf.geometry.representative_point()
+        lats, lons = centroids.y.to_numpy(), centroids.x.to_numpy()
+    zones = pd.Series(
+        [utm_epsg(lat, lon) for lat, lon in zip(lats, lons)], index=gdf.index
+    )
+    source_crs = CRS.from_user_input(gdf.crs or "EPSG:4326")
+
+    def project(transformer):
+        def transform(coords):
+            x, y = transformer.transform(coords[:, 0], coords[:, 1])
+            return np.column_stack([x, y])
+
+        return transform
+
+    for epsg, index in zones.groupby(zones).groups.items():
+        transformer, unit = utm_transformer(source_crs, int(epsg))
+        geometries = gdf.geometry.loc[index].to_numpy()
+        projected = shapely.transform(geometries, project(transformer))
+        areas.loc[index] = shapely.area(projected)
+        units.loc[index] = f"square {unit}"
+    return pd.DataFrame({"area": areas, "unit": units})
+
+
+def longest_distance_to_vertex(geometry):
+    """Calculate the radius between the polygon centroid and its furthest point.
+    Not callable by the LLM
+    Args:
+        polygon (shapely.geometry.Polygon): _description_
+    Returns:
+        max_distance (float): _description_
+    """
+    return longest_distances_to_vertex([geometry])[0]
+
+
+def longest_distances_to_vertex(geometries):
+    """longest_distance_to_vertex for a whole column of geometries at once.
+    Each part of a multipart geometry is measured from its own centroid to
+    its exterior vertices, and the geometry gets the largest of them.
+    Not callable by the LLM
+    Args:
+        geometries (GeoSeries or array of shapely geometries)
+    Returns:
+        max_distances (np.ndarray): one distance per geometry, 0 if empty
+    """
+    geometries = np.asarray(geometries, dtype=object)
+    parts, part_geometry = shapely.get_parts(geometries, return_index=True)
+    # Empty parts have no centroid and no vertices, they would shift the
+    # centroids out of line with the parts
+    located = ~(shapely.is_empty(parts) | shapely.is_missing(parts))
+    parts, part_geometry = parts[located], part_geometry[located]
+    # Polygons are measured on their exterior ring, other parts on themselves
+    is_polygon = shapely.get_type_id(parts) == 3
+    outlines = np.where(is_polygon, shapely.get_exterior_ring(parts), parts)
+    centroids = shapely.get_coordinates(shapely.centroid(parts))
+    coords, coord_part = shapely.get_coordinates(outlines, return_index=True)
+
+    distances = np.hypot(*(coords - centroids[coord_part]).T)
+    part_max = np.zeros(len(parts))
+    np.maximum.at(part_max, coord_part, distances)
+    max_distances = np.zeros(len(geometries))
+    np.maximum.at(max_distances, part_geometry, part_max)
+    return max_distances
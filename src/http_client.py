@@ -0,0 +1,121 @@
+"""Shared HTTP client for Overpass, Nominatim and taginfo.
+
+All calls go through one pooled requests.Session so connections are kept
+alive between tool calls, responses are compressed, every request has a
+timeout and rate limited (429) or timed out (504) answers are retried with
+jittered exponential backoff.
+"""
+import random
+import threading
+from time import sleep
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+OVERPASS_URL = "http://overpass-api.de/api/interpreter"
+NOMINATIM_URL = "https://nominatim.openstreetmap.org"
+TAGINFO_URL = "https://taginfo.openstreetmap.org/api/4"
+
+# (connect, read) timeouts in seconds, per host
+TIMEOUTS = {
+    "overpass-api.de": (5, 180),
+    "overpass.kumi.systems": (5, 180),
+    "overpass.private.coffee": (5, 180),
+    "nominatim.openstreetmap.org": (5, 30),
+    "taginfo.openstreetmap.org": (5, 60),
+}
+DEFAULT_TIMEOUT = (5, 60)
+
+RETRY_STATUS = {429, 504}
+MAX_RETRIES = 3
+BACKOFF_BASE = 1.0  # seconds
+BACKOFF_MAX = 30.0  # seconds
+
+HEADERS = {
+    "Accept-Encoding": "gzip, deflate",
+    "User-Agent": "NaturalMaps (https://github.com/JustinZarb/natural_maps)",
+}
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """Return the process-wide pooled session"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=10, pool_maxsize=32)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.headers.update(HEADERS)
+            _session = session
+    return _session
+
+
+def timeout_for(url: str):
+    return TIMEOUTS.get(urlparse(url).hostname, DEFAULT_TIMEOUT)
+
+
+def backoff_delay(attempt: int, retry_after=None):
+    """Seconds to wait before retry number `attempt` (0-based).
+    Uses the server's Retry-After header when it sends one, otherwise
+    exponential backoff with full jitter."""
+    if retry_after is not None:
+        try:
+            return min(float(retry_after), BACKOFF_MAX)
+        except ValueError:
+            pass
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt))
+
+
+def get(
+    url: str,
+    params: dict = None,
+    timeout=None,
+    max_retries: int = MAX_RETRIES,
+    stream: bool = False,
+):
+    """GET a url with the shared session.
+
+    Args:
+        url (str): endpoint to call
+        params (dict, optional): query parameters
+        timeout (tuple, optional): (connect, read) timeout. Defaults to the per-host timeout.
+        max_retries (int, optional): retries on 429/504 answers
+        stream (bool, optional): don't download the body yet
+
+    Returns:
+        requests.Response: the last response received
+    """
+    session = get_session()
+    timeout = timeout or timeout_for(url)
+    for attempt in range(max_retries + 1):
+        response = session.get(url, params=params, timeout=timeout, stream=stream)
+        if response.status_code not in RETRY_STATUS or attempt == max_retries:
+            return response
+        response.close()
+        sleep(backoff_delay(attempt, response.headers.get("Retry-After")))
+    return response
+
+
+def overpass_get(query: str, url: str = None, stream: bool = False):
+    """Send an overpass QL query and return the raw response.
+    Without a url, the query is routed through the overpass endpoint pool."""
+    if url is not None:
+        return get(url, params={"data": query}, stream=stream)
+    # imported here because the pool itself sends its requests through this module
+    from .overpass_pool import get_overpass_pool
+
+    return get_overpass_pool().get(query, stream=stream)
+
+
+def configure_osmnx():
+    """osmnx talks to Nominatim with its own requests calls,
+    so at least give it the same timeout as the rest of the app"""
+    import osmnx as ox
+
+    ox.settings.timeout = timeout_for(NOMINATIM_URL)[1]
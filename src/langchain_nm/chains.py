@@ -1,9 +1,9 @@
 import os
 import json
 import pandas as pd
-import requests
 from time import gmtime, strftime
 from langchain.prompts import PromptTemplate
+from src import http_client
 from langchain.llms import OpenAI
 from langchain.chat_models import ChatOpenAI
 from langchain.chains import LLMChain
@@ -37,8 +37,7 @@ chain_to_overpass = LLMChain(
 # Function that will perform the actual overpass query
 def overpass_query(ql_query):
     """Run an overpass query"""
-    overpass_url = "http://overpass-api.de/api/interpreter"
-    response = requests.get(overpass_url, params={"data": ql_query})
+    response = http_client.overpass_get(ql_query)
     if response.content:
         try:
             data = response.json()
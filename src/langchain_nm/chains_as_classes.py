@@ -1,9 +1,9 @@
 import os
 import json
 import pandas as pd
-import requests
 from time import gmtime, strftime
 from langchain.prompts import PromptTemplate
+from src import http_client
 from langchain.llms import OpenAI
 from langchain.chat_models import ChatOpenAI
 from langchain.chains import LLMChain
@@ -62,8 +62,7 @@ class OverpassQuery:
         )
 
     def overpass_query(self, ql_query):
-        overpass_url = "http://overpass-api.de/api/interpreter"
-        response = requests.get(overpass_url, params={"data": ql_query})
+        response = http_client.overpass_get(ql_query)
         if response.content:
             try:
                 data = response.json()
@@ -42,7 +42,7 @@ class OverpassQueryTool(BaseTool):
         run_manager: Optional[CallbackManagerForToolRun] = None,
     ) -> str:
         """Use the tool."""
-        return self.api_wrapper.run(query)
+        return self.api_wrapper.process_user_input(query)
 
     async def _arun(
         self,
@@ -50,4 +50,4 @@ class OverpassQueryTool(BaseTool):
         run_manager: Optional[AsyncCallbackManagerForToolRun] = None,
     ) -> str:
         """Use the tool asynchronously."""
-        raise NotImplementedError("GooglePlacesRun does not support async")
+        return await self.api_wrapper.aprocess_user_input(query)
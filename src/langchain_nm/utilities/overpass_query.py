@@ -3,8 +3,7 @@
 Adapting this Google Places API class: https://github.com/hwchase17/langchain/blob/master/langchain/utilities/google_places_api.py
 to do what Pasquale defined in the OverpassQuery class in chains_as_classes.py into a similar format to 
 """
-import requests
-import json
+import asyncio
 from langchain.chat_models import ChatOpenAI
 from langchain.prompts import PromptTemplate
 from langchain.chains import (
@@ -15,10 +14,16 @@ from langchain.chains import (
 )
 import logging
 from langchain.utils import get_from_dict_or_env
+from src.oql import canonical_or_cleaned
+from src.overpass_preflight import fetch_budgeted
+from src.overpass_stream import answer_to_text
 
 from pydantic import BaseModel, Extra, root_validator
 from typing import Any, Dict, Optional
 
+# Longest overpass answer put into the prompt of chain_to_user
+MAX_ANSWER_CHARS = 4096
+
 
 class OverpassQueryWrapper:
     """Wrapper around Overpass API.
@@ -70,19 +75,18 @@ class OverpassQueryWrapper:
         Returns:
             str: a json string with the query result.
         """
-        overpass_url = "http://overpass-api.de/api/interpreter"
-        response = requests.get(overpass_url, params={"data": ql_query})
+        data, _ = fetch_budgeted(canonical_or_cleaned(ql_query))
+        return answer_to_text(data, MAX_ANSWER_CHARS)
 
-        if not response.content:
-            raise ValueError("Empty response from Overpass API")
-        else:
-            try:
-                data = response.json()
-            except:
-                raise ValueError(str(response))
+    async def aoverpass_query(self, ql_query: str) -> str:
+        """Async variant of overpass_query, runs it in a worker thread
+        Args:
+            ql_query (str): a string with the query in OverpassQL
 
-        data_str = json.dumps(data)
-        return data_str
+        Returns:
+            str: a json string with the query result.
+        """
+        return await asyncio.to_thread(self.overpass_query, ql_query)
 
     def perform_op_query_func(self, inputs: dict) -> dict:
         query_input = inputs["ql_query"]
@@ -91,3 +95,12 @@ class OverpassQueryWrapper:
 
     def process_user_input(self, user_text_input):
         return self.overpass_sequential_chain.run({"user_text_input": user_text_input})
+
+    async def aprocess_user_input(self, user_text_input):
+        """Same steps as overpass_sequential_chain. TransformChain has no async
+        implementation, so the three steps are awaited one after the other here."""
+        ql_query = await self.chain_to_overpass.arun(user_text_input=user_text_input)
+        overpass_answer = await self.aoverpass_query(ql_query)
+        return await self.chain_to_user.arun(
+            overpass_answer=overpass_answer, user_text_input=user_text_input
+        )
@@ -1,27 +1,48 @@
+import asyncio
 import openai
 import os
 import json
 import requests
 from time import localtime, strftime
-import osmnx as ox
 import streamlit as st
 import re
 import pandas as pd
 import folium
+from shapely.errors import GEOSException
 from .streamlit_functions import (
-    gdf_data,
-    get_nodes_with_tags_in_bbox,
-    count_tag_frequency,
-    longest_distance_to_vertex,
+    tag_census_in_bbox,
     calculate_parameters_for_map,
+    name_to_gdf,
 )
+from .geometry import projected_areas, longest_distances_to_vertex
+from .overpass_stream import answer_to_text
+from .oql import canonical_or_cleaned
+from .tag_index import TagIndex
+from .element_store import as_store
+from .tag_search import TagSearchIndex
+from .tag_vocabulary import get_tag_vocabulary
+from .geo_distance import PointIndex
+from .spatial_join import (
+    spatial_join,
+    join_summary,
+    with_positions,
+    num_dropped,
+    summary_element,
+)
+from .osm_index import get_local_index, UnsupportedQuery
+from .overpass_preflight import fetch_budgeted
 import sys
 
 sys.path.append("..")
 
+# Longest function answer we give to the LLM
+MAX_FUNCTION_RESPONSE_CHARS = 4096
+# Keep nearest_results answers short enough for the LLM
+MAX_NEAREST_RESULTS = 20
+
 
 class ChatBot:
-    def __init__(self, log_path: str = None, openai_api_key=None):
+    def __init__(self, log_path: str = None, openai_api_key=None, osm_index=None):
         # Get OpenAI Key
         openai.api_key = openai_api_key
         assert openai.api_key, "Failed to find API keys"
@@ -35,6 +56,19 @@ class ChatBot:
         # Store overpass queries in the class
         self.overpass_queries = {}
         self.latest_query_result = None
+        self.latest_overpass_answer = None
+        # bboxes of the places seen by get_place_info, the (type, id) of the
+        # elements in their census, and the search index of its tags
+        self.census_bboxes = set()
+        self.census_ids = set()
+        self.tag_search = TagSearchIndex()
+        # All the unique tags as key:value pairs, kept up to date by tag_search
+        # eg. unique_tags_dict["dance"] = ['Body Isolation', 'Capoeira', 'Forró', ...]
+        self.unique_tags_dict = self.tag_search.unique_values
+        # Nearest neighbour index over the latest overpass answer
+        self.point_index = None
+        # Answer queries from a local OSM extract when one is configured
+        self.osm_index = osm_index if osm_index is not None else get_local_index()
         self.places_gdf = None
         st.session_state["gdf"] = self.places_gdf
         # Store transformed gdf files
@@ -43,6 +77,8 @@ class ChatBot:
         self.functions = {
             "overpass_query": self.overpass_query,
             "get_place_info": self.get_place_info,
+            "nearest_results": self.nearest_results,
+            "join_results": self.join_results,
         }
         self.function_status_pass = False  # Used to indicate function success
         self.function_metadata = [
@@ -54,6 +90,7 @@ class ChatBot:
                 '[out:json][timeout:25];area[name="Marzahn-Hellersdorf"];node(area)["wheelchair"="yes"]["shop"];out;'
                     Instructions:
                     - Keep the queries simple and specific.
+                    - For "A near B" don't use around, use join_results with one simple query for A and one for B.
                     - Always use Overpass built-in geocodeArea for locations like this {{geocodeArea:charlottenburg}}->.searchArea; 
                     - Use correct formatting, like using square brackets around nodes.
                     - If previous attempts fail:
@@ -72,6 +109,11 @@ class ChatBot:
                                 Starts with '[out:json][timeout:25];'.  Important: Ensure that 
                                 this is a properly formatted .json string.""",
                         },
+                        "page_after": {
+                            "type": "string",
+                            "description": """Only to get the next page of a big answer: the
+                                next_page_after value of the previous page, eg. "node/123".""",
+                        },
                     },
                     "required": ["prompt", "query"],
                 },
@@ -107,6 +149,70 @@ class ChatBot:
                     "required": ["place", "search_words"],
                 },
             },
+            {
+                "name": "nearest_results",
+                "description": """Find the results of the latest overpass query closest to a place or a point,
+                eg. the nearest toilets to a park. Run overpass_query for the things to find first.
+                Give either a place name or lat and lon. Without radius, returns the k nearest results,
+                with radius, all results within radius metres. Distances are in metres.""",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "place": {
+                            "type": "string",
+                            "description": "The name of the place to measure from.",
+                        },
+                        "lat": {
+                            "type": "number",
+                            "description": "Latitude of the point",
+                        },
+                        "lon": {
+                            "type": "number",
+                            "description": "Longitude of the point",
+                        },
+                        "k": {
+                            "type": "integer",
+                            "description": "How many results to return, default 5",
+                        },
+                        "radius": {
+                            "type": "number",
+                            "description": "Search radius in metres",
+                        },
+                    },
+                },
+            },
+            {
+                "name": "join_results",
+                "description": """Find the results of one overpass query that are near (or intersect) the results
+                of another, eg. "bike parking near spätis in Kreuzberg": query_a finds the bike parkings,
+                query_b the spätis. Both are simple overpass QL queries like the ones of overpass_query, without around.
+                End both with "out geom;" (or "out center;") so ways and relations have a position, elements without one
+                can't be joined and are only counted in num_dropped_a and num_dropped_b.
+                Returns the matching elements of query_a with their closest matches from query_b and the distance in metres.""",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "query_a": {
+                            "type": "string",
+                            "description": "Overpass QL query for the things to find",
+                        },
+                        "query_b": {
+                            "type": "string",
+                            "description": "Overpass QL query for the things they should be near",
+                        },
+                        "distance": {
+                            "type": "number",
+                            "description": "Maximum distance in metres, default 100",
+                        },
+                        "predicate": {
+                            "type": "string",
+                            "enum": ["near", "intersects"],
+                            "description": "near (default) or intersects, eg. benches inside parks",
+                        },
+                    },
+                    "required": ["query_a", "query_b"],
+                },
+            },
         ]
 
         # Logging parameters
@@ -115,38 +221,67 @@ class ChatBot:
             log_path = "~/naturalmaps_logs"
             self.log_path = os.path.expanduser(log_path)
 
-    def overpass_query(self, human_prompt, generated_query):
+    def overpass_query(self, human_prompt, generated_query, page_after=None):
         """Run an overpass query
         To improve chances of success, run this multiple times for simpler queries.
         eg. prompt: "Find bike parking near tech parks in Kreuzberg, Berlin"
         in this example, a complex query is likely to fail, so it is better to run
         a first query for bike parking in Kreuzberk and a second one for tech parks in Kreuzberg
+        Big answers are paged, page_after asks for the page after an element (see
+        overpass_preflight.fetch_page).
         """
-        overpass_url = "http://overpass-api.de/api/interpreter"
-
         # Check that the query is properly formatted
-        cleaned_query = generated_query.replace("\n", "").replace("\\", "")
-        response = requests.get(overpass_url, params={"data": cleaned_query})
-        if response.content:
+        cleaned_query = canonical_or_cleaned(generated_query.replace("\\", ""))
+
+        if self.osm_index is not None and page_after is None:
             try:
-                data = response.json()
+                data = self.osm_index.overpass_query(cleaned_query)
                 self.latest_query_result = data
-            except:
-                self.log_overpass_query(
-                    human_prompt, generated_query, cleaned_query, response
+                return self.overpass_answer_to_str(
+                    human_prompt, generated_query, cleaned_query, data
                 )
-                return json.dumps({"error": "Raised an error"})
-
-        data_str = json.dumps(data)
-        if len(data) > 1000:
-            # return a summary of the data and some features
-            data_str = json.dumps(
-                {
-                    "success": "the query returned so much data and we are working on summarizing it. For now it will just be displayed."
-                }
+            except UnsupportedQuery:
+                # Fall back to the overpass api
+                pass
+
+        # Repeated queries (eg. the demo prompts) are answered from the local
+        # cache, others are counted first so we don't download answers too
+        # big to use
+        try:
+            data, self.latest_query_result = fetch_budgeted(cleaned_query, page_after)
+        except (requests.RequestException, ValueError) as e:
+            data = {"error": f"Overpass request failed: {e}"}
+            self.latest_overpass_answer = data
+            data_str = json.dumps(data)
+            self.log_overpass_query(
+                human_prompt, generated_query, cleaned_query, data_str, data
             )
+            return data_str
 
-        self.log_overpass_query(human_prompt, generated_query, cleaned_query, data_str)
+        return self.overpass_answer_to_str(
+            human_prompt, generated_query, cleaned_query, data
+        )
+
+    async def aoverpass_query(self, human_prompt, generated_query, page_after=None):
+        """Async variant of overpass_query, lets several queries overlap their
+        network waits. Runs the same steps (local index, cache, preflight and
+        budget) in a worker thread."""
+        return await asyncio.to_thread(
+            self.overpass_query, human_prompt, generated_query, page_after
+        )
+
+    def overpass_answer_to_str(
+        self, human_prompt, generated_query, cleaned_query, data
+    ):
+        """Turn an overpass answer into the string returned to the LLM and log it"""
+        # Keep the parsed answer so execute_function doesn't have to parse data_str again
+        self.latest_overpass_answer = data
+        # Only as many elements as the LLM can take, the map gets all of them
+        data_str = answer_to_text(data, MAX_FUNCTION_RESPONSE_CHARS)
+
+        self.log_overpass_query(
+            human_prompt, generated_query, cleaned_query, data_str, data
+        )
         return data_str
 
     def get_place_info(self, place: str, search_words: str = None):
@@ -162,7 +297,7 @@ class ChatBot:
         """
 
         try:
-            new_gdf = ox.geocode_to_gdf(place)  # geodataframe
+            new_gdf = name_to_gdf(place)  # geodataframe
             if self.places_gdf is None:
                 self.places_gdf = new_gdf
             else:
@@ -172,9 +307,9 @@ class ChatBot:
         except ValueError as e:
             return e
 
-        # Get a list of unique keys in all the areas provided, sorted by frequency.
-        nodes = []
-        bounding_boxes = self.places_gdf.loc[
+        # Get the unique keys in all the areas provided. Places seen in earlier
+        # calls keep their census, only the new place is fetched and merged.
+        bounding_boxes = new_gdf.loc[
             :,
             [
                 "bbox_south",
@@ -183,29 +318,42 @@ class ChatBot:
                 "bbox_east",
             ],
         ]
-
         for _, row in bounding_boxes.iterrows():
-            nodes.append(get_nodes_with_tags_in_bbox(list(row)))
-            # All the unique tags as key:value pairs
-            # eg. unique_tags_dict["dance"] = {'Body Isolation', 'Capoeira', 'Forró', ...}
-            self.unique_tags_dict = count_tag_frequency(nodes)
-            num_unique_values = {k: len(v) for k, v in self.unique_tags_dict.items()}
-            num_unique_values = {
-                k: v
-                for k, v in sorted(
-                    num_unique_values.items(), key=lambda item: item[1], reverse=True
-                )
-            }
+            bbox = tuple(row)
+            if bbox in self.census_bboxes:
+                continue
+            census = None
+            if self.osm_index is not None:
+                try:
+                    census = self.osm_index.nodes_with_tags_in_bbox(list(bbox))
+                except UnsupportedQuery:
+                    # Outside the extract, fall back to the overpass api
+                    pass
+            if census is not None:
+                elements = census["elements"]
+            else:
+                # Only the tags are needed, counted as the tiles come in
+                elements = tag_census_in_bbox(list(bbox))
+            # Only the new place's tags are added to the search index, and
+            # elements already counted for an overlapping place are skipped
+            place_ids = set()
+            place_index = TagIndex().add_elements(
+                self.new_census_elements(elements, place_ids)
+            )
+            self.tag_search.add_tag_index(place_index)
+            # Only recorded once the whole census of the place went in
+            self.census_ids |= place_ids
+            self.census_bboxes.add(bbox)
 
         # add projected area to the gdf
-        self.places_gdf[["projected_area", "area_unit"]] = self.places_gdf.apply(
-            lambda row: gdf_data(row, self.places_gdf.crs), axis=1
-        )
+        areas = projected_areas(self.places_gdf)
+        self.places_gdf["projected_area"] = areas["area"]
+        self.places_gdf["area_unit"] = areas["unit"]
 
         # Add a column for each geometry with the longest distance from the centroid to the boundary
-        self.places_gdf["longest_distance_to_vertex"] = self.places_gdf[
-            "geometry"
-        ].apply(longest_distance_to_vertex)
+        self.places_gdf["longest_distance_to_vertex"] = longest_distances_to_vertex(
+            self.places_gdf["geometry"]
+        )
 
         data = {}
         tag_matches = self.search_dict(self.unique_tags_dict, search_words)
@@ -217,6 +365,13 @@ class ChatBot:
                 tag_matches_to_keep[k] = ["too many values"]
 
         data["tag_matches"] = tag_matches_to_keep
+        # Nothing in the census: suggest commonly used tags instead, so the
+        # LLM doesn't have to guess and retry
+        vocabulary = get_tag_vocabulary()
+        if not tag_matches_to_keep and vocabulary is not None and search_words:
+            data["tag_suggestions"] = vocabulary.search(
+                search_words, max_keys=10, max_values=5
+            )
         # st.markdown(data)
         # if "search_words" in data and data["search_words"].strip() != "":
         # else:
@@ -232,24 +387,125 @@ class ChatBot:
         tags = json.dumps(data)
         return tags
 
+    def nearest_results(
+        self,
+        place: str = None,
+        lat: float = None,
+        lon: float = None,
+        k: int = 5,
+        radius: float = None,
+    ):
+        """Results of the latest overpass query nearest to a place or a point.
+        Can be called by the LLM
+        Returns:
+            data (str): A JSON string with the origin and the results, closest first,
+            each with its distance in metres
+        """
+        if self.latest_query_result is None:
+            return json.dumps({"error": "Run an overpass query first"})
+        if place is not None:
+            try:
+                gdf = name_to_gdf(place)
+            except ValueError as e:
+                return json.dumps({"error": str(e)})
+            lat, lon = float(gdf["lat"].iloc[0]), float(gdf["lon"].iloc[0])
+        elif lat is None or lon is None:
+            return json.dumps({"error": "Give a place or lat and lon"})
+
+        # One index per overpass answer
+        if self.point_index is None or self.point_index.source is not (
+            self.latest_query_result
+        ):
+            self.point_index = PointIndex(self.latest_query_result)
+        k = max(1, min(int(k), MAX_NEAREST_RESULTS))
+        if radius is not None:
+            results = self.point_index.within(lat, lon, radius)
+            data = {"num_within_radius": len(results), "results": results[:k]}
+        else:
+            data = {"results": self.point_index.nearest(lat, lon, k)}
+        data["origin"] = {"lat": lat, "lon": lon}
+        return json.dumps(data)
+
+    def query_answer(self, query: str):
+        """(data, map_data) of an overpass query, from the local index when
+        possible, otherwise cached, preflighted and within the download
+        budget like overpass_query (see fetch_budgeted). Raises on network
+        and overpass errors."""
+        cleaned_query = canonical_or_cleaned(query.replace("\\", ""))
+        if self.osm_index is not None:
+            try:
+                data = self.osm_index.overpass_query(cleaned_query)
+                return data, data
+            except UnsupportedQuery:
+                pass
+        return fetch_budgeted(cleaned_query)
+
+    def join_results(
+        self,
+        query_a: str,
+        query_b: str,
+        distance: float = 100,
+        predicate: str = "near",
+    ):
+        """Elements of query_a near (or intersecting) elements of query_b,
+        joined locally instead of with an around query on the server.
+        Can be called by the LLM
+        The queries are asked for the geometry of their ways and relations
+        if they don't already (see spatial_join.with_positions).
+        Returns:
+            data (str): A JSON string with the number of elements of each query,
+            the number of elements left out for lack of a position, the
+            number of matches and the matching elements of query_a, with
+            their position but without their geometry, as many as fit in
+            MAX_FUNCTION_RESPONSE_CHARS
+        """
+        try:
+            answer_a, left = self.query_answer(with_positions(query_a))
+            answer_b, right = self.query_answer(with_positions(query_b))
+            left_elements, right_elements, pairs = spatial_join(
+                left, right, predicate=predicate, distance=distance
+            )
+        except (requests.RequestException, ValueError, GEOSException) as e:
+            return json.dumps({"error": str(e)})
+
+        matched = join_summary(left_elements, right_elements, pairs)
+        # Show the matches on the map
+        self.latest_query_result = {
+            **{k: v for k, v in left.items() if k != "elements"},
+            "elements": matched,
+        }
+        data = {
+            "num_a": len(left_elements),
+            "num_b": len(right_elements),
+            "num_dropped_a": num_dropped(left, left_elements),
+            "num_dropped_b": num_dropped(right, right_elements),
+            "num_matched": len(matched),
+        }
+        # Answers cut by the download budget say so
+        for name, answer in [("note_a", answer_a), ("note_b", answer_b)]:
+            if "note" in answer:
+                data[name] = answer["note"]
+        data["elements"] = [summary_element(element) for element in matched]
+        return answer_to_text(data, MAX_FUNCTION_RESPONSE_CHARS)
+
+    def new_census_elements(self, elements, seen: set):
+        """The elements not counted in the census yet, by (type, id). The
+        (type, id) of the elements yielded are added to seen."""
+        for element in elements:
+            key = (element.get("type"), element.get("id"))
+            if key not in self.census_ids and key not in seen:
+                seen.add(key)
+                yield element
+
     def search_dict(self, d, substring):
-        search_words = [s.strip() for s in substring.replace(",", " ").split()]
-
-        print(search_words)
-        matches = {}
-        for s in search_words:
-            # Add key value pairs if a substring appears in either key or value. Value is a list of strings. return only the matching string
-            for key, value in d.items():
-                if s in key:
-                    matches[key] = value
-                else:
-                    for v in value:
-                        if s in v:
-                            if key in matches:
-                                matches[key].append(v)
-                            else:
-                                matches[key] = [v]
-        return matches
+        """Keys and values of d ({key: [values]}) containing any of the words
+        in substring, deduplicated and ordered by frequency. The census of
+        get_place_info uses its prebuilt index (see tag_search)."""
+        if d is self.unique_tags_dict:
+            index = self.tag_search
+        else:
+            index = TagSearchIndex(d)
+        return index.search(substring)
 
     def save_to_json(self, file_path: str, this_run_name: str, log: dict):
         json_file_path = (
@@ -286,14 +542,15 @@ class ChatBot:
         return strftime("%Y-%m-%d %H:%M:%S", localtime())
 
     def log_overpass_query(
-        self, human_prompt, generated_query, cleaned_query, data_str
+        self, human_prompt, generated_query, cleaned_query, data_str, data_dict=None
     ):
         # Write Overpass API Call to JSON
         timestamp = self.get_timestamp()
         this_run_name = f"{timestamp} | {human_prompt}"
         filepath = os.path.join(self.log_path, "overpass_query_log.json")
         success = True if "error" not in data_str else False
-        data_dict = json.loads(data_str)
+        if data_dict is None:
+            data_dict = json.loads(data_str)
         returned_something = (
             True
             if ("elements" in data_dict and len(data_dict["elements"])) > 0
@@ -327,28 +584,16 @@ class ChatBot:
             log=self.overpass_queries[human_prompt],
         )
 
-    def process_osm_data(data, features):
+    @staticmethod
+    def process_osm_data(elements, features):
         """#ToDo: Use this to summarize a big OSM result.
-        # Replace 'data' with your actual JSON data
+        elements can be an ElementStore or any iterable of overpass elements,
+        eg. an OverpassStream, so a big answer never has to be held in memory
+        as dicts.
         # Replace 'features' with a list of features you're interested in
-        metadata = process_osm_data(data, ['gluten_free', 'vegan'])
+        metadata = ChatBot.process_osm_data(stream, ['gluten_free', 'vegan'])
         print(metadata)"""
-        items = json.loads(data)
-        num_elements = len(items)
-        unique_names = set()
-        special_features = {feature: 0 for feature in features}
-
-        for item in items:
-            unique_names.add(item["tags"]["name"])
-            for feature in features:
-                if feature in item["tags"] and item["tags"][feature] == "yes":
-                    special_features[feature] += 1
-
-        return {
-            "num_elements": num_elements,
-            "num_unique_names": len(unique_names),
-            "special_features": special_features,
-        }
+        return as_store(elements).summary(features)
 
     def add_system_message(self, content):
         self.messages.append({"role": "system", "content": content})
@@ -399,8 +644,8 @@ class ChatBot:
                 # Specific checks for self.overpass_query()
                 if function_name == "overpass_query":
                     try:
-                        data = json.loads(function_response)
-                        if len(function_response) > 4096:
+                        data = self.latest_overpass_answer
+                        if len(function_response) > MAX_FUNCTION_RESPONSE_CHARS:
                             function_response = (
                                 "Overpass query returned too many results."
                             )
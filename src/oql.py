@@ -0,0 +1,418 @@
+"""Overpass QL tokenizer and canonicalizer.
+
+canonicalize_query turns the textual variants of a query (spacing, quotes,
+order of settings and independent union members) into one text, which is
+both the cache key and the text sent to overpass.
+"""
+import re
+
+
+class OQLSyntaxError(ValueError):
+    pass
+
+
+TOKEN_RE = re.compile(
+    r"""
+    (?P<space>\s+)
+  | (?P<comment>//[^\n]*|/\*.*?\*/)
+  | (?P<dstring>"(?:[^"\\\n]|\\.)*")
+  | (?P<sstring>'(?:[^'\\\n]|\\.)*')
+  | (?P<arrow>->)
+  | (?P<number>-?\d+(?:\.\d+)?(?:[eE]-?\d+)?)
+  | (?P<word>[^\W\d]\w*)
+  | (?P<punct>[^\s\w])
+    """,
+    re.VERBOSE | re.DOTALL,
+)
+
+DEFAULT_TIMEOUT = "180"
+OUT_VERBOSITY = {"ids", "skel", "body", "tags", "meta", "noids"}
+OUT_GEOMETRY = {"geom", "bb", "center"}
+OUT_SORT = {"asc", "qt"}
+QUERY_TYPES = {"node", "way", "rel", "relation", "nwr", "nw", "nr", "wr", "area"}
+# First token of a (...) filter that only depends on constants (ids,
+# polygon, user, dates). area and around are only safe with an explicit
+# .set or id, a bare (area) reads the default set "_".
+SAFE_FILTER_STARTS = {"poly", "id", "user", "uid", "newer", "changed"}
+
+
+def tokenize(query: str):
+    """Split a query into (kind, text) tokens. Strings keep their quotes."""
+    tokens = []
+    pos = 0
+    while pos < len(query):
+        match = TOKEN_RE.match(query, pos)
+        if match is None or (match.lastgroup == "punct" and match.group() in "\"'"):
+            raise OQLSyntaxError(f"Unterminated string at position {pos}")
+        kind = match.lastgroup
+        text = match.group()
+        pos = match.end()
+        if kind in ("space", "comment"):
+            continue
+        if kind == "sstring":
+            # 'it\'s' -> "it's"
+            inner = text[1:-1].replace("\\'", "'").replace('"', '\\"')
+            kind, text = "dstring", f'"{inner}"'
+        tokens.append((kind, text))
+    return tokens
+
+
+def render(tokens):
+    """Join tokens, with a space only where two words would otherwise merge"""
+    out = []
+    previous = None
+    for kind, text in tokens:
+        if previous in ("word", "number") and kind in ("word", "number"):
+            out.append(" ")
+        out.append(text)
+        previous = kind
+    return "".join(out)
+
+
+def split_statements(tokens):
+    """Split at top-level semicolons. Returns (statements, trailing tokens)."""
+    statements = []
+    current = []
+    depth = 0
+    for token in tokens:
+        text = token[1]
+        if text in "([{" and token[0] == "punct":
+            depth += 1
+        elif text in ")]}" and token[0] == "punct":
+            depth -= 1
+            if depth < 0:
+                raise OQLSyntaxError(f"Unbalanced '{text}'")
+        if text == ";" and depth == 0:
+            statements.append(current)
+            current = []
+        else:
+            current.append(token)
+    if depth != 0:
+        raise OQLSyntaxError("Unbalanced brackets")
+    return statements, current
+
+
+def matching(tokens, start):
+    """Index of the bracket closing the one at tokens[start]"""
+    depth = 0
+    for i in range(start, len(tokens)):
+        if tokens[i][0] != "punct":
+            continue
+        if tokens[i][1] in "([{":
+            depth += 1
+        elif tokens[i][1] in ")]}":
+            depth -= 1
+            if depth == 0:
+                return i
+    raise OQLSyntaxError("Unbalanced brackets")
+
+
+def is_settings(statement):
+    """The optional first statement: [out:json][timeout:25]..."""
+    return (
+        len(statement) >= 3
+        and statement[0] == ("punct", "[")
+        and statement[1][0] == "word"
+        and statement[2] == ("punct", ":")
+    )
+
+
+def canonical_settings(statement):
+    settings = {}
+    i = 0
+    while i < len(statement):
+        if statement[i] != ("punct", "["):
+            raise OQLSyntaxError("Expected '[' in settings")
+        end = matching(statement, i)
+        name = statement[i + 1][1]
+        settings[name] = statement[i + 3 : end]
+        i = end + 1
+    if "timeout" in settings and render(settings["timeout"]) == DEFAULT_TIMEOUT:
+        del settings["timeout"]
+    parts = []
+    for name in sorted(settings):
+        parts += [("punct", "["), ("word", name), ("punct", ":")]
+        parts += settings[name]
+        parts.append(("punct", "]"))
+    return parts
+
+
+def canonical_filter(tokens):
+    """Quote bare keys and values inside a [...] tag filter.
+    Runs like addr:street are joined into one key. The ',i' flag stays bare."""
+    out = []
+    i = 0
+    while i < len(tokens):
+        kind, text = tokens[i]
+        after_comma = out and out[-1] == ("punct", ",")
+        if kind in ("word", "number") and not after_comma:
+            run = [text]
+            i += 1
+            while i < len(tokens) and (
+                tokens[i][0] in ("word", "number") or tokens[i] == ("punct", ":")
+            ):
+                run.append(tokens[i][1])
+                i += 1
+            out.append(("dstring", '"' + "".join(run) + '"'))
+            continue
+        out.append(tokens[i])
+        i += 1
+    return out
+
+
+def canonical_body(tokens):
+    """Canonicalize the tokens of one statement (without its semicolon)"""
+    out = []
+    i = 0
+    while i < len(tokens):
+        token = tokens[i]
+        if token == ("punct", "(") and i == 0:
+            # A union or difference block
+            end = matching(tokens, i)
+            out += canonical_block(tokens[i + 1 : end])
+            i = end + 1
+            continue
+        if token == ("punct", "["):
+            end = matching(tokens, i)
+            out.append(token)
+            out += canonical_filter(tokens[i + 1 : end])
+            out.append(tokens[end])
+            i = end + 1
+            continue
+        out.append(token)
+        i += 1
+    return out
+
+
+def is_independent(statement):
+    """True if a union member neither defines nor reads a set, so moving it
+    around inside the union can't change the result."""
+    if not statement or statement[0] not in (("word", t) for t in QUERY_TYPES):
+        return False
+    for i, (kind, text) in enumerate(statement):
+        if kind == "arrow":
+            return False
+        if text == "." and kind == "punct":
+            # .set as input, only allowed as area.set or around.set
+            if i == 0 or statement[i - 1] not in (("word", "area"), ("word", "around")):
+                return False
+        if text == "(" and kind == "punct" and i + 1 < len(statement):
+            first_kind, first_text = statement[i + 1]
+            if first_kind == "number" or first_text in SAFE_FILTER_STARTS:
+                continue
+            after = statement[i + 2 : i + 3]
+            if first_text == "area" and after in ([("punct", ".")], [("punct", ":")]):
+                continue
+            if first_text == "around" and after == [("punct", ".")]:
+                continue
+            return False
+    return True
+
+
+def canonical_block(tokens):
+    statements, trailing = split_statements(tokens)
+    if trailing:
+        statements.append(trailing)
+    members = [canonical_body(s) for s in statements]
+    if all(is_independent(s) for s in statements):
+        members = sorted(set(render(m) for m in members))
+        members = [tokenize(m) for m in members]
+    out = [("punct", "(")]
+    for member in members:
+        out += member
+        out.append(("punct", ";"))
+    out.append(("punct", ")"))
+    return out
+
+
+def canonicalize_query(query: str):
+    """Return the canonical text of an overpass QL query.
+
+    Raises:
+        OQLSyntaxError: if the query can't be tokenized or has unbalanced brackets
+    """
+    statements, trailing = split_statements(tokenize(query))
+    if trailing:
+        # A missing final semicolon
+        statements.append(trailing)
+    parts = []
+    for n, statement in enumerate(statements):
+        if not statement:
+            continue
+        if n == 0 and is_settings(statement):
+            statement = canonical_settings(statement)
+            if not statement:
+                continue
+        else:
+            statement = canonical_body(statement)
+        parts.append(render(statement) + ";")
+    return "".join(parts)
+
+
+def canonical_or_cleaned(query: str):
+    """canonicalize_query, falling back to the whitespace-collapsed query
+    for text the tokenizer doesn't understand. Never raises."""
+    try:
+        return canonicalize_query(query)
+    except OQLSyntaxError:
+        return " ".join(query.split())
+
+
+def out_index(statement):
+    """Position of the 'out' keyword if the statement is an out statement
+    (out ...; or .set out ...;), else None"""
+    if statement[:1] == [("word", "out")]:
+        return 0
+    if statement[:1] == [("punct", ".")] and statement[2:3] == [("word", "out")]:
+        return 2
+    return None
+
+
+def primary_out(query: str):
+    """Split a query at its first out statement, which outputs the primary
+    set. Later statements (eg. >;out skel qt; for the nodes of ways) only add
+    to what the first one returns.
+
+    Returns:
+        before (list): the statements before the out statement
+        out (list): the out statement up to and including 'out'
+        options (list): the tokens after 'out'
+        after (list): the statements after the out statement
+
+    Raises:
+        OQLSyntaxError: if the query has no out statement
+    """
+    statements, trailing = split_statements(tokenize(canonicalize_query(query)))
+    for n, statement in enumerate(statements):
+        i = out_index(statement)
+        if i is not None:
+            return (
+                statements[:n],
+                statement[: i + 1],
+                statement[i + 1 :],
+                statements[n + 1 :],
+            )
+    raise OQLSyntaxError("Query has no out statement")
+
+
+def join_statements(statements):
+    return "".join(render(statement) + ";" for statement in statements)
+
+
+def split_out_options(options):
+    """Sort the options of an out statement into
+    (verbosity, geometry, sort, limit, other). A bbox in brackets stays
+    with the geometry word it belongs to."""
+    parts = {"verbosity": [], "geometry": [], "sort": [], "limit": [], "other": []}
+    i = 0
+    while i < len(options):
+        kind, text = options[i]
+        part = "other"
+        if kind == "word" and text in OUT_VERBOSITY:
+            part = "verbosity"
+        elif kind == "word" and text in OUT_GEOMETRY:
+            part = "geometry"
+        elif kind == "word" and text in OUT_SORT:
+            part = "sort"
+        elif kind == "number":
+            part = "limit"
+        end = i + 1
+        if options[i] == ("punct", "("):
+            end = matching(options, i) + 1
+        elif part == "geometry" and options[end : end + 1] == [("punct", "(")]:
+            end = matching(options, end) + 1
+        parts[part] += options[i:end]
+        i = end
+    return parts
+
+
+def out_options(query: str):
+    """split_out_options of the primary out statement"""
+    return split_out_options(primary_out(query)[2])
+
+
+def with_out_count(query: str):
+    """The same query, but only counting the primary set (see primary_out),
+    not eg. the nodes recursed for the geometry of ways"""
+    before, out, options, after = primary_out(query)
+    return join_statements(before + [out + [("word", "count")]])
+
+
+def limited_options(options, limit: int, geometry: bool = False):
+    """out options returning at most `limit` elements, ordered by id.
+    Only a numeric limit is replaced, a bbox like geom(52.5,13.3,52.6,13.4)
+    is kept. With geometry, ways and relations get their geometry inline."""
+    parts = split_out_options(options)
+    if geometry and not parts["geometry"]:
+        parts["geometry"] = [("word", "geom")]
+    return (
+        parts["verbosity"]
+        + parts["geometry"]
+        + parts["other"]
+        + [("word", "asc"), ("number", str(limit))]
+    )
+
+
+def with_out_limit(query: str, limit: int):
+    """The same query, but returning at most `limit` elements of the primary
+    set, ordered by id so the page is stable.
+
+    Statements after the primary out statement are dropped, they would
+    recurse from the whole set and not just the page. If there were any,
+    the page asks for the geometry inline instead, so paged ways keep their
+    shape."""
+    before, out, options, after = primary_out(query)
+    return join_statements(
+        before + [out + limited_options(options, limit, geometry=bool(after))]
+    )
+
+
+def with_out_geometry(query: str):
+    """The same query, but with the geometry of ways and relations inline
+    ("out geom"), unless its primary out statement already asks for one
+    (geom, center or bb). Later statements are kept."""
+    before, out, options, after = primary_out(query)
+    if not split_out_options(options)["geometry"]:
+        options = options + [("word", "geom")]
+    return join_statements(before + [out + options] + after)
+
+
+# Order of the element types in an "out asc" answer
+PAGE_TYPES = ["node", "way", "rel", "area"]
+
+
+def with_page_after(query: str, limit: int, after: str):
+    """with_out_limit for the next page of the primary set: the elements
+    that come after `after` (eg. "node/123", the last element of the
+    previous page) in id order.
+
+    Raises:
+        OQLSyntaxError: if the query can't be rewritten or after isn't type/id
+    """
+    match = re.fullmatch(r"\s*(node|way|rel|relation|area)/(\d+)\s*", after)
+    if match is None:
+        raise OQLSyntaxError(f"Can't continue after {after!r}, expected eg. node/123")
+    before, out, options, rest = primary_out(query)
+    name = out[1][1] if out[0] == ("punct", ".") else "_"
+    last_type = "rel" if match[1] == "relation" else match[1]
+    types = PAGE_TYPES[PAGE_TYPES.index(last_type) :]
+    members = [f"{types[0]}.{name}(if:id()>{match[2]});"]
+    members += [f"{osm_type}.{name};" for osm_type in types[1:]]
+    continuation = "(" + "".join(members) + f")->.{name};"
+    return (
+        join_statements(before)
+        + continuation
+        + join_statements([out + limited_options(options, limit, geometry=bool(rest))])
+    )
+
+
+def with_count_and_limit(query: str, limit: int):
+    """Count the primary set and return its first `limit` elements in one
+    request, so overpass evaluates the query only once. The first element of
+    the answer is the count."""
+    before, out, options, after = primary_out(query)
+    return join_statements(
+        before
+        + [out + [("word", "count")]]
+        + [out + limited_options(options, limit, geometry=bool(after))]
+    )
@@ -0,0 +1,532 @@
+"""Offline backend answering overpass-style queries from a local OSM extract.
+
+build_index() reads a regional .osm.pbf extract (eg. Berlin from Geofabrik)
+once and writes every tagged node and way into a SQLite file with an R-tree
+spatial index and a (key, value) tag index. LocalOSMIndex then answers the
+bbox, area and tag-filter patterns the bot generates without going over the
+network.
+
+Ways are stored with their bbox and center, like "out center". Relations
+aren't imported, queries for them are left to overpass. Areas
+(area[name=...], {{geocodeArea:...}}) are resolved with the geocoder and
+matched against the element positions. Queries using anything else (around,
+recursion, set differences, ...), queries reaching outside the extract and
+any error while answering raise UnsupportedQuery, so the caller can fall
+back to the overpass api.
+
+Reading .pbf files needs pyosmium (pip install osmium); querying an existing
+index doesn't.
+"""
+import os
+import re
+import sqlite3
+import threading
+
+from shapely import contains_xy
+
+from .bbox_tiles import intersection
+from .oql import canonicalize_query, split_statements, tokenize, matching, render
+from .single_flight import geocode_flight, geocode_key
+
+
+BATCH_SIZE = 10000
+INDEX_ENV_VAR = "NATURALMAPS_OSM_INDEX"
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS elements (
+        rowid INTEGER PRIMARY KEY,
+        type TEXT NOT NULL,
+        id INTEGER NOT NULL,
+        lat REAL NOT NULL,
+        lon REAL NOT NULL
+    )""",
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_elements ON elements (type, id)",
+    """CREATE VIRTUAL TABLE IF NOT EXISTS element_bounds USING rtree(
+        rowid, min_lat, max_lat, min_lon, max_lon
+    )""",
+    "CREATE TABLE IF NOT EXISTS tags (elem INTEGER, key TEXT, value TEXT)",
+    "CREATE INDEX IF NOT EXISTS idx_tags_key_value ON tags (key, value)",
+    "CREATE INDEX IF NOT EXISTS idx_tags_elem ON tags (elem)",
+    "CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT)",
+]
+
+
+class UnsupportedQuery(ValueError):
+    """The query uses something the local index can't answer"""
+
+
+def build_index(pbf_path: str, index_path: str):
+    """Import the tagged nodes and ways of a .osm.pbf extract into a SQLite index.
+
+    Args:
+        pbf_path (str): eg. "berlin-latest.osm.pbf"
+        index_path (str): where to write the index
+    """
+    try:
+        import osmium
+    except ImportError:
+        raise ImportError("Building an OSM index needs pyosmium: pip install osmium")
+
+    folder_path = os.path.dirname(index_path)
+    if folder_path and not os.path.exists(folder_path):
+        os.makedirs(folder_path)
+    conn = sqlite3.connect(index_path)
+    for statement in SCHEMA:
+        conn.execute(statement)
+
+    class Handler(osmium.SimpleHandler):
+        def __init__(self):
+            super().__init__()
+            self.rowid = 0
+            # [S, W, N, E] of everything imported
+            self.bounds_seen = [90.0, 180.0, -90.0, -180.0]
+            self.elements = []
+            self.bounds = []
+            self.tags = []
+
+        def add(self, osm_type, osm_id, tags, min_lat, max_lat, min_lon, max_lon):
+            self.rowid += 1
+            lat, lon = (min_lat + max_lat) / 2, (min_lon + max_lon) / 2
+            self.elements.append((self.rowid, osm_type, osm_id, lat, lon))
+            self.bounds.append((self.rowid, min_lat, max_lat, min_lon, max_lon))
+            self.tags += [(self.rowid, tag.k, tag.v) for tag in tags]
+            seen = self.bounds_seen
+            seen[0], seen[1] = min(seen[0], min_lat), min(seen[1], min_lon)
+            seen[2], seen[3] = max(seen[2], max_lat), max(seen[3], max_lon)
+            if len(self.elements) >= BATCH_SIZE:
+                self.flush()
+
+        def node(self, n):
+            if n.tags and n.location.valid():
+                lat, lon = n.location.lat, n.location.lon
+                self.add("node", n.id, n.tags, lat, lat, lon, lon)
+
+        def way(self, w):
+            if not w.tags:
+                return
+            locations = [n.location for n in w.nodes if n.location.valid()]
+            if not locations:
+                return
+            lats = [location.lat for location in locations]
+            lons = [location.lon for location in locations]
+            self.add("way", w.id, w.tags, min(lats), max(lats), min(lons), max(lons))
+
+        def flush(self):
+            conn.executemany(
+                "INSERT INTO elements VALUES (?, ?, ?, ?, ?)", self.elements
+            )
+            conn.executemany(
+                "INSERT INTO element_bounds VALUES (?, ?, ?, ?, ?)", self.bounds
+            )
+            conn.executemany("INSERT INTO tags VALUES (?, ?, ?)", self.tags)
+            conn.commit()
+            self.elements, self.bounds, self.tags = [], [], []
+
+    handler = Handler()
+    handler.apply_file(pbf_path, locations=True)
+    handler.flush()
+
+    reader = osmium.io.Reader(pbf_path)
+    timestamp = reader.header().get("osmosis_replication_timestamp")
+    reader.close()
+    conn.execute(
+        "INSERT OR REPLACE INTO metadata VALUES ('timestamp_osm_base', ?)",
+        (timestamp or "",),
+    )
+    conn.execute(
+        "INSERT OR REPLACE INTO metadata VALUES ('bounds', ?)",
+        (",".join(str(b) for b in handler.bounds_seen),),
+    )
+    conn.commit()
+    conn.close()
+
+
+def _regexp(pattern, value):
+    return value is not None and re.search(pattern, value) is not None
+
+
+class LocalOSMIndex:
+    def __init__(self, index_path: str):
+        if not os.path.isfile(index_path):
+            raise FileNotFoundError(f"No OSM index at {index_path}, see build_index")
+        self.index_path = index_path
+        self._local = threading.local()
+        self._bounds = None
+
+    @property
+    def conn(self):
+        # sqlite connections can't be shared between streamlit script threads
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(f"file:{self.index_path}?mode=ro", uri=True)
+            conn.create_function("REGEXP", 2, _regexp, deterministic=True)
+            self._local.conn = conn
+        return conn
+
+    def header(self):
+        row = self.conn.execute(
+            "SELECT value FROM metadata WHERE name = 'timestamp_osm_base'"
+        ).fetchone()
+        return {
+            "version": 0.6,
+            "generator": "NaturalMaps local OSM index",
+            "osm3s": {"timestamp_osm_base": row[0] if row else ""},
+        }
+
+    @property
+    def bounds(self):
+        """[S, W, N, E] of the extract. Indexes built before the bounds were
+        stored get them from the R-tree."""
+        if self._bounds is None:
+            row = self.conn.execute(
+                "SELECT value FROM metadata WHERE name = 'bounds'"
+            ).fetchone()
+            if row:
+                self._bounds = [float(b) for b in row[0].split(",")]
+            else:
+                south, north, west, east = self.conn.execute(
+                    "SELECT min(min_lat), max(max_lat), min(min_lon), max(max_lon) "
+                    "FROM element_bounds"
+                ).fetchone()
+                self._bounds = [south, west, north, east]
+        return self._bounds
+
+    def check_covered(self, bbox):
+        """Raise UnsupportedQuery unless the extract covers the whole bbox.
+        A query without a bbox or an area covers the whole world."""
+        if bbox is None:
+            raise UnsupportedQuery(
+                "Queries without a bbox or area reach outside the extract"
+            )
+        south, west, north, east = self.bounds
+        if not (
+            south <= bbox[0]
+            and west <= bbox[1]
+            and north >= bbox[2]
+            and east >= bbox[3]
+        ):
+            raise UnsupportedQuery(f"{bbox} is outside the extract {self.bounds}")
+
+    def select(self, types, bbox=None, filters=(), polygon=None):
+        """Elements of the given types in a bbox matching all tag filters.
+
+        Args:
+            types (list): subset of ["node", "way"]
+            bbox (list, optional): [S, W, N, E]
+            filters (list, optional): (op, key, value, case_insensitive) tuples,
+                op is one of "has", "not_has", "=", "!=", "~", "!~", "~~"
+            polygon (shapely geometry, optional): keep only elements inside
+                it, and inside bbox if there is one
+
+        Returns:
+            elements (list): overpass-style element dicts
+
+        Raises:
+            UnsupportedQuery: if the bbox or polygon isn't inside the extract
+        """
+        sql = ["SELECT e.rowid, e.type, e.id, e.lat, e.lon FROM elements e"]
+        where = [f"e.type IN ({', '.join('?' for _ in types)})"]
+        params = list(types)
+        if polygon is not None:
+            west, south, east, north = polygon.bounds
+            area_bbox = [south, west, north, east]
+            bbox = area_bbox if bbox is None else intersection(bbox, area_bbox)
+            if bbox is None:
+                return []
+        self.check_covered(bbox)
+        if bbox is not None:
+            sql.append("JOIN element_bounds b ON b.rowid = e.rowid")
+            where.append(
+                "b.max_lat >= ? AND b.min_lat <= ? AND b.max_lon >= ? AND b.min_lon <= ?"
+            )
+            params += [bbox[0], bbox[2], bbox[1], bbox[3]]
+        for op, key, value, case_insensitive in filters:
+            flags = "(?i)" if case_insensitive else ""
+            exists = "EXISTS (SELECT 1 FROM tags t WHERE t.elem = e.rowid AND {})"
+            if op == "has":
+                where.append(exists.format("t.key = ?"))
+                params.append(key)
+            elif op == "not_has":
+                where.append("NOT " + exists.format("t.key = ?"))
+                params.append(key)
+            elif op == "=":
+                where.append(exists.format("t.key = ? AND t.value = ?"))
+                params += [key, value]
+            elif op == "!=":
+                where.append("NOT " + exists.format("t.key = ? AND t.value = ?"))
+                params += [key, value]
+            elif op == "~":
+                where.append(exists.format("t.key = ? AND t.value REGEXP ?"))
+                params += [key, flags + value]
+            elif op == "!~":
+                where.append("NOT " + exists.format("t.key = ? AND t.value REGEXP ?"))
+                params += [key, flags + value]
+            elif op == "~~":
+                where.append(exists.format("t.key REGEXP ? AND t.value REGEXP ?"))
+                params += [flags + key, flags + value]
+        sql.append("WHERE " + " AND ".join(where))
+        rows = self.conn.execute(" ".join(sql), params).fetchall()
+
+        if polygon is not None:
+            inside = contains_xy(polygon, [r[4] for r in rows], [r[3] for r in rows])
+            rows = [row for row, keep in zip(rows, inside) if keep]
+        return self._with_tags(rows)
+
+    def _with_tags(self, rows):
+        tags = {row[0]: {} for row in rows}
+        rowids = list(tags)
+        # sqlite limits the number of bound parameters per statement
+        for start in range(0, len(rowids), 900):
+            chunk = rowids[start : start + 900]
+            for elem, key, value in self.conn.execute(
+                f"SELECT elem, key, value FROM tags WHERE elem IN ({', '.join('?' for _ in chunk)})",
+                chunk,
+            ):
+                tags[elem][key] = value
+
+        elements = []
+        for rowid, osm_type, osm_id, lat, lon in rows:
+            element = {"type": osm_type, "id": osm_id}
+            if osm_type == "node":
+                element["lat"], element["lon"] = lat, lon
+            else:
+                element["center"] = {"lat": lat, "lon": lon}
+            element["tags"] = tags[rowid]
+            elements.append(element)
+        return elements
+
+    def nodes_with_tags_in_bbox(self, bbox: list, what_to_get="nodes"):
+        """Local version of streamlit_functions.get_nodes_with_tags_in_bbox
+
+        Raises:
+            UnsupportedQuery: if the bbox isn't inside the extract, or on any
+            error reading the index
+        """
+        osm_type = "node" if what_to_get == "nodes" else "way"
+        data = self.header()
+        try:
+            data["elements"] = self.select([osm_type], bbox=bbox)
+        except UnsupportedQuery:
+            raise
+        except Exception as e:
+            raise UnsupportedQuery(f"The local index failed: {e}") from e
+        return data
+
+    def overpass_query(self, query: str):
+        """Answer an overpass QL query from the index.
+
+        Raises:
+            UnsupportedQuery: if the query uses anything the index can't
+            answer or reaches outside the extract, and on any other error
+            (syntax, geocoding, sqlite), so the caller can always fall back
+            to the overpass api
+        """
+        try:
+            return self._overpass_query(query)
+        except UnsupportedQuery:
+            raise
+        except Exception as e:
+            raise UnsupportedQuery(f"The local index failed: {e}") from e
+
+    def _overpass_query(self, query: str):
+        statements, _ = split_statements(tokenize(canonicalize_query(query)))
+        sets = {}
+        elements = []
+        for statement in statements:
+            if not statement or statement[0] == ("punct", "["):
+                # settings
+                continue
+            output = out_set(statement)
+            if output is not None:
+                name, verbosity, order, limit = output
+                if name not in sets:
+                    raise UnsupportedQuery(f"Unknown set .{name}")
+                if verbosity == "count":
+                    elements.append(count_element(sets[name]))
+                    continue
+                result = sets[name]["elements"]
+                if order == "asc":
+                    result = sorted(result, key=id_order)
+                elements += result[:limit]
+                continue
+            name, result = self.run_statement(statement, sets)
+            sets[name] = result
+        data = self.header()
+        data["elements"] = elements
+        return data
+
+    def run_statement(self, statement, sets):
+        statement, name = split_assignment(statement)
+        if statement and statement[0] == ("punct", "("):
+            end = matching(statement, 0)
+            if end != len(statement) - 1:
+                raise UnsupportedQuery("Unexpected tokens after union")
+            members, trailing = split_statements(statement[1:end])
+            members += [trailing] if trailing else []
+            seen = set()
+            union = []
+            for member in members:
+                _, result = self.run_statement(member, sets)
+                for element in result["elements"]:
+                    key = (element["type"], element["id"])
+                    if key not in seen:
+                        seen.add(key)
+                        union.append(element)
+            return name, {"elements": union}
+
+        area = parse_area(statement)
+        if area is not None:
+            return name, {"area": area, "elements": []}
+
+        types, bbox, area_set, filters = parse_query_statement(statement)
+        polygon = None
+        if area_set is not None:
+            if "area" not in sets.get(area_set, {}):
+                raise UnsupportedQuery(f"Set .{area_set} is not an area")
+            polygon = self.area_polygon(sets[area_set]["area"])
+        elements = self.select(types, bbox=bbox, filters=filters, polygon=polygon)
+        return name, {"elements": elements}
+
+    def area_polygon(self, area_name):
+        import osmnx as ox
+
+        gdf = geocode_flight.do(geocode_key(area_name), ox.geocode_to_gdf, area_name)
+        return gdf.geometry.iloc[0]
+
+
+def unquote(token):
+    kind, text = token
+    return text[1:-1].replace('\\"', '"') if kind == "dstring" else text
+
+
+def split_assignment(statement):
+    """Split 'stmt->.name' into (stmt, name). The default set is '_'."""
+    if len(statement) >= 3 and statement[-3] == ("arrow", "->"):
+        return statement[:-3], statement[-1][1]
+    return statement, "_"
+
+
+def out_set(statement):
+    """(set name, verbosity, order, limit) for an out statement, None for
+    anything else. limit is None without one."""
+    if statement[0] == ("word", "out"):
+        name, options = "_", statement[1:]
+    elif statement[0] == ("punct", ".") and statement[2:3] == [("word", "out")]:
+        name, options = statement[1][1], statement[3:]
+    else:
+        return None
+    words = [text for kind, text in options if kind == "word"]
+    limits = [int(float(text)) for kind, text in options if kind == "number"]
+    verbosity = "count" if "count" in words else "body"
+    order = "asc" if "asc" in words else "qt"
+    return name, verbosity, order, limits[0] if limits else None
+
+
+TYPE_ORDER = {"node": 0, "way": 1, "relation": 2, "area": 3}
+
+
+def id_order(element):
+    """Sort key of "out asc": by type, then id"""
+    return TYPE_ORDER[element["type"]], element["id"]
+
+
+def count_element(result):
+    counts = {"nodes": 0, "ways": 0, "relations": 0, "areas": 0}
+    for element in result["elements"]:
+        counts[element["type"] + "s"] += 1
+    counts["total"] = sum(counts.values())
+    return {"type": "count", "id": 0, "tags": {k: str(v) for k, v in counts.items()}}
+
+
+def parse_area(statement):
+    """Name of the area in area["name"="X"] or {{geocodeArea:X}}, else None"""
+    texts = [text for _, text in statement]
+    if texts[:2] == ["{", "{"] and len(texts) > 3 and texts[2] == "geocodeArea":
+        end = texts.index("}")
+        return render(statement[4:end])
+    if statement[:1] == [("word", "area")]:
+        for i in range(1, len(statement) - 3):
+            if (
+                statement[i] == ("punct", "[")
+                and unquote(statement[i + 1]) == "name"
+                and statement[i + 2] == ("punct", "=")
+            ):
+                return unquote(statement[i + 3])
+        raise UnsupportedQuery("Only areas selected by name are supported")
+    return None
+
+
+def parse_filter(tokens):
+    """(op, key, value, case_insensitive) from the tokens inside [...]"""
+    case_insensitive = tokens[-2:] == [("punct", ","), ("word", "i")]
+    if case_insensitive:
+        tokens = tokens[:-2]
+    texts = [text if kind == "punct" else None for kind, text in tokens]
+    if len(tokens) == 1:
+        return "has", unquote(tokens[0]), None, False
+    if texts[:1] == ["!"] and len(tokens) == 2:
+        return "not_has", unquote(tokens[1]), None, False
+    if len(tokens) == 3 and texts[1] in ("=", "~"):
+        return texts[1], unquote(tokens[0]), unquote(tokens[2]), case_insensitive
+    if len(tokens) == 4 and texts[1] == "!" and texts[2] in ("=", "~"):
+        op = "!" + texts[2]
+        return op, unquote(tokens[0]), unquote(tokens[3]), case_insensitive
+    if len(tokens) == 4 and texts[0] == "~" and texts[2] == "~":
+        return "~~", unquote(tokens[1]), unquote(tokens[3]), case_insensitive
+    raise UnsupportedQuery(f"Unsupported tag filter {tokens}")
+
+
+TYPES = {
+    "node": ["node"],
+    "way": ["way"],
+    "nw": ["node", "way"],
+}
+# Query types that include relations, which aren't in the index
+RELATION_TYPES = {"nwr", "nr", "wr", "rel", "relation"}
+
+
+def parse_query_statement(statement):
+    """Returns (types, bbox, area set name, filters) of eg.
+    node(area.searchArea)["shop"="supermarket"]"""
+    if statement and statement[0][0] == "word" and statement[0][1] in RELATION_TYPES:
+        raise UnsupportedQuery("Relations are not in the local index")
+    if not statement or statement[0][0] != "word" or statement[0][1] not in TYPES:
+        raise UnsupportedQuery(f"Unsupported statement {statement[:3]}")
+    types = TYPES[statement[0][1]]
+    bbox = None
+    area_set = None
+    filters = []
+    i = 1
+    while i < len(statement):
+        if statement[i][0] != "punct" or statement[i][1] not in "([":
+            raise UnsupportedQuery(f"Unexpected token {statement[i]}")
+        end = matching(statement, i)
+        inner = statement[i + 1 : end]
+        if statement[i][1] == "[":
+            filters.append(parse_filter(inner))
+        elif [kind for kind, _ in inner] == ["number", "punct"] * 3 + ["number"]:
+            bbox = [float(text) for kind, text in inner if kind == "number"]
+        elif inner == [("word", "area")]:
+            area_set = "_"
+        elif len(inner) == 3 and inner[0] == ("word", "area") and inner[1][1] == ".":
+            area_set = inner[2][1]
+        else:
+            raise UnsupportedQuery(f"Unsupported filter {inner}")
+        i = end + 1
+    return types, bbox, area_set, filters
+
+
+_default_index = None
+_default_index_lock = threading.Lock()
+
+
+def get_local_index():
+    """The index configured with NATURALMAPS_OSM_INDEX, or None"""
+    global _default_index
+    path = os.getenv(INDEX_ENV_VAR)
+    if not path:
+        return None
+    with _default_index_lock:
+        if _default_index is None:
+            _default_index = LocalOSMIndex(os.path.expanduser(path))
+    return _default_index
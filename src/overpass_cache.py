@@ -0,0 +1,174 @@
+import os
+import json
+import sqlite3
+import hashlib
+import threading
+from time import time
+from datetime import datetime, timezone
+
+from .oql import canonical_or_cleaned
+
+
+DEFAULT_CACHE_PATH = os.path.expanduser("~/naturalmaps_cache/overpass_cache.sqlite")
+
+
+def normalize_query(query: str):
+    """Canonical text of a query, so that the same query written differently shares a key"""
+    return canonical_or_cleaned(query)
+
+
+def query_key(query: str):
+    return hashlib.sha256(normalize_query(query).encode()).hexdigest()
+
+
+def osm_base_timestamp(data: dict):
+    """Return the osm3s.timestamp_osm_base of an overpass answer as a unix time.
+    Falls back to None if the answer doesn't have one."""
+    try:
+        stamp = data["osm3s"]["timestamp_osm_base"]
+        parsed = datetime.strptime(stamp, "%Y-%m-%dT%H:%M:%SZ")
+        return parsed.replace(tzinfo=timezone.utc).timestamp()
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+class OverpassCache:
+    """Persistent, content-addressed cache of overpass answers.
+
+    Entries are keyed by the normalized query text and stored in SQLite so they
+    survive between sessions and are shared by every process on the machine.
+    An entry expires once the OSM data it was computed from
+    (osm3s.timestamp_osm_base) is older than `ttl` seconds. When the cache grows
+    past `max_bytes` the least recently used entries are evicted.
+    """
+
+    def __init__(
+        self,
+        path: str = DEFAULT_CACHE_PATH,
+        ttl: float = 6 * 60 * 60,
+        max_bytes: int = 512 * 1024 * 1024,
+    ):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        folder_path = os.path.dirname(path)
+        if folder_path and not os.path.exists(folder_path):
+            os.makedirs(folder_path)
+
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                query TEXT NOT NULL,
+                response TEXT NOT NULL,
+                osm_base REAL NOT NULL,
+                last_access REAL NOT NULL,
+                size INTEGER NOT NULL
+            )"""
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_last_access ON responses (last_access)"
+        )
+        self._conn.commit()
+
+    def get(self, query: str):
+        """Return the cached answer (dict) for a query, or None on a miss"""
+        key = query_key(query)
+        now = time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response, osm_base FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            response, osm_base = row
+            if now - osm_base > self.ttl:
+                # The data behind this answer is stale
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._conn.commit()
+                self.misses += 1
+                return None
+            self._conn.execute(
+                "UPDATE responses SET last_access = ? WHERE key = ?", (now, key)
+            )
+            self._conn.commit()
+            self.hits += 1
+        return json.loads(response)
+
+    def put(self, query: str, data: dict):
+        """Store an answer. Answers with an overpass runtime error are not cached."""
+        if "error" in data.get("remark", ""):
+            return
+        response = json.dumps(data)
+        now = time()
+        osm_base = osm_base_timestamp(data) or now
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    query_key(query),
+                    normalize_query(query),
+                    response,
+                    osm_base,
+                    now,
+                    len(response),
+                ),
+            )
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        """Drop least recently used entries until the cache fits in max_bytes"""
+        (total,) = self._conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()
+        if total <= self.max_bytes:
+            return
+        rows = self._conn.execute(
+            "SELECT key, size FROM responses ORDER BY last_access ASC"
+        ).fetchall()
+        to_delete = []
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            to_delete.append((key,))
+            total -= size
+        self._conn.executemany("DELETE FROM responses WHERE key = ?", to_delete)
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+            self._conn.commit()
+
+    def stats(self):
+        """Hit/miss counters for this process and the current size on disk"""
+        with self._lock:
+            entries, size = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": entries,
+            "bytes": size,
+        }
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_overpass_cache():
+    """Return the process-wide cache shared by the bot, the wrappers and the streamlit pages"""
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = OverpassCache()
+    return _default_cache
@@ -0,0 +1,225 @@
+"""Pool of overpass endpoints.
+
+Instead of sending everything to overpass-api.de, queries are routed to the
+fastest healthy endpoint that has a free slot. Endpoints are configured with
+the OVERPASS_ENDPOINTS environment variable (comma separated interpreter
+urls, eg. a self-hosted instance or a local stand-in server for tests) and
+default to the public instances listed on the OSM wiki.
+
+- Free slots are read from each endpoint's /api/status page, at most every
+  STATUS_INTERVAL seconds, in a background thread. Queries never wait for
+  a status check, they use the last known slots.
+- Latency is tracked as an exponentially weighted moving average.
+- After FAILURE_THRESHOLD consecutive failures an endpoint's circuit opens
+  and it is skipped for COOLDOWN seconds, then tried again. If every
+  circuit is open, the endpoint whose circuit opened first is tried anyway.
+"""
+import os
+import re
+import threading
+from time import monotonic
+
+import requests
+
+from . import http_client
+
+
+PUBLIC_ENDPOINTS = [
+    "https://overpass-api.de/api/interpreter",
+    "https://overpass.kumi.systems/api/interpreter",
+    "https://overpass.private.coffee/api/interpreter",
+]
+
+STATUS_INTERVAL = 30  # seconds
+STATUS_TIMEOUT = (2, 3)
+FAILURE_THRESHOLD = 3
+COOLDOWN = 60  # seconds
+LATENCY_SMOOTHING = 0.3
+# 5xx and 429 answers count against the endpoint, 400 means the query was bad
+FAILURE_STATUS = {429, 500, 502, 503, 504}
+
+
+def status_url(interpreter_url: str):
+    return re.sub(r"/interpreter/?$", "/status", interpreter_url)
+
+
+def parse_free_slots(status_text: str):
+    """Number of free slots from an /api/status page, None if it can't tell"""
+    match = re.search(r"(\d+) slots? available now", status_text)
+    if match:
+        return int(match.group(1))
+    if "Slot available after" in status_text or "Currently running" in status_text:
+        return 0
+    return None
+
+
+class Endpoint:
+    def __init__(self, url: str):
+        self.url = url
+        self.status_url = status_url(url)
+        self.latency = None  # seconds, moving average
+        self.free_slots = None  # None means unknown
+        self.status_checked = None
+        self.refreshing = False
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+
+    def is_open(self, now):
+        """Circuit is open: the endpoint failed repeatedly and is cooling down"""
+        return now < self.open_until
+
+    def __repr__(self):
+        return (
+            f"Endpoint({self.url!r}, latency={self.latency}, "
+            f"free_slots={self.free_slots}, failures={self.consecutive_failures})"
+        )
+
+
+class EndpointPool:
+    def __init__(self, urls: list = None):
+        if urls is None:
+            configured = os.getenv("OVERPASS_ENDPOINTS")
+            urls = (
+                [u.strip() for u in configured.split(",") if u.strip()]
+                if configured
+                else PUBLIC_ENDPOINTS
+            )
+        self.endpoints = [Endpoint(url) for url in urls]
+        self._lock = threading.Lock()
+
+    def refresh_status(self, endpoint: Endpoint):
+        try:
+            response = http_client.get_session().get(
+                endpoint.status_url, timeout=STATUS_TIMEOUT
+            )
+            free_slots = parse_free_slots(response.text)
+        except requests.RequestException:
+            free_slots = None
+        with self._lock:
+            endpoint.free_slots = free_slots
+            endpoint.status_checked = monotonic()
+            endpoint.refreshing = False
+
+    def refresh_stale(self):
+        """Check the status of the endpoints not checked for STATUS_INTERVAL
+        seconds, in a background thread. Each endpoint has at most one check
+        running, however many threads are querying."""
+        now = monotonic()
+        with self._lock:
+            stale = [
+                endpoint
+                for endpoint in self.endpoints
+                if not endpoint.refreshing
+                and not endpoint.is_open(now)
+                and (
+                    endpoint.status_checked is None
+                    or now - endpoint.status_checked > STATUS_INTERVAL
+                )
+            ]
+            for endpoint in stale:
+                endpoint.refreshing = True
+        if stale:
+            threading.Thread(
+                target=self._refresh_all, args=(stale,), daemon=True
+            ).start()
+
+    def _refresh_all(self, endpoints):
+        for endpoint in endpoints:
+            self.refresh_status(endpoint)
+
+    def ranked(self):
+        """Endpoints in the order they should be tried. Endpoints with an open
+        circuit are left out until their cooldown is over, unless all of them
+        are open: then the one that opened first is tried (half-open), so a
+        single endpoint can't lock the app out for a whole cooldown."""
+        self.refresh_stale()
+        now = monotonic()
+
+        def rank(endpoint):
+            no_slots = endpoint.free_slots == 0
+            # Untried endpoints get a chance before slow known ones
+            latency = endpoint.latency if endpoint.latency is not None else 0.0
+            return (no_slots, latency)
+
+        with self._lock:
+            available = [e for e in self.endpoints if not e.is_open(now)]
+            if not available and self.endpoints:
+                return [min(self.endpoints, key=lambda e: e.open_until)]
+            return sorted(available, key=rank)
+
+    def record_success(self, endpoint: Endpoint, latency: float):
+        with self._lock:
+            endpoint.consecutive_failures = 0
+            endpoint.open_until = 0.0
+            if endpoint.latency is None:
+                endpoint.latency = latency
+            else:
+                endpoint.latency += LATENCY_SMOOTHING * (latency - endpoint.latency)
+
+    def record_failure(self, endpoint: Endpoint):
+        with self._lock:
+            endpoint.consecutive_failures += 1
+            if endpoint.consecutive_failures >= FAILURE_THRESHOLD:
+                endpoint.open_until = monotonic() + COOLDOWN
+            # We probably used its last slot
+            endpoint.free_slots = 0
+
+    def get(self, query: str, stream: bool = False):
+        """Send a query to the best endpoint, falling over to the next one
+        on connection errors and overloaded answers.
+
+        Returns:
+            requests.Response: the first acceptable response, or the last failure
+        """
+        last_error = None
+        response = None
+        # With several endpoints, fail over instead of backing off on one of them
+        max_retries = 0 if len(self.endpoints) > 1 else http_client.MAX_RETRIES
+        for endpoint in self.ranked():
+            if response is not None:
+                response.close()
+                response = None
+            start = monotonic()
+            try:
+                response = http_client.get(
+                    endpoint.url,
+                    params={"data": query},
+                    max_retries=max_retries,
+                    stream=stream,
+                )
+            except requests.RequestException as e:
+                self.record_failure(endpoint)
+                last_error = e
+                continue
+            if response.status_code in FAILURE_STATUS:
+                self.record_failure(endpoint)
+                continue
+            self.record_success(endpoint, monotonic() - start)
+            return response
+        if response is not None:
+            return response
+        raise last_error or requests.ConnectionError("No overpass endpoint available")
+
+    def stats(self):
+        return [
+            {
+                "url": e.url,
+                "latency": e.latency,
+                "free_slots": e.free_slots,
+                "consecutive_failures": e.consecutive_failures,
+                "circuit_open": e.is_open(monotonic()),
+            }
+            for e in self.endpoints
+        ]
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_overpass_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = EndpointPool()
+    return _pool
@@ -0,0 +1,228 @@
+"""Preflight a query with `out count` before downloading its answer.
+
+Overpass counts the primary set of the query (see oql.primary_out) and
+returns its first PAGE_SIZE elements, ordered by id, in the same request
+(oql.with_count_and_limit). The query is evaluated once and we never
+download more than a page:
+
+- "full": the page is the whole answer
+- "page": the first PAGE_SIZE elements, with the counts. The next pages
+  are fetched with page_after, the last element of the previous page.
+- "summary": too many elements to be useful, only the counts go to the LLM
+
+A runtime error (eg. a timeout) of the preflight request is raised, the
+query isn't run a second time.
+
+The text given to the LLM is cut to its size budget separately (see
+overpass_stream.answer_to_text), so the note saying an answer was paged
+always reaches it. PAGE_SIZE only bounds what we download and draw on the
+map.
+
+Queries that already have a limit of at most PAGE_SIZE, or only count,
+are not preflighted. Queries with more than one out statement (eg. ways and
+then their nodes with >;out skel qt;) are counted first and only paged if
+the count is too big, since a page can't carry the recursed nodes.
+
+fetch_budgeted() is the one way the bot, its async path and the langchain
+wrapper fetch the answer of a query: cache, preflight, then a streamed
+download cut off after MAX_STREAMED_ELEMENTS.
+"""
+from .bbox_tiles import fetch_query, is_incomplete
+from .overpass_cache import get_overpass_cache
+from .overpass_stream import add_note, fetch_answer
+from .single_flight import overpass_flight, overpass_key
+from .oql import (
+    OQLSyntaxError,
+    primary_out,
+    split_out_options,
+    with_count_and_limit,
+    with_out_count,
+    with_out_limit,
+    with_page_after,
+)
+
+
+PAGE_SIZE = 2000
+PAGE_LIMIT = 20000
+# Answers that weren't preflighted are cut off after this many elements,
+# or bytes of body (ways with their geometry can be big)
+MAX_STREAMED_ELEMENTS = 10000
+MAX_STREAMED_BYTES = 64 * 1024 * 1024
+COUNT_KEYS = ["nodes", "ways", "relations", "areas", "total"]
+
+
+def check_complete(data: dict):
+    """Raise the runtime error overpass reports in an answer's remark
+
+    Raises:
+        ValueError: if overpass gave up on the query (eg. a timeout)
+    """
+    if is_incomplete(data):
+        raise ValueError(f"Overpass gave up on the query: {data['remark']}")
+    return data
+
+
+def parse_counts(data: dict):
+    """Counts from the first count element of an answer, and its remark"""
+    counts = {key: 0 for key in COUNT_KEYS}
+    for element in data.get("elements", []):
+        if element.get("type") == "count":
+            for key in COUNT_KEYS:
+                counts[key] = int(element["tags"].get(key, 0))
+            break
+    if "remark" in data:
+        counts["remark"] = data["remark"]
+    return counts
+
+
+def count_results(query: str):
+    """Number of elements in the primary set of the query, by type.
+
+    Raises:
+        OQLSyntaxError: if the query can't be rewritten
+        ValueError: if overpass rejects or gives up on the count query
+    """
+    return parse_counts(check_complete(fetch_query(with_out_count(query))))
+
+
+def choose_mode(total: int, page_size: int = PAGE_SIZE):
+    if total <= page_size:
+        return "full"
+    if total <= PAGE_LIMIT:
+        return "page"
+    return "summary"
+
+
+def needs_preflight(options: dict, page_size: int = PAGE_SIZE):
+    """False for queries that only count or are already limited to a page"""
+    if ("word", "count") in options["other"]:
+        return False
+    limit = options["limit"]
+    return not (limit and float(limit[0][1]) <= page_size)
+
+
+def preflight(query: str, page_size: int = PAGE_SIZE):
+    """Returns (mode, counts, data).
+
+    data is the answer, or the first page of it, and None if the query
+    should simply be fetched as it is. counts is None if the query wasn't
+    counted, eg. because it has no out statement we recognise.
+
+    Raises:
+        ValueError: if overpass rejects or gives up on the query
+    """
+    try:
+        before, out, options, after = primary_out(query)
+    except OQLSyntaxError:
+        return "full", None, None
+    if not needs_preflight(split_out_options(options), page_size):
+        return "full", None, None
+
+    if after:
+        counts = count_results(query)
+        mode = choose_mode(counts["total"], page_size)
+        if mode == "full":
+            return mode, counts, None
+        return mode, counts, fetch_query(with_out_limit(query, page_size))
+
+    data = check_complete(fetch_query(with_count_and_limit(query, page_size)))
+    counts = parse_counts(data)
+    page = {k: v for k, v in data.items() if k != "elements"}
+    page["elements"] = [e for e in data["elements"] if e.get("type") != "count"]
+    return choose_mode(counts["total"], page_size), counts, page
+
+
+def page_token(element: dict):
+    """How the LLM asks for the page after an element, eg. "node/123" """
+    return f"{element['type']}/{element['id']}"
+
+
+def add_next_page(data: dict, page_size: int = PAGE_SIZE):
+    """Tell the LLM how to get the next page, if the page is full"""
+    if len(data["elements"]) < page_size:
+        return data
+    data["next_page_after"] = page_token(data["elements"][-1])
+    add_note(
+        data,
+        "For the next page, run the same query again with "
+        f'page_after="{data["next_page_after"]}".',
+    )
+    return data
+
+
+def fetch_page(query: str, after: str, page_size: int = PAGE_SIZE):
+    """The page of a query's answer after the element `after` (see
+    page_token)
+
+    Raises:
+        ValueError: if after isn't an element, or overpass rejects or gives
+        up on the query
+    """
+    data = dict(check_complete(fetch_query(with_page_after(query, page_size, after))))
+    add_note(
+        data,
+        f"{len(data['elements'])} results (ordered by id) after {after.strip()}.",
+    )
+    return add_next_page(data, page_size)
+
+
+def fetch_streamed(query: str):
+    """Download an answer element by element, stopping after
+    MAX_STREAMED_ELEMENTS or MAX_STREAMED_BYTES. Only complete answers are
+    cached, a cut one says so in its note."""
+    data = fetch_answer(
+        query, max_elements=MAX_STREAMED_ELEMENTS, max_bytes=MAX_STREAMED_BYTES
+    )
+    if data.get("truncated"):
+        add_note(
+            data,
+            f"The download stopped after {len(data['elements'])} elements, "
+            "the query has more results than that.",
+        )
+    else:
+        get_overpass_cache().put(query, data)
+    return data
+
+
+def fetch_budgeted(query: str, page_after: str = None, page_size: int = PAGE_SIZE):
+    """The answer of a cleaned query, from the cache when possible, never
+    downloading more than a page or MAX_STREAMED_ELEMENTS. With page_after,
+    the page after that element (see fetch_page).
+
+    Returns:
+        data (dict): the answer for the LLM, with a note if it was cut
+        map_data (dict): the elements to show on the map. The same as data,
+        except in "summary" mode where data only holds the counts.
+
+    Raises:
+        requests.RequestException: on network errors
+        ValueError: if overpass rejects or gives up on the query
+    """
+    if page_after is not None:
+        data = fetch_page(query, page_after, page_size)
+        return data, data
+    data = get_overpass_cache().get(query)
+    if data is not None:
+        return data, data
+    # The preflight answer is cached under the rewritten query by fetch_query
+    mode, counts, data = preflight(query, page_size)
+    if data is None:
+        data = overpass_flight.do(overpass_key(query), fetch_streamed, query)
+    elif mode == "page":
+        data = dict(data)
+        data["counts"] = counts
+        add_note(
+            data,
+            f"Only the first {len(data['elements'])} of "
+            f"{counts['total']} results (ordered by id) were downloaded.",
+        )
+        add_next_page(data, page_size)
+    elif mode == "summary":
+        # The page still goes on the map, the LLM only gets the counts
+        summary = {
+            "counts": counts,
+            "note": "The query matches too many elements to download. "
+            "Make it more specific.",
+        }
+        return summary, data
+    return data, data
@@ -0,0 +1,322 @@
+"""Local stand-in for the overpass api, replaying recorded HTTP exchanges.
+
+The fixtures are the exchanges the app actually had with overpass, one JSON
+object per line: {"query": ..., "status": ..., "body": ...}. They include
+the preflight counts, pages and bbox tiles, not only the queries the LLM
+wrote. Record them by running the server in record mode in front of the
+real api and pointing the app at it:
+
+    python -m src.overpass_replay --record
+    export OVERPASS_ENDPOINTS=http://127.0.0.1:8765/api/interpreter
+
+and replay them later without network, eg. for the benchmarks:
+
+    python -m src.overpass_replay --bench 5
+
+Queries are matched on their canonical text (see oql.py). It also serves
+/api/status, so the endpoint pool treats it like any other instance. An old
+overpass_query_log.json (see ChatBot.log_overpass_query) can be used as
+fixtures too, but it only holds the queries written by the LLM.
+
+- latency: seconds added to every answer, plus up to `jitter` seconds
+- error_rate: fraction of queries answered with a 429 or 504
+- record: forward unknown queries to `upstream` and append the exchanges to
+  the fixture file. Overload answers are passed on but not recorded.
+
+Unknown queries get a 404, which the client rejects like any other error
+answer, so it never ends up in the cache.
+"""
+import os
+import json
+import random
+import argparse
+import threading
+from time import sleep, perf_counter
+from datetime import datetime
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import requests
+
+from .overpass_cache import query_key, normalize_query
+from .http_client import OVERPASS_URL, HEADERS
+
+
+DEFAULT_PORT = 8765
+DEFAULT_FIXTURE_PATH = os.path.expanduser(
+    "~/naturalmaps_cache/overpass_exchanges.jsonl"
+)
+INJECTED_ERRORS = [429, 504]
+# Answers worth replaying: results and rejected queries, not overload
+RECORDED_STATUS = {200, 400}
+
+
+def load_log_fixtures(path: str):
+    """Map query_key -> (200, response text, query) from an overpass_query_log.json"""
+    fixtures = {}
+    with open(path, "r") as f:
+        runs = json.load(f)
+    for run in runs.values():
+        log = run.get("log", {})
+        query = log.get("cleaned_oQL_query")
+        response = log.get("overpass_response")
+        if not query or not isinstance(response, str):
+            continue
+        try:
+            json.loads(response)
+        except ValueError:
+            # eg. "something went wrong"
+            continue
+        fixtures[query_key(query)] = (200, response, query)
+    return fixtures
+
+
+def load_fixtures(path: str):
+    """Map query_key -> (status, body, query) from a file of recorded
+    exchanges, or from an overpass_query_log.json"""
+    if not os.path.isfile(path):
+        return {}
+    if path.endswith(".json"):
+        return load_log_fixtures(path)
+    fixtures = {}
+    with open(path, "r") as f:
+        for line in f:
+            if line.strip():
+                exchange = json.loads(line)
+                fixtures[query_key(exchange["query"])] = (
+                    exchange["status"],
+                    exchange["body"],
+                    exchange["query"],
+                )
+    return fixtures
+
+
+class ReplayServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self,
+        fixture_path: str,
+        host: str = "127.0.0.1",
+        port: int = DEFAULT_PORT,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        error_rate: float = 0.0,
+        record: bool = False,
+        upstream: str = OVERPASS_URL,
+        seed: int = None,
+    ):
+        super().__init__((host, port), ReplayHandler)
+        self.fixture_path = fixture_path
+        self.fixtures = load_fixtures(fixture_path)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.record = record
+        self.upstream = upstream
+        self.random = random.Random(seed)
+        self.hits = 0
+        self.misses = 0
+        self.errors_injected = 0
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/api/interpreter"
+
+    def start(self):
+        """Serve in a background thread and return the interpreter url"""
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self.url
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def answer(self, query: str):
+        """(status, body) for a query"""
+        with self._lock:
+            if self.error_rate and self.random.random() < self.error_rate:
+                self.errors_injected += 1
+                return self.random.choice(INJECTED_ERRORS), ""
+            delay = self.latency + self.jitter * self.random.random()
+        if delay:
+            sleep(delay)
+
+        key = query_key(query)
+        with self._lock:
+            exchange = self.fixtures.get(key)
+            if exchange is not None:
+                self.hits += 1
+                return exchange[:2]
+            self.misses += 1
+        if not self.record:
+            return 404, json.dumps(
+                {"remark": f"No recorded answer for: {normalize_query(query)}"}
+            )
+        return self.record_query(query)
+
+    def record_query(self, query: str):
+        upstream = requests.get(
+            self.upstream, params={"data": query}, headers=HEADERS, timeout=(5, 180)
+        )
+        if upstream.status_code not in RECORDED_STATUS:
+            # Don't record overload answers, only pass them on
+            return upstream.status_code, upstream.text
+        status, body = upstream.status_code, upstream.text
+        with self._lock:
+            self.fixtures[query_key(query)] = (status, body, normalize_query(query))
+            self.save_exchange(query, status, body)
+        return status, body
+
+    def save_exchange(self, query: str, status: int, body: str):
+        folder_path = os.path.dirname(self.fixture_path)
+        if folder_path and not os.path.exists(folder_path):
+            os.makedirs(folder_path)
+        exchange = {"query": normalize_query(query), "status": status, "body": body}
+        with open(self.fixture_path, "a") as f:
+            f.write(json.dumps(exchange) + "\n")
+
+    def status_text(self):
+        return (
+            "Connected as: 0\n"
+            f"Current time: {datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')}\n"
+            "Rate limit: 0\n"
+            "4 slots available now.\n"
+            "Currently running queries (pid, space limit, time limit, start time):\n"
+        )
+
+    def stats(self):
+        return {
+            "fixtures": len(self.fixtures),
+            "hits": self.hits,
+            "misses": self.misses,
+            "errors_injected": self.errors_injected,
+        }
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        parsed = urlparse(self.path)
+        if parsed.path.rstrip("/") == "/api/status":
+            self.send(200, self.server.status_text(), "text/plain")
+        elif parsed.path.rstrip("/") == "/api/interpreter":
+            self.interpret(parse_qs(parsed.query).get("data", [""])[0])
+        else:
+            self.send(404, "", "text/plain")
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length).decode()
+        if urlparse(self.path).path.rstrip("/") != "/api/interpreter":
+            self.send(404, "", "text/plain")
+            return
+        # Overpass accepts both a form field and the raw query as the body
+        data = parse_qs(body).get("data", [body])[0]
+        self.interpret(data)
+
+    def interpret(self, query: str):
+        status, body = self.server.answer(query)
+        self.send(status, body, "application/json")
+
+    def send(self, status: int, body: str, content_type: str):
+        payload = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        # Keep benchmark output clean
+        pass
+
+
+def benchmark(server, rounds: int = 1):
+    """Replay every recorded query through the streaming client, bypassing
+    the cache, and time it.
+
+    Returns:
+        stats (dict): number of queries, elements and errors, and the
+        total, median and slowest time per query in seconds
+    """
+    # imported here so the server itself doesn't need the client modules
+    from .overpass_stream import fetch_answer
+
+    with server._lock:
+        queries = [
+            query for status, body, query in server.fixtures.values() if status == 200
+        ]
+    timings = []
+    elements = errors = 0
+    for _ in range(rounds):
+        for query in queries:
+            start = perf_counter()
+            try:
+                elements += len(fetch_answer(query, url=server.url)["elements"])
+            except (ValueError, requests.RequestException):
+                errors += 1
+            timings.append(perf_counter() - start)
+    timings.sort()
+    return {
+        "queries": len(timings),
+        "elements": elements,
+        "errors": errors,
+        "total": sum(timings),
+        "median": timings[len(timings) // 2] if timings else 0.0,
+        "max": timings[-1] if timings else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("fixtures", nargs="?", default=DEFAULT_FIXTURE_PATH)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--record", action="store_true")
+    parser.add_argument("--upstream", default=OVERPASS_URL)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument(
+        "--bench",
+        type=int,
+        metavar="ROUNDS",
+        help="replay every recorded query ROUNDS times, print timings and exit",
+    )
+    args = parser.parse_args()
+
+    server = ReplayServer(
+        args.fixtures,
+        host=args.host,
+        port=args.port,
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        record=args.record,
+        upstream=args.upstream,
+        seed=args.seed,
+    )
+    if args.bench:
+        with server:
+            print(json.dumps(benchmark(server, args.bench), indent=4))
+        return
+    print(f"Replaying {len(server.fixtures)} answers at {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
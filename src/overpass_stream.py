@@ -0,0 +1,222 @@
+"""Incremental parsing of overpass json answers.
+
+OverpassStream decodes the elements of an answer one by one while the body
+downloads, and stops once an element or byte budget is used up.
+answer_to_text() serializes an answer up to a character budget.
+"""
+import codecs
+import json
+
+from . import http_client
+
+
+_decoder = json.JSONDecoder()
+WHITESPACE = " \t\n\r"
+
+
+class OverpassStream:
+    """Iterate over the elements of an overpass answer.
+
+    Args:
+        chunks (iterable of bytes): the raw body, eg. response.iter_content()
+        max_elements (int, optional): stop after this many elements
+        max_bytes (int, optional): stop after this many bytes of body were read
+
+    After iterating, `header` holds everything before the elements array,
+    `remark` any overpass runtime remark and `truncated` whether a budget
+    stopped the iteration before the end of the answer.
+    """
+
+    def __init__(self, chunks, max_elements=None, max_bytes=None, on_close=None):
+        self._chunks = iter(chunks)
+        self._text_decoder = codecs.getincrementaldecoder("utf-8")()
+        self._buffer = ""
+        self._pos = 0
+        self._exhausted = False
+        self._on_close = on_close
+        self.max_elements = max_elements
+        self.max_bytes = max_bytes
+        self.bytes_read = 0
+        self.num_elements = 0
+        self.header = {}
+        self.remark = None
+        self.truncated = False
+
+    def _read_more(self):
+        """Append the next chunk to the buffer. Returns False at end of body,
+        or when the byte budget is used up and the body goes on."""
+        if self._exhausted:
+            return False
+        try:
+            chunk = next(self._chunks)
+        except StopIteration:
+            self._exhausted = True
+            self._buffer += self._text_decoder.decode(b"", final=True)
+            return False
+        if self.max_bytes is not None and self.bytes_read >= self.max_bytes:
+            self.truncated = True
+            self._exhausted = True
+            return False
+        self.bytes_read += len(chunk)
+        # Drop what was already parsed so the buffer stays small
+        self._buffer = self._buffer[self._pos :] + self._text_decoder.decode(chunk)
+        self._pos = 0
+        return True
+
+    def _skip(self, chars):
+        while True:
+            while self._pos < len(self._buffer) and self._buffer[self._pos] in chars:
+                self._pos += 1
+            if self._pos < len(self._buffer) or not self._read_more():
+                return
+
+    def _read_header(self):
+        marker = '"elements"'
+        while marker not in self._buffer:
+            if not self._read_more():
+                # Not an element list (eg. an error page): parse it whole
+                self.header = json.loads(self._buffer) if self._buffer else {}
+                return False
+        start = self._buffer.index(marker)
+        self.header = json.loads(self._buffer[:start] + '"elements": []}')
+        del self.header["elements"]
+        self._pos = start + len(marker)
+        self._skip(WHITESPACE + ":")
+        if self._buffer[self._pos : self._pos + 1] != "[":
+            raise ValueError("Overpass answer has no elements array")
+        self._pos += 1
+        return True
+
+    def _read_trailer(self):
+        while self._read_more():
+            pass
+        rest = self._buffer[self._pos :].strip().lstrip(",").rstrip("}")
+        if rest.strip():
+            self.remark = json.loads("{" + rest + "}").get("remark")
+
+    def __iter__(self):
+        try:
+            if not self._read_header():
+                self.remark = self.header.get("remark")
+                return
+            while True:
+                if (
+                    self.max_elements is not None
+                    and self.num_elements >= self.max_elements
+                ):
+                    self.truncated = True
+                    return
+                self._skip(WHITESPACE + ",")
+                if self._pos >= len(self._buffer):
+                    if self.truncated:
+                        return
+                    raise ValueError("Overpass answer ended inside the elements array")
+                if self._buffer[self._pos] == "]":
+                    self._pos += 1
+                    self._read_trailer()
+                    return
+                try:
+                    element, end = _decoder.raw_decode(self._buffer, self._pos)
+                except json.JSONDecodeError:
+                    # The element is split over two chunks
+                    if not self._read_more():
+                        if self.truncated:
+                            return
+                        raise
+                    continue
+                self._pos = end
+                self.num_elements += 1
+                yield element
+        finally:
+            self.close()
+
+    def close(self):
+        if self._on_close is not None:
+            self._on_close()
+            self._on_close = None
+
+    def to_dict(self, elements):
+        """Rebuild an overpass-style answer from the header and some elements"""
+        data = dict(self.header)
+        data["elements"] = elements
+        if self.remark is not None:
+            data["remark"] = self.remark
+        return data
+
+
+def stream_overpass_query(
+    query, max_elements=None, max_bytes=None, chunk_size=65536, url=None
+):
+    """Send a query and return an OverpassStream over its elements.
+    The connection is released as soon as iteration stops. Without a url,
+    the query goes through the overpass endpoint pool.
+
+    Raises:
+        ValueError: if overpass rejects the query (eg. a syntax error)
+    """
+    response = http_client.overpass_get(query, url=url, stream=True)
+    if response.status_code != 200:
+        message = response.text[:500]
+        response.close()
+        raise ValueError(f"Overpass returned {response.status_code}: {message}")
+    return OverpassStream(
+        response.iter_content(chunk_size=chunk_size),
+        max_elements=max_elements,
+        max_bytes=max_bytes,
+        on_close=response.close,
+    )
+
+
+def fetch_answer(query, max_elements=None, max_bytes=None, url=None):
+    """Download an answer, stopping once a budget is used up.
+
+    Returns:
+        data (dict): the answer. If a budget stopped the download it has
+        "truncated": True, and only holds the elements read until then.
+
+    Raises:
+        ValueError: if overpass rejects the query (eg. a syntax error)
+    """
+    stream = stream_overpass_query(
+        query, max_elements=max_elements, max_bytes=max_bytes, url=url
+    )
+    data = stream.to_dict(list(stream))
+    if stream.truncated:
+        data["truncated"] = True
+    return data
+
+
+def add_note(data: dict, note: str):
+    """Append a note for the LLM to an answer's "note" """
+    data["note"] = f"{data['note']} {note}" if data.get("note") else note
+
+
+# Room kept free for the note added to a cut answer
+NOTE_CHARS = 200
+
+
+def answer_to_text(data: dict, max_chars: int = None):
+    """JSON text of an answer, listing only as many elements as fit in
+    max_chars. A cut answer says so with "truncated": True and a note."""
+    elements = data.get("elements")
+    if max_chars is None or not elements:
+        return json.dumps(data)
+    head = {k: v for k, v in data.items() if k != "elements"}
+    size = len(json.dumps(head)) + len(', "elements": []') + NOTE_CHARS
+    parts = []
+    for element in elements:
+        text = json.dumps(element)
+        size += len(text) + 2
+        if size > max_chars:
+            break
+        parts.append(text)
+    if len(parts) < len(elements):
+        head["truncated"] = True
+        add_note(
+            head,
+            f"Only {len(parts)} of the {len(elements)} elements are listed here, "
+            "all of them are shown on the map.",
+        )
+    # "elements" is the last key, so the text ends with []}
+    text = json.dumps({**head, "elements": []})
+    return text[:-3] + "[" + ", ".join(parts) + "]}"
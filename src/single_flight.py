@@ -0,0 +1,68 @@
+"""In-process request coalescing.
+
+Streamlit runs every session's script in its own thread. When several users
+look at the same district, identical Overpass and geocoding requests would
+otherwise go out in parallel. With single-flight, the first caller runs the
+request and everyone asking for the same key meanwhile waits for it and gets
+the same result (or the same exception). Results are shared, so callers
+should not mutate them in place; name_to_gdf hands out copies.
+"""
+import threading
+
+from .overpass_cache import normalize_query
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.coalesced = 0  # number of callers that piggybacked on another call
+
+    def do(self, key, fn, *args, **kwargs):
+        """Run fn(*args, **kwargs) unless a call with the same key is in flight,
+        in which case wait for that call and return its result."""
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                self.coalesced += 1
+                leader = False
+            else:
+                call = _Call()
+                self._calls[key] = call
+                leader = True
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args, **kwargs)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+
+overpass_flight = SingleFlight()
+geocode_flight = SingleFlight()
+
+
+def overpass_key(query: str):
+    return normalize_query(query)
+
+
+def geocode_key(place: str):
+    return " ".join(place.casefold().split())
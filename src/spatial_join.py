@@ -0,0 +1,151 @@
+"""Local spatial joins between two overpass results: the right-hand
+geometries go into a shapely STRtree, projected to metres around the
+results' mean latitude, and point to point distances are haversine.
+"""
+import numpy as np
+import shapely
+from shapely import STRtree
+
+from .geo_distance import haversine, EARTH_RADIUS
+from .oql import OQLSyntaxError, with_out_geometry
+
+
+PREDICATES = {"near": "dwithin", "intersects": "intersects"}
+
+
+def element_geometry(element: dict):
+    """Shapely geometry of an overpass element, in (lon, lat), or None"""
+    if "lat" in element and "lon" in element:
+        return shapely.Point(element["lon"], element["lat"])
+    points = [(p["lon"], p["lat"]) for p in element.get("geometry") or [] if p]
+    if len(points) >= 4 and points[0] == points[-1]:
+        return shapely.Polygon(points)
+    if len(points) >= 2:
+        return shapely.LineString(points)
+    if "center" in element:
+        return shapely.Point(element["center"]["lon"], element["center"]["lat"])
+    return None
+
+
+def with_positions(query: str):
+    """The query with "out geom" if it doesn't ask for a geometry or center,
+    so its ways and relations can be joined. Queries that can't be parsed
+    are returned as they are."""
+    try:
+        return with_out_geometry(query)
+    except OQLSyntaxError:
+        return query
+
+
+def located(data: dict):
+    """(elements, geometries) of the elements of an answer that have a position"""
+    elements, geometries = [], []
+    for element in data.get("elements", []):
+        geometry = element_geometry(element)
+        if geometry is not None:
+            elements.append(element)
+            geometries.append(geometry)
+    geometries = np.array(geometries, dtype=object)
+    invalid = ~shapely.is_valid(geometries)
+    if invalid.any():
+        geometries[invalid] = shapely.make_valid(geometries[invalid])
+    return elements, geometries
+
+
+def summary_element(element: dict):
+    """An element without its geometry, nodes or bounds: type, id, tags,
+    matches and its position (a node's coordinates, otherwise the centroid
+    of its geometry)"""
+    summary = {k: element[k] for k in ("type", "id", "tags", "matches") if k in element}
+    geometry = element_geometry(element)
+    if geometry is not None:
+        centroid = shapely.centroid(shapely.make_valid(geometry))
+        summary["lat"], summary["lon"] = round(centroid.y, 7), round(centroid.x, 7)
+    return summary
+
+
+def num_dropped(data: dict, elements: list):
+    """Number of elements of an answer left out of a join for lack of a
+    position"""
+    return len(data.get("elements", [])) - len(elements)
+
+
+def to_metres(geometries, lat0: float):
+    """Project (lon, lat) geometries to metres around latitude lat0"""
+    scale = np.radians(1) * EARTH_RADIUS
+    factors = np.array([scale * np.cos(np.radians(lat0)), scale])
+    return shapely.transform(geometries, lambda coords: coords * factors)
+
+
+def spatial_join(left: dict, right: dict, predicate: str = "near", distance=100):
+    """Pairs of elements of two overpass answers that are near each other
+    or intersect.
+
+    Args:
+        left (dict): overpass answer, eg. bike parkings
+        right (dict): overpass answer, eg. spätis
+        predicate (str): "near" (within `distance` metres) or "intersects"
+        distance (float): metres, only used by "near"
+
+    Returns:
+        left_elements, right_elements (list), pairs (list): (i, j, metres)
+        tuples of indices into left_elements and right_elements, sorted by
+        distance
+    """
+    if predicate not in PREDICATES:
+        raise ValueError(f"predicate must be one of {list(PREDICATES)}")
+    left_elements, left_geometries = located(left)
+    right_elements, right_geometries = located(right)
+    if not len(left_geometries) or not len(right_geometries):
+        return left_elements, right_elements, []
+
+    all_geometries = np.concatenate([left_geometries, right_geometries])
+    lat0 = float(np.mean(shapely.get_coordinates(all_geometries)[:, 1]))
+    left_metres = to_metres(left_geometries, lat0)
+    right_metres = to_metres(right_geometries, lat0)
+
+    tree = STRtree(right_metres)
+    if predicate == "near":
+        i, j = tree.query(left_metres, predicate="dwithin", distance=distance)
+    else:
+        i, j = tree.query(left_metres, predicate="intersects")
+
+    metres = shapely.distance(left_metres[i], right_metres[j])
+    # Exact distances between points, the projection is only used to search
+    both_points = (shapely.get_type_id(left_geometries[i]) == 0) & (
+        shapely.get_type_id(right_geometries[j]) == 0
+    )
+    if both_points.any():
+        a, b = left_geometries[i][both_points], right_geometries[j][both_points]
+        metres[both_points] = haversine(
+            shapely.get_y(a), shapely.get_x(a), shapely.get_y(b), shapely.get_x(b)
+        )
+    keep = metres <= distance if predicate == "near" else np.ones(len(i), bool)
+    pairs = sorted(
+        zip(i[keep].tolist(), j[keep].tolist(), metres[keep].tolist()),
+        key=lambda pair: pair[2],
+    )
+    return left_elements, right_elements, pairs
+
+
+def join_summary(left_elements, right_elements, pairs, max_matches: int = 3):
+    """The left elements that have a match, each with its closest matches.
+
+    Returns:
+        matched (list): left elements with a "matches" list of
+        {"type", "id", "name", "distance"} dicts, closest first
+    """
+    matched = {}
+    for i, j, metres in pairs:
+        element = matched.setdefault(i, {**left_elements[i], "matches": []})
+        if len(element["matches"]) < max_matches:
+            right = right_elements[j]
+            element["matches"].append(
+                {
+                    "type": right["type"],
+                    "id": right["id"],
+                    "name": right.get("tags", {}).get("name"),
+                    "distance": round(metres, 1),
+                }
+            )
+    return list(matched.values())
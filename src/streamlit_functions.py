@@ -1,22 +1,36 @@
-import requests
 import json
 import streamlit as st
 import folium
 from streamlit_folium import st_folium, folium_static
 import matplotlib.pyplot as plt
 from wordcloud import WordCloud, STOPWORDS, ImageColorGenerator
-import utm
-from pyproj import CRS, Transformer
 import pandas as pd
 import plotly.express as px
 import osmnx as ox
 import folium
 import contextily as cx
-from shapely.geometry import Polygon, Point, LineString, mapping, MultiPolygon
+from shapely.geometry import Polygon, LineString, mapping
 import pydeck as pdk
 from math import sqrt, log
-from geopandas import GeoDataFrame
 import hashlib
+from . import http_client
+from .geometry import gdf_data, longest_distance_to_vertex
+from .tag_index import TagStatistics
+from .tag_vocabulary import get_tag_vocabulary
+from .element_store import ElementStore, as_store
+from .bbox_tiles import (
+    fetch_query,
+    fetch_bbox_tiled,
+    fetch_tiles,
+    fetch_tile_answers,
+    is_covered,
+    tile_elements,
+    tiles_for_bbox,
+    viewport_zoom,
+)
+from .single_flight import geocode_flight, geocode_key
+
+http_client.configure_osmnx()
 
 
 def overpass_to_feature_group(data_str=""):
@@ -56,28 +70,21 @@ def overpass_to_circles(data_str=""):
 def create_circles_from_nodes(nodes):
     # Create a feature group
     feature_group = folium.FeatureGroup(name="circles")
-    for node in nodes:
-        # Loop over each node in the 'elements' key of the JSON object
-        if node["type"] == "node":
-            node_data = [(node["lat"], node["lon"], node["tags"])]
-            # the tags content needs to be reformatted
-            for lat, lon, tags in node_data:
-                tags_content = "<br>".join(
-                    [f"<b>{k}</b>: {v}" for k, v in tags.items()]
-                )
-                circle = folium.Circle(
-                    location=[lat, lon],
-                    radius=5,  # Set the radius as needed
-                    color="blue",  # Set a default color or use a function to determine color based on tags
-                    fill=True,
-                    fill_color="blue",  # Set a default color or use a function to determine color based on tags
-                    fill_opacity=0.4,
-                    tooltip=tags_content,
-                )
-                # Add the circle to the feature group
-                feature_group.add_child(circle)
-        elif node["type"] == "area":
-            pass
+    # nodes can be a list of elements or an ElementStore
+    for lat, lon, tags in as_store(nodes).of_type("node").iter_points():
+        # the tags content needs to be reformatted
+        tags_content = "<br>".join([f"<b>{k}</b>: {v}" for k, v in tags.items()])
+        circle = folium.Circle(
+            location=[lat, lon],
+            radius=5,  # Set the radius as needed
+            color="blue",  # Set a default color or use a function to determine color based on tags
+            fill=True,
+            fill_color="blue",  # Set a default color or use a function to determine color based on tags
+            fill_opacity=0.4,
+            tooltip=tags_content,
+        )
+        # Add the circle to the feature group
+        feature_group.add_child(circle)
     return feature_group
 
 
@@ -153,6 +160,8 @@ def calculate_parameters_for_map(overpass_answer=None, gdf=None):
     takes an overpass answer string or a geodataframe
     and returns:
     fg, center, zoom
+    For a geodataframe, fg is the cleaned geodataframe, which folium.GeoJson
+    accepts as it is.
     """
     default_bounds = [[52.5210821, 13.3942864], [52.525776, 13.4038867]]
     fg = None
@@ -165,26 +174,23 @@ def calculate_parameters_for_map(overpass_answer=None, gdf=None):
         if bounds == [[None, None], [None, None]]:
             bounds = default_bounds
     elif gdf is not None:
-        # Drop missing geometries
-        gdf = gdf[gdf["geometry"].notna()]
-
-        # Repair invalid geometries
-        gdf["geometry"] = gdf["geometry"].buffer(0)
-
-        # Convert to GeoJSON
-        geojson_data = json.loads(gdf.to_json())
-
-        # Calculate bounds from GeoJSON
-        if geojson_data["features"]:
-            all_coords = [
-                feat["geometry"]["coordinates"] for feat in geojson_data["features"]
-            ]
-            lats = [coord[1] for coords in all_coords for coord in coords]
-            lons = [coord[0] for coords in all_coords for coord in coords]
-            bounds = [[min(lats), min(lons)], [max(lats), max(lons)]]
+        # Drop missing and empty geometries
+        gdf = gdf[gdf["geometry"].notna() & ~gdf["geometry"].is_empty]
+
+        # Repair only the invalid geometries
+        invalid = ~gdf["geometry"].is_valid
+        if invalid.any():
+            gdf = gdf.copy()
+            gdf.loc[invalid, "geometry"] = gdf.loc[invalid, "geometry"].buffer(0)
+
+        # Bounds straight from the geometry array
+        if len(gdf):
+            minx, miny, maxx, maxy = map(float, gdf.total_bounds)
+            bounds = [[miny, minx], [maxy, maxx]]
         else:
             bounds = default_bounds
-        fg = geojson_data
+        # The map serializes it through __geo_interface__ when it is drawn
+        fg = gdf
 
     center = calculate_center(bounds)
     zoom = calculate_zoom_level(bounds)
@@ -233,8 +239,10 @@ def name_to_gdf(place_name):
         gdf: a geodataframe
     """
     # Use OSMnx to geocode the location (OSMnx uses some other libraries)
-    gdf = ox.geocode_to_gdf(place_name)
-    return gdf
+    # Sessions asking for the same place at the same time share one request,
+    # each gets its own copy of the answer
+    gdf = geocode_flight.do(geocode_key(place_name), ox.geocode_to_gdf, place_name)
+    return gdf.copy()
 
 
 def map_location(
@@ -277,10 +285,8 @@ def word_to_color(word):
 
 
 def overpass_query(query):
-    overpass_url = "http://overpass-api.de/api/interpreter"
-    response = requests.get(overpass_url, params={"data": query})
-    data = response.json()
-    return data
+    """Cached, coalesced overpass answer, parsed while it downloads"""
+    return fetch_query(query)
 
 
 def bbox_from_st_data(st_data):
@@ -298,162 +304,52 @@ def bbox_from_st_data(st_data):
     return bbox
 
 
-def gdf_data(row, original_crs):
-    """Get the area of a polygon
-    can take a row of a gdf"""
-    utm_zone = utm.latlon_to_zone_number(row["lat"], row["lon"])
-    south = row["lat"] < 0
-    utm_crs = CRS.from_dict({"proj": "utm", "zone": utm_zone, "south": south})
-    epsg_code = utm_crs.to_authority()[1]
-    unit = list({ai.unit_name for ai in utm_crs.axis_info})[0]
-    gdf_projected = GeoDataFrame([row], crs=original_crs).to_crs(epsg_code)
-    area = gdf_projected.area.values[0]
-    return pd.Series({"area": area, "unit": f"square {unit}"})
-
-
-def longest_distance_to_vertex(geometry):
-    """Calculate the radius between the polygon centroid and its furthest point.
-    Not callable by the LLM
-    Args:
-        polygon (shapely.geometry.Polygon): _description_
-    Returns:
-        max_distance (float): _description_
-    """
-    # Check if the geometry is a MultiPolygon
-    if isinstance(geometry, MultiPolygon):
-        # If it is, iterate over the individual polygons
-        polygons = list(geometry)
-    else:
-        # If it's not a MultiPolygon, assume it's a single Polygon and put it in a list
-        polygons = [geometry]
-
-    max_distance = 0
-    for polygon in polygons:
-        centroid = polygon.centroid
-        # Calculate the distance from the centroid to each vertex
-        distances = [
-            centroid.distance(Point(vertex)) for vertex in polygon.exterior.coords
-        ]
-        # Update max_distance if the maximum distance for this polygon is greater
-        max_distance = max(max_distance, max(distances))
-
-    # Return the maximum distance
-    return max_distance
-
-
-def add_value(tag_frequency, t, v):
-    if isinstance(v, str):
-        values = v.split(";")
-        for value in values:
-            if t in tag_frequency:
-                if (
-                    value not in tag_frequency[t]
-                ):  # Check if value is not already in the list
-                    tag_frequency[t].append(value)
-            else:
-                tag_frequency[t] = [value]
-    else:
-        if t in tag_frequency:
-            if (
-                str(v) not in tag_frequency[t]
-            ):  # Check if value is not already in the list
-                tag_frequency[t].append(str(v))
-        else:
-            tag_frequency[t] = [str(v)]
-    return tag_frequency
-
-
 def count_tag_frequency_in_nodes(nodes, tag=None):
-    tag_frequency = {}
-
-    for node in nodes:
-        if "tags" in node:
-            for t, v in node["tags"].items():
-                # Split the tag on the first separator
-                t = t.split(":")[0]
-
-                if tag is None:
-                    # Collecting unique values for each tag
-                    tag_frequency = add_value(tag_frequency, t, v)
-                else:
-                    # Collecting unique values for a specific tag
-                    if t == tag:
-                        tag_frequency = add_value(tag_frequency, t, v)
-
-    return tag_frequency
+    """Unique values of each tag key, eg. {"amenity": ["cafe", "bench"]}.
+    Keys are grouped on their first part and values split on ";" (see TagIndex)."""
+    return TagStatistics().add_elements(nodes).unique_values(tag)
 
 
 def count_tag_frequency_old(data, tag=None):
-    tag_frequency = {}
-
-    for element in data["elements"]:
-        if "tags" in element:
-            for t, v in element["tags"].items():
-                if tag is None:
-                    # Counting tag frequency
-                    if t in tag_frequency:
-                        tag_frequency[t] += 1
-                    else:
-                        tag_frequency[t] = 1
-                else:
-                    # Counting value frequency for a specific tag
-                    if t == tag:
-                        if v in tag_frequency:
-                            tag_frequency[v] += 1
-                        else:
-                            tag_frequency[v] = 1
-
-    return tag_frequency
+    """Number of elements with each tag key, or with each value of `tag`.
+    data is an overpass answer, an ElementStore or, to answer from memory,
+    the TagStatistics of the result."""
+    if isinstance(data, TagStatistics):
+        return data.tag_frequency(tag)
+    store = as_store(data)
+    if tag is None:
+        return store.key_counts()
+    return store.value_counts(tag)
 
 
 def count_tag_frequency(datasets, tag=None):
-    # Combine elements of all datasets into a single list
-    nodes = [element for data in datasets for element in data["elements"]]
-    return count_tag_frequency_in_nodes(nodes, tag)
+    return TagStatistics.from_datasets(datasets).unique_values(tag)
 
 
 def count_unique_values(datasets, tag=None):
-    unique_values = set()
+    return {tag: TagStatistics.from_datasets(datasets).unique_count(tag)}
 
-    # Combine elements of all datasets into a single list
-    elements = [element for data in datasets for element in data["elements"]]
 
-    for element in elements:
-        if "tags" in element:
-            for t, v in element["tags"].items():
-                # Split the tag on the first separator
-                t = t.split(":")[0]
-
-                if t == tag:
-                    unique_values.add(v)
+def count_value_frequency(datasets):
+    return TagStatistics.from_datasets(datasets).value_frequency()
 
-    return {tag: len(unique_values)}
 
+def tag_statistics_for_view(bbox: list):
+    """TagStatistics of the fetched nodes inside bbox.
 
-def count_value_frequency(datasets):
-    value_frequency = {}
-
-    # Combine elements of all datasets into a single list
-    elements = [element for data in datasets for element in data["elements"]]
-
-    for element in elements:
-        if "tags" in element:
-            for _, v in element["tags"].items():
-                # Counting value frequency
-                if v in value_frequency:
-                    value_frequency[v] += 1
-                else:
-                    value_frequency[v] = 1
-
-    # Sort the dictionary by its values in descending order
-    value_frequency = {
-        k: v
-        for k, v in sorted(
-            value_frequency.items(), key=lambda item: item[1], reverse=True
+    They are kept in st.session_state["tag_stats"] and only recomputed when
+    the view or the fetched nodes change, so eg. picking another key in the
+    word cloud doesn't count the tags again. The fetched nodes are told apart
+    by st.session_state["nodes_version"], see fetch_viewport_delta.
+    """
+    key = (tuple(bbox), st.session_state.get("nodes_version", 0))
+    if st.session_state.get("tag_stats_key") != key:
+        st.session_state["nodes_in_view"] = st.session_state.nodes_store.in_bbox(bbox)
+        st.session_state["tag_stats"] = TagStatistics.from_store(
+            st.session_state.nodes_in_view
         )
-    }
-
-    return value_frequency
+        st.session_state["tag_stats_key"] = key
+    return st.session_state.tag_stats
 
 
 def generate_wordcloud(frequency_dict):
@@ -473,39 +369,90 @@ def generate_wordcloud(frequency_dict):
     return wordcloud
 
 
-def get_nodes_with_tags_in_bbox(bbox: list, what_to_get="nodes"):
+def tagged_elements_query(what_to_get="nodes", verbosity="body"):
+    """make_query for bbox_tiles: all elements with at least one tag in a bbox"""
+    if what_to_get == "nodes":
+        element = "node"
+    elif "way" in what_to_get.lower():
+        element = "way"
+
+    def tile_query(tile):
+        return f"""
+        [out:json][timeout:60];
+        (
+        {element}({tile[0]}, {tile[1]}, {tile[2]}, {tile[3]})[~"."~"."];
+        );
+        out {verbosity};
+        """
+
+    return tile_query
+
+
+def get_nodes_with_tags_in_bbox(bbox: list, what_to_get="nodes", tags_only=False):
     """Get unique tag keys within a bounding box and plot the top 200 in a wordcloud
     In this case it is necessary to run a query in overpass because
     osmnx.geometries.geometries_from_bbox requires an input for "tags", but here
     we want to get all of them.
 
-    ToDo: Limit the query size
+    Large bboxes are split into quadtree tiles which are fetched in parallel and
+    cached one by one (see bbox_tiles), so overlapping places reuse tiles.
+    Tiles on the edge of the bbox are clipped to it.
+
+    With tags_only, overpass is asked for "out tags": elements come back with
+    only type, id and tags, which is all the tag statistics need and a
+    fraction of the payload. Don't use it if the nodes go on a map.
 
     returns:
         data: the query response in json format
     """
-    overpass_url = "http://overpass-api.de/api/interpreter"
-    if what_to_get == "nodes":
-        overpass_query = f"""
-        [out:json];
-        (
-        node({bbox[0]}, {bbox[1]}, {bbox[2]}, {bbox[3]})[~"."~"."];
-        );
-        out body;
-        """
-    elif "way" in what_to_get.lower():
-        overpass_query = f"""
-        [out:json];
-        (
-        way({bbox[0]}, {bbox[1]}, {bbox[2]}, {bbox[3]})[~"."~"."];
-        );
-        out body;
-        """
+    verbosity = "tags" if tags_only else "body"
+    return fetch_bbox_tiled(bbox, tagged_elements_query(what_to_get, verbosity))
 
-    response = requests.get(overpass_url, params={"data": overpass_query})
-    data = response.json()
 
-    return data
+def tag_census_in_bbox(bbox: list, what_to_get="nodes"):
+    """The tagged elements in a bbox with only their tags ("out tags"), for
+    tag statistics. They are yielded tile by tile as the tiles come in, so
+    they can go straight into a TagIndex without building the merged answer:
+
+        index.add_elements(tag_census_in_bbox(bbox))
+    """
+    return tile_elements(
+        fetch_tiles(bbox, tagged_elements_query(what_to_get, "tags")), bbox
+    )
+
+
+def fetch_viewport_delta(bbox: list):
+    """Fetch only the tiles of the viewport this session hasn't fetched yet.
+
+    The viewport is covered with whole tiles of the fixed quadtree grid, at
+    a zoom that depends on the size of the view (see bbox_tiles.viewport_zoom),
+    so every tile is cached on its own and shared with other sessions. The
+    tiles already fetched are kept in st.session_state["fetched_tiles"]:
+    panning only downloads the newly exposed tiles, and zooming in downloads
+    nothing because the coarser tiles already cover the view. The nodes of
+    the new tiles are appended to st.session_state["nodes_store"], no copy
+    of their dicts is kept.
+
+    returns:
+        tiles (list): the tiles that were fetched, empty if none
+    """
+    fetched = st.session_state.get("fetched_tiles", set())
+    tiles = [
+        t
+        for t in tiles_for_bbox(bbox, viewport_zoom(bbox))
+        if not is_covered(t, fetched)
+    ]
+    stores = [
+        ElementStore.from_data(data)
+        for data in fetch_tile_answers(tiles, tagged_elements_query())
+    ]
+    if "nodes_store" in st.session_state:
+        stores.insert(0, st.session_state["nodes_store"])
+    if tiles or "nodes_store" not in st.session_state:
+        st.session_state["nodes_store"] = ElementStore.concat(stores)
+        st.session_state["nodes_version"] = st.session_state.get("nodes_version", 0) + 1
+    st.session_state["fetched_tiles"] = fetched | set(tiles)
+    return tiles
 
 
 def save_nodes_to_json(self, file_path: str, this_run_name: str, log: dict):
@@ -546,9 +493,14 @@ def save_nodes_to_json(self, file_path: str, this_run_name: str, log: dict):
 
 
 def get_tag_keys():
+    """All tag keys with their usage count, from the offline vocabulary
+    snapshot if there is one (see tag_vocabulary), otherwise from taginfo"""
+    vocabulary = get_tag_vocabulary()
+    if vocabulary is not None:
+        return [{"key": key, "count_all": count} for key, count in vocabulary.keys()]
     # Seems excessive
-    url = "https://taginfo.openstreetmap.org/api/4/keys/all"
-    response = requests.get(url)
+    url = f"{http_client.TAGINFO_URL}/keys/all"
+    response = http_client.get(url)
     data = response.json()
     return data["data"]
 
@@ -573,17 +525,14 @@ def filter_nodes_with_tags(nodes: dict, tags: dict):
     """Get a subset of nodes from some geometry returned by overpass
 
     Args:
-        nodes (dict): Objects returned from Overpass
+        nodes (dict): Objects returned from Overpass, or their ElementStore
         tags (dict): Tags to search for
     """
+    store = as_store(nodes)
     selection = {}
 
     for key, values in tags.items():
         for value in values:
-            selection[value] = [
-                e
-                for e in nodes["elements"]
-                if (key in e["tags"].keys()) and (value in e["tags"].values())
-            ]
+            selection[value] = store.select(key, value).to_dicts()
 
     return selection
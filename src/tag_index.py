@@ -0,0 +1,204 @@
+"""Per-key counts of the tag values in a set of OSM elements.
+
+    index = TagIndex()
+    index.add_data(overpass_answer)
+    index.unique_values()        # {"amenity": ["cafe", "bench", ...], ...}
+    index.value_counts("amenity")  # {"cafe": 12, "bench": 40, ...}
+
+By default keys are grouped on their first part (addr:street -> addr) and
+values like "vegan;vegetarian" are split on ";".
+"""
+from sys import intern
+
+import pandas as pd
+
+
+class TagIndex:
+    def __init__(self, split_keys: bool = True, split_values: bool = True):
+        self.split_keys = split_keys
+        self.split_values = split_values
+        # key -> {value: count}, in the order they were first seen
+        self._values = {}
+        # key -> number of elements with the key
+        self._key_counts = {}
+        self.num_elements = 0
+
+    def _key(self, key):
+        if self.split_keys:
+            key = key.split(":")[0]
+        return intern(key)
+
+    def _split(self, value):
+        if not isinstance(value, str):
+            return [intern(str(value))]
+        if self.split_values:
+            return [intern(v) for v in value.split(";")]
+        return [intern(value)]
+
+    def add_tags(self, tags: dict):
+        """Add the tags of one element"""
+        seen_keys = set()
+        for key, value in tags.items():
+            key = self._key(key)
+            values = self._values.setdefault(key, {})
+            for v in self._split(value):
+                values[v] = values.get(v, 0) + 1
+            if key not in seen_keys:
+                seen_keys.add(key)
+                self._key_counts[key] = self._key_counts.get(key, 0) + 1
+        self.num_elements += 1
+
+    def add_elements(self, elements):
+        for element in elements:
+            if "tags" in element:
+                self.add_tags(element["tags"])
+        return self
+
+    def add_data(self, data: dict):
+        """Add the elements of an overpass answer"""
+        return self.add_elements(data.get("elements", []))
+
+    @classmethod
+    def from_datasets(cls, datasets, **kwargs):
+        index = cls(**kwargs)
+        for data in datasets:
+            index.add_data(data)
+        return index
+
+    @classmethod
+    def from_store(cls, store, **kwargs):
+        """Index of an ElementStore, counted on its tag columns. Keys are
+        grouped and values split once per distinct string, not per tag."""
+        index = cls(**kwargs)
+        tags = store.tags
+        keys = tags["key"].cat.categories
+        if index.split_keys:
+            keys = keys.str.split(":").str[0]
+        values = tags["value"].cat.categories
+        if index.split_values:
+            values = values.str.split(";")
+        frame = pd.DataFrame(
+            {
+                "element": tags["element"].to_numpy(),
+                "key": keys.to_numpy(dtype=object)[tags["key"].cat.codes.to_numpy()],
+                "value": values.to_numpy(dtype=object)[
+                    tags["value"].cat.codes.to_numpy()
+                ],
+            }
+        )
+        if index.split_values:
+            frame = frame.explode("value")
+        counts = frame.groupby(["key", "value"], sort=False).size()
+        for (key, value), n in counts.items():
+            index._values.setdefault(intern(key), {})[intern(value)] = int(n)
+        key_counts = frame.drop_duplicates(["element", "key"])["key"].value_counts(
+            sort=False
+        )
+        index._key_counts = {intern(key): int(n) for key, n in key_counts.items()}
+        index.num_elements = len(store)
+        return index
+
+    def __contains__(self, key):
+        return key in self._values
+
+    def __len__(self):
+        return len(self._values)
+
+    def keys(self):
+        return list(self._values)
+
+    def unique_values(self, key: str = None):
+        """{key: [unique values]} for every key, or only for `key`"""
+        if key is not None:
+            return {key: list(self._values[key])} if key in self._values else {}
+        return {k: list(values) for k, values in self._values.items()}
+
+    def value_counts(self, key: str):
+        """{value: number of occurrences} for one key"""
+        return dict(self._values.get(key, {}))
+
+    def key_counts(self):
+        """{key: number of elements with the key}"""
+        return dict(self._key_counts)
+
+    def num_unique_values(self):
+        """{key: number of unique values}, most diverse keys first"""
+        counts = {k: len(values) for k, values in self._values.items()}
+        return dict(sorted(counts.items(), key=lambda item: item[1], reverse=True))
+
+
+def by_frequency(counts: dict):
+    return dict(sorted(counts.items(), key=lambda item: item[1], reverse=True))
+
+
+class TagStatistics:
+    """All the tag statistics of one result, collected in a single pass:
+    tag_frequency(), unique_values(), unique_count(key), value_frequency()"""
+
+    def __init__(self):
+        # Full keys, whole values
+        self.frequencies = TagIndex(split_keys=False, split_values=False)
+        # Key groups (addr:street -> addr), values split on ";"
+        self.index = TagIndex()
+        # Key groups, whole values
+        self.grouped = TagIndex(split_values=False)
+        self._value_frequency = {}
+
+    def add_tags(self, tags: dict):
+        self.frequencies.add_tags(tags)
+        self.index.add_tags(tags)
+        self.grouped.add_tags(tags)
+        for value in tags.values():
+            self._value_frequency[value] = self._value_frequency.get(value, 0) + 1
+
+    def add_elements(self, elements):
+        for element in elements:
+            if "tags" in element:
+                self.add_tags(element["tags"])
+        return self
+
+    def add_data(self, data: dict):
+        return self.add_elements(data.get("elements", []))
+
+    @classmethod
+    def from_datasets(cls, datasets):
+        stats = cls()
+        for data in datasets:
+            stats.add_data(data)
+        return stats
+
+    @classmethod
+    def from_store(cls, store):
+        """Statistics of an ElementStore, from its tag columns"""
+        stats = cls()
+        stats.frequencies = TagIndex.from_store(
+            store, split_keys=False, split_values=False
+        )
+        stats.index = TagIndex.from_store(store)
+        stats.grouped = TagIndex.from_store(store, split_values=False)
+        counts = store.tags["value"].value_counts(sort=False)
+        stats._value_frequency = {value: int(n) for value, n in counts.items() if n}
+        return stats
+
+    @property
+    def num_elements(self):
+        return self.frequencies.num_elements
+
+    def tag_frequency(self, tag: str = None):
+        """{key: elements with the key}, or {value: elements with tag=value}"""
+        if tag is None:
+            return by_frequency(self.frequencies.key_counts())
+        return by_frequency(self.frequencies.value_counts(tag))
+
+    def unique_values(self, tag: str = None):
+        return self.index.unique_values(tag)
+
+    def unique_count(self, tag: str):
+        return len(self.grouped.value_counts(tag))
+
+    def num_unique_values(self):
+        return self.index.num_unique_values()
+
+    def value_frequency(self):
+        """{value: occurrences over all keys}, most frequent first"""
+        return by_frequency(self._value_frequency)
@@ -0,0 +1,139 @@
+"""Substring search over the tag keys and values of a tag census, through a
+trigram index. Strings are compared normalized (see normalize), and matches
+are ranked by how often they occur in the census.
+"""
+import re
+import unicodedata
+from functools import lru_cache
+
+
+NGRAM = 3
+NORMALIZE_CACHE_SIZE = 2**16
+SEPARATORS = re.compile(r"[_:\s]+")
+
+
+@lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
+def normalize(text: str):
+    """Form of a key, value or search word used for matching:
+    casefolded, without diacritics (ü -> u, é -> e, ß -> ss) and with
+    _ and : turned into spaces (addr:street -> addr street)."""
+    folded = unicodedata.normalize("NFKD", text.casefold())
+    folded = "".join(c for c in folded if not unicodedata.combining(c))
+    return SEPARATORS.sub(" ", folded).strip()
+
+
+def ngrams(text: str, n: int = NGRAM):
+    return {text[i : i + n] for i in range(len(text) - n + 1)}
+
+
+def split_search_words(substring: str):
+    words = [normalize(s) for s in substring.replace(",", " ").split()]
+    return [w for w in words if w]
+
+
+class TagSearchIndex:
+    def __init__(self, unique_values: dict = None, counts: dict = None):
+        """
+        Args:
+            unique_values (dict): {key: [unique values]}, eg. ChatBot.unique_tags_dict
+            counts (dict, optional): {key: {value: occurrences}} used for ranking
+        """
+        self.unique_values = {}
+        self.value_counts = {}
+        self.key_counts = {}
+        # Every distinct normalized string once, with the keys and the
+        # (key, value) pairs it stands for
+        self.strings = []
+        self.as_key = []  # string id -> keys
+        self.as_value = []  # string id -> (key, value) pairs
+        self.ids = {}
+        self.postings = {}
+        self.add(unique_values or {}, counts)
+
+    @classmethod
+    def from_tag_index(cls, index):
+        """Build the search index of a TagIndex, ranked by its value counts"""
+        return cls().add_tag_index(index)
+
+    def string_id(self, text: str):
+        """Id of the normalized text, indexed on first sight"""
+        text = normalize(text)
+        if text not in self.ids:
+            i = self.ids[text] = len(self.strings)
+            self.strings.append(text)
+            self.as_key.append([])
+            self.as_value.append([])
+            for gram in ngrams(text):
+                self.postings.setdefault(gram, set()).add(i)
+        return self.ids[text]
+
+    def add(self, unique_values: dict, counts: dict = None):
+        """Add keys and values, eg. the census of one more place. Only the
+        strings not seen before are indexed, the counts of the others are
+        added up."""
+        counts = counts or {}
+        for key, values in unique_values.items():
+            if key not in self.unique_values:
+                self.unique_values[key] = []
+                self.value_counts[key] = {}
+                self.key_counts[key] = 0
+                self.as_key[self.string_id(key)].append(key)
+            known = self.value_counts[key]
+            for value in values:
+                if value not in known:
+                    known[value] = 0
+                    self.unique_values[key].append(value)
+                    self.as_value[self.string_id(value)].append((key, value))
+                n = counts.get(key, {}).get(value, 1)
+                known[value] += n
+                self.key_counts[key] += n
+        return self
+
+    def add_tag_index(self, index):
+        """Add the keys and values of a TagIndex, ranked by its value counts"""
+        return self.add(
+            index.unique_values(),
+            {key: index.value_counts(key) for key in index.keys()},
+        )
+
+    def find(self, word: str):
+        """Ids of the strings containing word, which must be normalized"""
+        if len(word) < NGRAM:
+            return [i for i, text in enumerate(self.strings) if word in text]
+        candidates = None
+        for gram in sorted(ngrams(word), key=lambda g: len(self.postings.get(g, ()))):
+            posting = self.postings.get(gram)
+            if not posting:
+                return []
+            candidates = set(posting) if candidates is None else candidates & posting
+        return [i for i in candidates if word in self.strings[i]]
+
+    def search(self, substring: str):
+        """Keys and values containing any of the words in substring.
+
+        A key that matches returns all its values, otherwise only the matching
+        values are returned. Keys and values are ordered by frequency.
+
+        Returns:
+            matches (dict): {key: [values]}
+        """
+        whole_keys = set()
+        matched_values = {}
+        for word in split_search_words(substring):
+            for i in self.find(word):
+                whole_keys.update(self.as_key[i])
+                for key, value in self.as_value[i]:
+                    matched_values.setdefault(key, set()).add(value)
+
+        matches = {}
+        for key in whole_keys | set(matched_values):
+            values = (
+                self.unique_values[key] if key in whole_keys else matched_values[key]
+            )
+            counts = self.value_counts[key]
+            matches[key] = sorted(values, key=lambda v: counts.get(v, 0), reverse=True)
+        return dict(
+            sorted(
+                matches.items(), key=lambda item: self.key_counts[item[0]], reverse=True
+            )
+        )
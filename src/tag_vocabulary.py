@@ -0,0 +1,356 @@
+"""Offline snapshot of the OSM tag vocabulary, from taginfo.
+
+Downloading the full taginfo key list on every call is too slow to be
+useful. build_vocabulary() fetches the most used keys and their most common
+values once and writes them with their usage counts into one compact binary
+file. TagVocabulary memory-maps that file on first use, so loading it is
+free and only the pages that are read end up in memory. Searches use a
+trigram index stored in the same file.
+
+File layout (little endian):
+    header:   MAGIC, number of records, entries and trigrams, and the offsets
+              of the entries, trigrams, postings and strings (uint32 each)
+    records:  (key offset, key length, value offset, value length, count)
+              sorted by key, then by count descending. Key-only records
+              (the key's total count) have NO_VALUE as value offset.
+    entries:  (text offset, text length, postings start, postings count)
+              for every distinct normalized key or value (see
+              tag_search.normalize), with the records that use it
+    trigrams: (text offset, text length, postings start, postings count)
+              sorted by text, with the entries that contain the trigram
+    postings: uint32 record and entry numbers
+    strings:  the utf-8 keys, values, normalized texts and trigrams
+
+    python -m src.tag_vocabulary        # build ~/naturalmaps_cache/tag_vocabulary.bin
+"""
+import os
+import mmap
+import struct
+import argparse
+import threading
+
+from . import http_client
+from .tag_search import NGRAM, ngrams, normalize, split_search_words
+
+
+DEFAULT_VOCABULARY_PATH = os.path.expanduser("~/naturalmaps_cache/tag_vocabulary.bin")
+MAGIC = b"NMTAGV2\0"
+HEADER = struct.Struct("<8sIIIIIII")
+RECORD = struct.Struct("<IHIHQ")
+# Normalized texts and trigrams
+ENTRY = struct.Struct("<IHII")
+POSTING = struct.Struct("<I")
+NO_VALUE = 0xFFFFFFFF
+# taginfo returns at most this many rows per page
+TAGINFO_PAGE_SIZE = 999
+
+
+def taginfo_rows(path: str, params: dict, max_rows: int):
+    """Rows of a paged taginfo api call, sorted as requested in params"""
+    rows = []
+    page = 1
+    while len(rows) < max_rows:
+        rp = min(TAGINFO_PAGE_SIZE, max_rows - len(rows))
+        response = http_client.get(
+            f"{http_client.TAGINFO_URL}{path}",
+            params={**params, "page": page, "rp": rp},
+        )
+        response.raise_for_status()
+        data = response.json()["data"]
+        rows += data
+        if len(data) < rp:
+            break
+        page += 1
+    return rows
+
+
+def download_vocabulary(
+    max_keys: int = 5000, keys_with_values: int = 300, values_per_key: int = 50
+):
+    """{key: (count, {value: count})} for the most used keys in taginfo.
+    Only the first `keys_with_values` keys get their common values, keys like
+    name or addr:street have too many values to be a vocabulary."""
+    keys = taginfo_rows(
+        "/keys/all", {"sortname": "count_all", "sortorder": "desc"}, max_keys
+    )
+    vocabulary = {}
+    for n, row in enumerate(keys):
+        values = {}
+        if n < keys_with_values and row.get("values_all", 0) < 100000:
+            for value_row in taginfo_rows(
+                "/key/values",
+                {"key": row["key"], "sortname": "count_all", "sortorder": "desc"},
+                values_per_key,
+            ):
+                values[value_row["value"]] = value_row["count"]
+        vocabulary[row["key"]] = (row["count_all"], values)
+    return vocabulary
+
+
+def write_vocabulary(vocabulary: dict, path: str = DEFAULT_VOCABULARY_PATH):
+    """Write {key: (count, {value: count})} in the memory-mappable format"""
+    strings = bytearray()
+    offsets = {}
+
+    def add_string(text):
+        if text not in offsets:
+            encoded = text.encode()
+            offsets[text] = (len(strings), len(encoded))
+            strings.extend(encoded)
+        return offsets[text]
+
+    records = []
+    # normalized text -> numbers of the records using it
+    texts = {}
+    for key in sorted(vocabulary):
+        count, values = vocabulary[key]
+        key_offset, key_length = add_string(key)
+        texts.setdefault(normalize(key), []).append(len(records))
+        records.append((key_offset, key_length, NO_VALUE, 0, count))
+        for value, value_count in sorted(values.items(), key=lambda v: -v[1]):
+            value_offset, value_length = add_string(value)
+            texts.setdefault(normalize(value), []).append(len(records))
+            records.append(
+                (key_offset, key_length, value_offset, value_length, value_count)
+            )
+
+    postings = []
+    entries = []
+    grams = {}
+    for i, (text, record_numbers) in enumerate(texts.items()):
+        entries.append((*add_string(text), len(postings), len(record_numbers)))
+        postings += record_numbers
+        for gram in ngrams(text):
+            grams.setdefault(gram, []).append(i)
+    trigrams = []
+    for gram in sorted(grams):
+        trigrams.append((*add_string(gram), len(postings), len(grams[gram])))
+        postings += grams[gram]
+
+    folder_path = os.path.dirname(path)
+    if folder_path and not os.path.exists(folder_path):
+        os.makedirs(folder_path)
+    entries_offset = HEADER.size + RECORD.size * len(records)
+    trigrams_offset = entries_offset + ENTRY.size * len(entries)
+    postings_offset = trigrams_offset + ENTRY.size * len(trigrams)
+    strings_offset = postings_offset + POSTING.size * len(postings)
+    with open(path, "wb") as f:
+        f.write(
+            HEADER.pack(
+                MAGIC,
+                len(records),
+                len(entries),
+                len(trigrams),
+                entries_offset,
+                trigrams_offset,
+                postings_offset,
+                strings_offset,
+            )
+        )
+        for record in records:
+            f.write(RECORD.pack(*record))
+        for entry in entries + trigrams:
+            f.write(ENTRY.pack(*entry))
+        f.write(struct.pack(f"<{len(postings)}I", *postings))
+        f.write(strings)
+
+
+def build_vocabulary(path: str = DEFAULT_VOCABULARY_PATH, **kwargs):
+    write_vocabulary(download_vocabulary(**kwargs), path)
+
+
+class TagVocabulary:
+    def __init__(self, path: str = DEFAULT_VOCABULARY_PATH):
+        self.path = path
+        self._mm = None
+        self._lock = threading.Lock()
+
+    def _open(self):
+        with self._lock:
+            if self._mm is None:
+                with open(self.path, "rb") as f:
+                    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                (
+                    magic,
+                    self._size,
+                    self._num_entries,
+                    self._num_trigrams,
+                    self._entries,
+                    self._trigrams,
+                    self._postings,
+                    self._strings,
+                ) = HEADER.unpack_from(mm, 0)
+                if magic != MAGIC:
+                    mm.close()
+                    raise ValueError(
+                        f"{self.path} is not a tag vocabulary of this version, "
+                        "rebuild it with python -m src.tag_vocabulary"
+                    )
+                self._mm = mm
+        return self._mm
+
+    def __len__(self):
+        self._open()
+        return self._size
+
+    def _string(self, offset, length):
+        start = self._strings + offset
+        return self._mm[start : start + length].decode()
+
+    def _record(self, i):
+        key_offset, key_length, value_offset, value_length, count = RECORD.unpack_from(
+            self._open(), HEADER.size + i * RECORD.size
+        )
+        key = self._string(key_offset, key_length)
+        value = (
+            None
+            if value_offset == NO_VALUE
+            else self._string(value_offset, value_length)
+        )
+        return key, value, count
+
+    def records(self):
+        """(key, value, count) for every record, value is None for key totals"""
+        for i in range(len(self)):
+            yield self._record(i)
+
+    def keys(self):
+        """(key, count) of every key, most used first"""
+        keys = [(key, count) for key, value, count in self.records() if value is None]
+        return sorted(keys, key=lambda item: item[1], reverse=True)
+
+    def _key_record(self, key: str):
+        """Number of the first record of a key, by binary search"""
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if self._record(middle)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def values(self, key: str):
+        """{value: count} of the common values of a key, by binary search"""
+        i = self._key_record(key)
+        values = {}
+        while i < len(self):
+            record_key, value, count = self._record(i)
+            if record_key != key:
+                break
+            if value is not None:
+                values[value] = count
+            i += 1
+        return values
+
+    def _posting_list(self, start, count):
+        offset = self._postings + start * POSTING.size
+        return struct.unpack_from(f"<{count}I", self._mm, offset)
+
+    def _entry(self, table, i):
+        """(text, postings start, postings count) of an entry or trigram"""
+        text_offset, text_length, start, count = ENTRY.unpack_from(
+            self._mm, table + i * ENTRY.size
+        )
+        return self._string(text_offset, text_length), start, count
+
+    def _trigram_entries(self, gram: str):
+        """Numbers of the entries containing a trigram, by binary search"""
+        low, high = 0, self._num_trigrams
+        while low < high:
+            middle = (low + high) // 2
+            text, start, count = self._entry(self._trigrams, middle)
+            if text == gram:
+                return self._posting_list(start, count)
+            if text < gram:
+                low = middle + 1
+            else:
+                high = middle
+        return ()
+
+    def find(self, word: str):
+        """Numbers of the records whose key or value contains word, which
+        must be normalized. Words shorter than a trigram scan the entries."""
+        self._open()
+        if len(word) < NGRAM:
+            candidates = range(self._num_entries)
+        else:
+            candidates = None
+            for gram in ngrams(word):
+                entries = self._trigram_entries(gram)
+                if not entries:
+                    return []
+                candidates = (
+                    set(entries) if candidates is None else candidates & set(entries)
+                )
+        records = []
+        for i in candidates:
+            text, start, count = self._entry(self._entries, i)
+            if word in text:
+                records += self._posting_list(start, count)
+        return records
+
+    def search(self, substring: str, max_keys: int = 20, max_values: int = 10):
+        """Valid key:value pairs matching the search words, most used first.
+
+        A key that matches returns its most used values, otherwise only the
+        matching values are returned. Only the max_keys most used keys are
+        kept.
+
+        Returns:
+            matches (dict): {key: [values]}
+        """
+        whole_keys = {}
+        matched_values = {}
+        for word in split_search_words(substring):
+            for i in self.find(word):
+                key, value, count = self._record(i)
+                if value is None:
+                    whole_keys[key] = count
+                else:
+                    matched_values.setdefault(key, {})[value] = count
+
+        key_counts = dict(whole_keys)
+        for key in matched_values.keys() - key_counts.keys():
+            key_counts[key] = self._record(self._key_record(key))[2]
+        keys = sorted(key_counts, key=key_counts.get, reverse=True)[:max_keys]
+        matches = {}
+        for key in keys:
+            values = self.values(key) if key in whole_keys else matched_values[key]
+            matches[key] = sorted(values, key=values.get, reverse=True)[:max_values]
+        return matches
+
+
+_vocabulary = None
+_vocabulary_lock = threading.Lock()
+
+
+def get_tag_vocabulary(path: str = DEFAULT_VOCABULARY_PATH):
+    """The shared vocabulary, or None if no snapshot has been built"""
+    global _vocabulary
+    if not os.path.isfile(path):
+        return None
+    with _vocabulary_lock:
+        if _vocabulary is None or _vocabulary.path != path:
+            _vocabulary = TagVocabulary(path)
+    return _vocabulary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the offline tag vocabulary")
+    parser.add_argument("path", nargs="?", default=DEFAULT_VOCABULARY_PATH)
+    parser.add_argument("--max-keys", type=int, default=5000)
+    parser.add_argument("--keys-with-values", type=int, default=300)
+    parser.add_argument("--values-per-key", type=int, default=50)
+    args = parser.parse_args()
+    build_vocabulary(
+        args.path,
+        max_keys=args.max_keys,
+        keys_with_values=args.keys_with_values,
+        values_per_key=args.values_per_key,
+    )
+    print(f"Wrote {len(TagVocabulary(args.path))} records to {args.path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+import asyncio
+import json
+
+import pytest
+
+from src import async_client, overpass_cache, overpass_pool
+from src.async_client import ResponseError
+from src.overpass_replay import ReplayServer
+
+QUERY = '[out:json];node["amenity"="bench"](52.5,13.3,52.6,13.4);out;'
+ANSWER = {"elements": [{"type": "node", "id": 1, "lat": 52.51, "lon": 13.31}]}
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    """A replay server behind the endpoint pool, with an empty cache"""
+    path = tmp_path / "exchanges.jsonl"
+    exchange = {"query": QUERY, "status": 200, "body": json.dumps(ANSWER)}
+    path.write_text(json.dumps(exchange) + "\n")
+    cache = overpass_cache.OverpassCache(str(tmp_path / "cache.sqlite"))
+    monkeypatch.setattr(overpass_cache, "_default_cache", cache)
+    with ReplayServer(str(path), port=0) as server:
+        monkeypatch.setattr(
+            overpass_pool, "_pool", overpass_pool.EndpointPool([server.url])
+        )
+        server.cache = cache
+        yield server
+
+
+def test_answer_is_fetched_and_cached(server):
+    assert asyncio.run(async_client.overpass_query(QUERY)) == ANSWER
+    assert server.cache.stats()["entries"] == 1
+
+
+def test_error_status_raises_and_is_not_cached(server):
+    with pytest.raises(ResponseError) as error:
+        asyncio.run(async_client.overpass_query('[out:json];node["shop"];out;'))
+    assert error.value.status == 404
+    assert server.cache.stats()["entries"] == 0
+
+
+def test_client_is_closed_when_its_loop_shuts_down(server):
+    async def use_client():
+        client = await async_client.get_async_client()
+        await client.overpass_query(QUERY)
+        return client
+
+    client = asyncio.run(use_client())
+    assert client._session.closed
+    assert not async_client._clients
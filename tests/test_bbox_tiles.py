@@ -0,0 +1,96 @@
+import pytest
+
+from src import bbox_tiles
+from src.bbox_tiles import (
+    MAX_ELEMENTS_PER_TILE,
+    MAX_VIEWPORT_TILES,
+    bbox_area_km2,
+    choose_zoom,
+    contains,
+    children,
+    fetch_bbox_tiled,
+    is_covered,
+    tile_bbox,
+    tiles_for_bbox,
+    viewport_zoom,
+)
+
+MITTE = [52.50, 13.36, 52.54, 13.42]
+
+
+def make_query(bbox):
+    return '[out:json];node({},{},{},{})[~"."~"."];out;'.format(*bbox)
+
+
+@pytest.fixture
+def fake_overpass(monkeypatch):
+    """Answers tile queries with one node in the middle of the tile, and a
+    runtime error for the tiles listed in `too_big`"""
+    queries, too_big = [], set()
+
+    def fetch_query(query):
+        queries.append(query)
+        bbox = [float(v) for v in query.split("node(")[1].split(")")[0].split(",")]
+        if tuple(bbox) in too_big:
+            return {"elements": [], "remark": "runtime error: Query timed out"}
+        lat, lon = (bbox[0] + bbox[2]) / 2, (bbox[1] + bbox[3]) / 2
+        node = {"type": "node", "id": hash((lat, lon)), "lat": lat, "lon": lon}
+        return {"elements": [node]}
+
+    monkeypatch.setattr(bbox_tiles, "fetch_query", fetch_query)
+    return queries, too_big
+
+
+def test_tiles_cover_the_bbox():
+    tiles = tiles_for_bbox(MITTE, 14)
+    south = min(tile_bbox(t)[0] for t in tiles)
+    west = min(tile_bbox(t)[1] for t in tiles)
+    north = max(tile_bbox(t)[2] for t in tiles)
+    east = max(tile_bbox(t)[3] for t in tiles)
+    assert contains([south, west, north, east], MITTE)
+
+
+def test_zoom_keeps_tiles_under_the_element_limit():
+    density = 5000
+    zoom = choose_zoom(MITTE, density)
+    tile = tiles_for_bbox(MITTE, zoom)[0]
+    assert bbox_area_km2(tile_bbox(tile)) * density <= MAX_ELEMENTS_PER_TILE
+    assert choose_zoom(MITTE, density * 100) > zoom
+
+
+def test_edge_tiles_are_clipped_and_elements_stay_inside(fake_overpass):
+    queries, _ = fake_overpass
+    data = fetch_bbox_tiled(MITTE, make_query, density=1000)
+    assert data["elements"]
+    for query in queries:
+        bbox = [float(v) for v in query.split("node(")[1].split(")")[0].split(",")]
+        assert contains(MITTE, bbox)
+    for element in data["elements"]:
+        assert bbox_tiles.in_bbox(element, MITTE)
+
+
+def test_tile_overpass_gives_up_on_is_split_in_four(fake_overpass):
+    queries, too_big = fake_overpass
+    tile = tiles_for_bbox(MITTE, 12)[0]
+    too_big.add(tuple(tile_bbox(tile)))
+    answers = bbox_tiles.fetch_tile(tile, make_query)
+    assert len(queries) == 5
+    assert len(answers) == 4
+    assert not any(bbox_tiles.is_incomplete(data) for data in answers)
+
+
+def test_viewport_zoom_gets_coarser_for_bigger_views():
+    # About 600 x 600 pixels at map zoom 13 and 16
+    wide = [52.4686, 13.3483, 52.5314, 13.4517]
+    narrow = [52.4961, 13.3935, 52.5039, 13.4065]
+    assert len(tiles_for_bbox(wide, viewport_zoom(wide))) <= MAX_VIEWPORT_TILES
+    assert viewport_zoom(wide) < viewport_zoom(narrow)
+
+
+def test_tiles_are_covered_by_parents_or_all_children():
+    tile = tiles_for_bbox(MITTE, 13)[0]
+    assert all(is_covered(child, {tile}) for child in children(tile))
+    quarter = children(tile)
+    assert is_covered(tile, set(quarter))
+    assert not is_covered(tile, set(quarter[:3]))
+    assert not is_covered(tile, set())
@@ -0,0 +1,37 @@
+from src.element_store import ElementStore
+
+
+def node(id, lat, lon, **tags):
+    return {"type": "node", "id": id, "lat": lat, "lon": lon, "tags": tags}
+
+
+def test_concat_keeps_shared_elements_once():
+    first = ElementStore.from_elements(
+        [node(1, 52.5, 13.4, amenity="bench"), node(2, 52.5, 13.5, shop="bakery")]
+    )
+    second = ElementStore.from_elements(
+        [node(2, 52.5, 13.5, shop="bakery"), node(3, 52.6, 13.5, amenity="cafe")]
+    )
+    store = ElementStore.concat([first, second])
+    assert sorted(store.elements["id"]) == [1, 2, 3]
+    assert store.key_counts() == {"amenity": 2, "shop": 1}
+    assert [e["tags"] for e in store.to_dicts()] == [
+        {"amenity": "bench"},
+        {"shop": "bakery"},
+        {"amenity": "cafe"},
+    ]
+
+
+def test_concat_relabels_subsets_and_keeps_categoricals():
+    first = ElementStore.from_elements(
+        [node(1, 52.5, 13.4, amenity="bench"), node(2, 60.0, 13.4, amenity="cafe")]
+    ).in_bbox([52, 13, 53, 14])
+    second = ElementStore.from_elements([node(3, 52.6, 13.5, name="Späti")])
+    store = ElementStore.concat([first, second])
+    assert store.value_counts("amenity") == {"bench": 1}
+    assert store.select("name").to_dicts()[0]["id"] == 3
+    assert store.tags["key"].dtype == "category"
+
+
+def test_concat_of_nothing_is_empty():
+    assert len(ElementStore.concat([])) == 0
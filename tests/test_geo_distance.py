@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+from src.geo_distance import EARTH_RADIUS, PointIndex, haversine
+
+ANSWER = {
+    "elements": [
+        {"type": "node", "id": 1, "lat": 52.5200, "lon": 13.4050, "tags": {}},
+        {"type": "node", "id": 2, "lat": 52.5210, "lon": 13.4050, "tags": {}},
+        {"type": "node", "id": 3, "lat": 52.5300, "lon": 13.4050, "tags": {}},
+        {"type": "way", "id": 4, "center": {"lat": 52.5205, "lon": 13.4050}},
+        # A way from "out body" has no position and is left out
+        {"type": "way", "id": 5, "tags": {"highway": "path"}},
+    ]
+}
+
+
+def test_haversine_of_scalars_and_arrays():
+    # One degree of latitude is a 360th of the meridian
+    assert haversine(0, 0, 1, 0) == pytest.approx(2 * np.pi * EARTH_RADIUS / 360)
+    assert haversine(52.5, 13.4, 52.5, 13.4) == 0
+    distances = haversine(52.52, 13.405, np.array([52.521, 52.53]), 13.405)
+    assert distances.shape == (2,)
+    assert distances == pytest.approx([111.2, 1112.0], rel=1e-3)
+
+
+def test_nearest_and_within():
+    index = PointIndex(ANSWER)
+    assert len(index) == 4
+    nearest = index.nearest(52.5200, 13.4050, k=2)
+    assert [e["id"] for e in nearest] == [1, 4]
+    assert nearest[1]["distance"] == pytest.approx(55.6, abs=0.1)
+    assert [e["id"] for e in index.within(52.5200, 13.4050, radius=200)] == [1, 4, 2]
+    assert len(index.nearest(52.52, 13.405, k=10)) == 4
+
+
+def test_empty_answers():
+    index = PointIndex({"elements": []})
+    assert index.nearest(52.52, 13.405) == []
+    assert index.within(52.52, 13.405, radius=1000) == []
@@ -0,0 +1,46 @@
+import numpy as np
+from geopandas import GeoDataFrame
+from shapely.geometry import MultiPolygon, Point, Polygon
+
+from src.geometry import longest_distances_to_vertex, projected_areas
+
+SQUARE = Polygon([(0, 0), (2, 0), (2, 2), (0, 2)])
+
+
+def test_distance_from_centroid_to_farthest_vertex():
+    distances = longest_distances_to_vertex([SQUARE, Point(1, 1)])
+    assert np.allclose(distances, [np.sqrt(2), 0])
+
+
+def test_empty_geometries_and_parts_measure_zero():
+    far_square = Polygon([(10, 10), (14, 10), (14, 14), (10, 14)])
+    geometries = [
+        Polygon(),
+        SQUARE,
+        MultiPolygon([far_square, Polygon()]),
+        None,
+        MultiPolygon([]),
+    ]
+    distances = longest_distances_to_vertex(geometries)
+    assert np.allclose(distances, [0, np.sqrt(2), np.sqrt(8), 0, 0])
+
+
+def test_areas_are_measured_in_metres_of_the_local_utm_zone():
+    # About 1 x 1 km in Berlin and in Sydney
+    gdf = GeoDataFrame(
+        geometry=[
+            Polygon([(13.4, 52.5), (13.4147, 52.5), (13.4147, 52.509), (13.4, 52.509)]),
+            Polygon(
+                [
+                    (151.2, -33.9),
+                    (151.2108, -33.9),
+                    (151.2108, -33.891),
+                    (151.2, -33.891),
+                ]
+            ),
+        ],
+        crs="EPSG:4326",
+    )
+    areas = projected_areas(gdf)
+    assert np.allclose(areas["area"], 1e6, rtol=0.02)
+    assert list(areas["unit"]) == ["square metre", "square metre"]
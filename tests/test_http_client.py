@@ -0,0 +1,59 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from src import http_client
+
+
+class FlakyHandler(BaseHTTPRequestHandler):
+    """Answers 429 until `failures` requests were rejected, then 200"""
+
+    def do_GET(self):
+        server = self.server
+        server.requests += 1
+        if server.requests <= server.failures:
+            self.send_response(429)
+            self.send_header("Retry-After", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(b'{"elements": []}')
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def flaky_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FlakyHandler)
+    server.requests, server.failures = 0, 2
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def url(server):
+    return f"http://127.0.0.1:{server.server_address[1]}/api/interpreter"
+
+
+def test_rate_limited_requests_are_retried(flaky_server):
+    response = http_client.get(url(flaky_server))
+    assert response.status_code == 200
+    assert flaky_server.requests == 3
+
+
+def test_last_response_is_returned_when_retries_run_out(flaky_server):
+    response = http_client.get(url(flaky_server), max_retries=1)
+    assert response.status_code == 429
+    assert flaky_server.requests == 2
+
+
+def test_backoff_uses_retry_after_and_is_capped():
+    assert http_client.backoff_delay(0, "2") == 2
+    assert http_client.backoff_delay(0, "3600") == http_client.BACKOFF_MAX
+    assert 0 <= http_client.backoff_delay(10) <= http_client.BACKOFF_MAX
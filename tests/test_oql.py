@@ -0,0 +1,86 @@
+import pytest
+
+from src.oql import (
+    OQLSyntaxError,
+    canonicalize_query,
+    with_out_count,
+    with_out_limit,
+    with_page_after,
+)
+
+
+def test_union_reading_default_set_keeps_its_order():
+    query = (
+        '(area["name"="Mitte"];node(area)["shop"];'
+        'area["name"="Pankow"];node(area)["shop"];);out;'
+    )
+    assert canonicalize_query(query) == query
+
+
+def test_union_reading_default_set_is_not_deduplicated():
+    query = '(area["name"="Mitte"];node(area);area["name"="Mitte"];node(area););out;'
+    assert canonicalize_query(query) == query
+
+
+def test_input_free_union_is_sorted_and_deduplicated():
+    query = "(node[b](area.a);node[a](area:3600062422);node[b](area.a););out;"
+    assert canonicalize_query(query) == (
+        '(node["a"](area:3600062422);node["b"](area.a););out;'
+    )
+
+
+def test_bare_around_is_not_reordered():
+    query = '(node["b"](around:100);node["a"](around:100););out;'
+    assert canonicalize_query(query) == query
+
+
+def test_non_ascii_bare_value_is_quoted_whole():
+    assert canonicalize_query("node[name=Neukölln];out;") == (
+        'node["name"="Neukölln"];out;'
+    )
+
+
+def test_non_ascii_quoted_value_is_unchanged():
+    query = "area[name='Schöneberg']->.a;node(area.a)[shop];out;"
+    assert canonicalize_query(query) == (
+        'area["name"="Schöneberg"]->.a;node(area.a)["shop"];out;'
+    )
+
+
+def test_settings_are_sorted_and_default_timeout_dropped():
+    assert canonicalize_query("[timeout:180][out:json];node[a];out;") == (
+        '[out:json];node["a"];out;'
+    )
+
+
+def test_unbalanced_brackets_raise():
+    with pytest.raises(OQLSyntaxError):
+        canonicalize_query("node[a;out;")
+
+
+def test_out_limit_keeps_geometry_bbox():
+    query = "way[highway](52.5,13.3,52.6,13.4);out geom(52.5,13.3,52.6,13.4) qt 50;"
+    assert with_out_limit(query, 100) == (
+        'way["highway"](52.5,13.3,52.6,13.4);out geom(52.5,13.3,52.6,13.4)asc 100;'
+    )
+
+
+def test_count_and_page_only_the_primary_set():
+    query = "way[building](area.a);out body;>;out skel qt;"
+    assert with_out_count(query) == 'way["building"](area.a);out count;'
+    assert with_out_limit(query, 100) == (
+        'way["building"](area.a);out body geom asc 100;'
+    )
+
+
+def test_next_page_continues_after_the_last_element():
+    query = '[out:json];way["shop"]->.a;.a out;>;out skel qt;'
+    assert with_page_after(query, 100, "way/42") == (
+        '[out:json];way["shop"]->.a;'
+        "(way.a(if:id()>42);rel.a;area.a;)->.a;.a out geom asc 100;"
+    )
+
+
+def test_next_page_needs_an_element():
+    with pytest.raises(OQLSyntaxError):
+        with_page_after('[out:json];node["shop"];out;', 100, "the next page")
@@ -0,0 +1,132 @@
+import sqlite3
+
+import pytest
+from shapely.geometry import box
+
+from src.osm_index import SCHEMA, LocalOSMIndex, UnsupportedQuery, build_index
+
+EXTRACT = [52.3, 13.0, 52.7, 13.8]
+NODES = [
+    # id, lat, lon, tags
+    (1, 52.51, 13.31, {"amenity": "cafe", "name": "Café Eins"}),
+    (2, 52.53, 13.35, {"amenity": "cafe"}),
+    (3, 52.51, 13.31, {"amenity": "bench"}),
+    (4, 52.60, 13.50, {"amenity": "cafe"}),
+]
+WAY = (10, [52.50, 13.30, 52.52, 13.32], {"leisure": "park"})
+
+
+def make_index(path):
+    """An index with NODES and WAY, written like build_index does"""
+    conn = sqlite3.connect(path)
+    for statement in SCHEMA:
+        conn.execute(statement)
+    rows = [("node", i, lat, lat, lon, lon, tags) for i, lat, lon, tags in NODES]
+    way_id, (south, west, north, east), way_tags = WAY
+    rows.append(("way", way_id, south, north, west, east, way_tags))
+    for rowid, (osm_type, osm_id, s, n, w, e, tags) in enumerate(rows, 1):
+        conn.execute(
+            "INSERT INTO elements VALUES (?, ?, ?, ?, ?)",
+            (rowid, osm_type, osm_id, (s + n) / 2, (w + e) / 2),
+        )
+        conn.execute(
+            "INSERT INTO element_bounds VALUES (?, ?, ?, ?, ?)", (rowid, s, n, w, e)
+        )
+        conn.executemany(
+            "INSERT INTO tags VALUES (?, ?, ?)",
+            [(rowid, k, v) for k, v in tags.items()],
+        )
+    conn.execute(
+        "INSERT INTO metadata VALUES ('bounds', ?)", (",".join(map(str, EXTRACT)),)
+    )
+    conn.commit()
+    conn.close()
+    return LocalOSMIndex(path)
+
+
+@pytest.fixture
+def index(tmp_path, monkeypatch):
+    index = make_index(str(tmp_path / "index.sqlite"))
+    # "Mitte" is geocoded to a box around the first nodes
+    monkeypatch.setattr(
+        index, "area_polygon", lambda name: box(13.2, 52.45, 13.4, 52.55)
+    )
+    return index
+
+
+def ids(data):
+    return [e["id"] for e in data["elements"]]
+
+
+def test_bbox_and_tag_filters(index):
+    data = index.overpass_query(
+        '[out:json];node["amenity"="cafe"](52.5,13.3,52.55,13.4);out;'
+    )
+    assert ids(data) == [1, 2]
+    data = index.overpass_query(
+        '[out:json];node["amenity"]["name"~"café",i](52.5,13.3,52.55,13.4);out;'
+    )
+    assert ids(data) == [1]
+    data = index.overpass_query(
+        '[out:json];node["amenity"]["amenity"!="cafe"](52.5,13.3,52.55,13.4);out;'
+    )
+    assert ids(data) == [3]
+
+
+def test_area_keeps_the_bbox(index):
+    query = '[out:json];area["name"="Mitte"]->.a;node(area.a)(52.52,13.3,52.54,13.4)["amenity"="cafe"];out;'
+    assert ids(index.overpass_query(query)) == [2]
+    query = '[out:json];area["name"="Mitte"]->.a;node(area.a)["amenity"="cafe"];out;'
+    assert ids(index.overpass_query(query)) == [1, 2]
+
+
+def test_ways_come_with_their_center(index):
+    data = index.overpass_query(
+        '[out:json];way["leisure"="park"](52.5,13.3,52.55,13.4);out;'
+    )
+    assert data["elements"][0]["center"] == pytest.approx({"lat": 52.51, "lon": 13.31})
+
+
+def test_out_limit_and_count(index):
+    bbox = "(52.3,13.0,52.7,13.8)"
+    assert ids(index.overpass_query(f'[out:json];node["amenity"]{bbox};out 1;')) == [1]
+    data = index.overpass_query(f'[out:json];node["amenity"="cafe"]{bbox};out count;')
+    assert data["elements"][0]["tags"]["total"] == "3"
+
+
+def test_unsupported_queries_fall_back(index):
+    for query in [
+        '[out:json];nwr["amenity"](52.5,13.3,52.55,13.4);out;',
+        '[out:json];rel["route"="bus"](52.5,13.3,52.55,13.4);out;',
+        '[out:json];node["amenity"](50.0,13.3,52.55,13.4);out;',
+        '[out:json];node["amenity"];out;',
+        '[out:json];node(around:100,52.5,13.3)["amenity"];out;',
+        "not a query",
+    ]:
+        with pytest.raises(UnsupportedQuery):
+            index.overpass_query(query)
+
+
+OSM_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6">
+  <node id="1" lat="52.51" lon="13.31"><tag k="amenity" v="cafe"/></node>
+  <node id="2" lat="52.52" lon="13.32"/>
+  <node id="3" lat="52.50" lon="13.30"/>
+  <way id="10"><nd ref="2"/><nd ref="3"/><tag k="highway" v="footway"/></way>
+  <relation id="20"><member type="way" ref="10" role=""/><tag k="route" v="foot"/></relation>
+</osm>
+"""
+
+
+def test_import_keeps_tagged_nodes_and_ways(tmp_path):
+    pytest.importorskip("osmium")
+    extract = tmp_path / "extract.osm"
+    extract.write_text(OSM_XML)
+    build_index(str(extract), str(tmp_path / "index.sqlite"))
+    index = LocalOSMIndex(str(tmp_path / "index.sqlite"))
+    assert index.bounds == [52.5, 13.3, 52.52, 13.32]
+    data = index.overpass_query("[out:json];nw(52.5,13.3,52.52,13.32);out;")
+    assert [(e["type"], e["id"]) for e in data["elements"]] == [
+        ("node", 1),
+        ("way", 10),
+    ]
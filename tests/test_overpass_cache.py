@@ -0,0 +1,48 @@
+from src.overpass_cache import OverpassCache
+
+QUERY = '[out:json];node["amenity"="bench"](52.5,13.3,52.6,13.4);out;'
+ANSWER = {
+    "osm3s": {"timestamp_osm_base": "2030-01-01T00:00:00Z"},
+    "elements": [{"type": "node", "id": 1, "lat": 52.51, "lon": 13.31}],
+}
+
+
+def test_query_written_differently_hits_the_same_entry(tmp_path):
+    cache = OverpassCache(str(tmp_path / "cache.sqlite"))
+    assert cache.get(QUERY) is None
+    cache.put(QUERY, ANSWER)
+    same_query = "[out:json]; node[amenity=bench] (52.5, 13.3, 52.6, 13.4); out;"
+    assert cache.get(same_query) == ANSWER
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+
+def test_entries_survive_a_new_connection(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    OverpassCache(path).put(QUERY, ANSWER)
+    assert OverpassCache(path).get(QUERY) == ANSWER
+
+
+def test_stale_answers_expire(tmp_path):
+    cache = OverpassCache(str(tmp_path / "cache.sqlite"), ttl=60)
+    stale = {**ANSWER, "osm3s": {"timestamp_osm_base": "2020-01-01T00:00:00Z"}}
+    cache.put(QUERY, stale)
+    assert cache.get(QUERY) is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_runtime_errors_are_not_cached(tmp_path):
+    cache = OverpassCache(str(tmp_path / "cache.sqlite"))
+    cache.put(QUERY, {"elements": [], "remark": "runtime error: Query timed out"})
+    assert cache.stats()["entries"] == 0
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = OverpassCache(str(tmp_path / "cache.sqlite"), max_bytes=300)
+    queries = [
+        f'[out:json];node["amenity"="bench"]({i},13,{i + 1},14);out;' for i in range(3)
+    ]
+    for query in queries:
+        cache.put(query, ANSWER)
+    assert cache.get(queries[0]) is None
+    assert cache.get(queries[-1]) == ANSWER
@@ -0,0 +1,76 @@
+from time import monotonic
+
+import pytest
+
+from src import overpass_pool
+from src.overpass_pool import FAILURE_THRESHOLD, EndpointPool, parse_free_slots
+
+URLS = ["http://a.test/api/interpreter", "http://b.test/api/interpreter"]
+
+
+@pytest.fixture
+def pool():
+    pool = EndpointPool(URLS)
+    # No status checks in the background
+    for endpoint in pool.endpoints:
+        endpoint.status_checked = monotonic() + 3600
+    return pool
+
+
+def fail(pool, endpoint, times=FAILURE_THRESHOLD):
+    for _ in range(times):
+        pool.record_failure(endpoint)
+
+
+def test_fastest_endpoint_with_free_slots_comes_first(pool):
+    a, b = pool.endpoints
+    pool.record_success(a, 2.0)
+    pool.record_success(b, 0.5)
+    assert pool.ranked() == [b, a]
+    b.free_slots = 0
+    assert pool.ranked() == [a, b]
+
+
+def test_circuit_opens_after_repeated_failures(pool):
+    a, b = pool.endpoints
+    fail(pool, a, FAILURE_THRESHOLD - 1)
+    assert a in pool.ranked()
+    fail(pool, a, 1)
+    assert pool.ranked() == [b]
+
+
+def test_success_closes_the_circuit(pool):
+    a, b = pool.endpoints
+    fail(pool, a)
+    pool.record_success(a, 1.0)
+    assert a.consecutive_failures == 0
+    assert set(pool.ranked()) == {a, b}
+
+
+def test_circuit_closes_after_the_cooldown(pool, monkeypatch):
+    a, b = pool.endpoints
+    fail(pool, a)
+    later = monotonic() + overpass_pool.COOLDOWN + 1
+    monkeypatch.setattr(overpass_pool, "monotonic", lambda: later)
+    assert a in pool.ranked()
+
+
+def test_all_circuits_open_tries_the_one_that_opened_first(pool):
+    a, b = pool.endpoints
+    fail(pool, b)
+    fail(pool, a)
+    assert pool.ranked() == [b]
+
+
+def test_single_endpoint_is_never_locked_out():
+    pool = EndpointPool(URLS[:1])
+    (endpoint,) = pool.endpoints
+    endpoint.status_checked = monotonic() + 3600
+    fail(pool, endpoint)
+    assert pool.ranked() == [endpoint]
+
+
+def test_free_slots_from_status_page():
+    assert parse_free_slots("Rate limit: 2\n2 slots available now.") == 2
+    assert parse_free_slots("Slot available after: 2023-07-01T00:00:10Z") == 0
+    assert parse_free_slots("") is None
@@ -0,0 +1,88 @@
+import pytest
+
+from src import overpass_cache, overpass_preflight
+from src.oql import with_page_after
+from src.overpass_preflight import fetch_budgeted, preflight
+
+QUERY = '[out:json];node["amenity"="bench"](52.5,13.3,52.6,13.4);out;'
+
+
+def count(total):
+    return {
+        "type": "count",
+        "id": 0,
+        "tags": {"nodes": str(total), "total": str(total)},
+    }
+
+
+def nodes(first, n):
+    return [
+        {"type": "node", "id": i, "lat": 52.5, "lon": 13.3}
+        for i in range(first, first + n)
+    ]
+
+
+@pytest.fixture
+def overpass(tmp_path, monkeypatch):
+    """Fake fetch_query: answers queries from `answers`, a list of dicts used
+    in order, and records the queries. The cache starts empty."""
+    queries, answers = [], []
+
+    def fetch_query(query):
+        queries.append(query)
+        return answers.pop(0)
+
+    monkeypatch.setattr(overpass_preflight, "fetch_query", fetch_query)
+    cache = overpass_cache.OverpassCache(str(tmp_path / "cache.sqlite"))
+    monkeypatch.setattr(overpass_cache, "_default_cache", cache)
+    return queries, answers, cache
+
+
+def test_small_answer_is_fetched_once_and_not_cached_twice(overpass):
+    queries, answers, cache = overpass
+    answers.append({"elements": [count(3)] + nodes(1, 3)})
+    data, map_data = fetch_budgeted(QUERY)
+    assert data["elements"] == nodes(1, 3)
+    assert map_data is data
+    assert len(queries) == 1
+    # fetch_query caches the rewritten query, nothing more is stored
+    assert cache.stats()["entries"] == 0
+
+
+def test_runtime_error_is_raised_without_running_the_query_again(overpass):
+    queries, answers, _ = overpass
+    answers.append({"elements": [], "remark": "runtime error: Query timed out"})
+    with pytest.raises(ValueError, match="timed out"):
+        fetch_budgeted(QUERY)
+    assert len(queries) == 1
+
+
+def test_big_answer_is_paged_with_a_continuation(overpass):
+    queries, answers, _ = overpass
+    answers.append({"elements": [count(25)] + nodes(1, 10)})
+    data, _ = fetch_budgeted(QUERY, page_size=10)
+    assert data["counts"]["total"] == 25
+    assert data["next_page_after"] == "node/10"
+
+    answers.append({"elements": nodes(11, 10)})
+    page, _ = fetch_budgeted(QUERY, page_size=10, page_after="node/10")
+    assert queries[-1] == with_page_after(QUERY, 10, "node/10")
+    assert page["next_page_after"] == "node/20"
+
+    answers.append({"elements": nodes(21, 5)})
+    last, _ = fetch_budgeted(QUERY, page_size=10, page_after="node/20")
+    assert "next_page_after" not in last
+
+
+def test_too_many_elements_only_give_the_counts(overpass):
+    _, answers, _ = overpass
+    answers.append({"elements": [count(10**6)] + nodes(1, 10)})
+    data, map_data = fetch_budgeted(QUERY, page_size=10)
+    assert "elements" not in data
+    assert data["counts"]["total"] == 10**6
+    assert len(map_data["elements"]) == 10
+
+
+def test_limited_queries_are_not_preflighted():
+    query = '[out:json];node["amenity"="bench"](52.5,13.3,52.6,13.4);out 5;'
+    assert preflight(query) == ("full", None, None)
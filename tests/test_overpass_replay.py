@@ -0,0 +1,76 @@
+import json
+
+import pytest
+
+from src import bbox_tiles, overpass_cache, overpass_pool
+from src.overpass_replay import ReplayServer, benchmark, load_fixtures
+from src.overpass_stream import fetch_answer
+
+QUERY = '[out:json];node["amenity"="bench"](52.5,13.3,52.6,13.4);out;'
+ANSWER = {
+    "version": 0.6,
+    "elements": [
+        {"type": "node", "id": 1, "lat": 52.51, "lon": 13.31, "tags": {}},
+        {"type": "node", "id": 2, "lat": 52.52, "lon": 13.32, "tags": {}},
+    ],
+}
+
+
+@pytest.fixture
+def fixture_path(tmp_path):
+    path = tmp_path / "exchanges.jsonl"
+    exchange = {"query": QUERY, "status": 200, "body": json.dumps(ANSWER)}
+    path.write_text(json.dumps(exchange) + "\n")
+    return str(path)
+
+
+@pytest.fixture
+def server(fixture_path):
+    with ReplayServer(fixture_path, port=0) as server:
+        yield server
+
+
+@pytest.fixture
+def through_server(server, tmp_path, monkeypatch):
+    """Route the app's overpass requests to the replay server, with an empty cache"""
+    monkeypatch.setattr(
+        overpass_pool, "_pool", overpass_pool.EndpointPool([server.url])
+    )
+    cache = overpass_cache.OverpassCache(str(tmp_path / "cache.sqlite"))
+    monkeypatch.setattr(overpass_cache, "_default_cache", cache)
+    return cache
+
+
+def test_replays_recorded_query_written_differently(server):
+    query = "[out:json]; node[amenity=bench] (52.5, 13.3, 52.6, 13.4); out;"
+    assert fetch_answer(query, url=server.url)["elements"] == ANSWER["elements"]
+    assert server.stats()["hits"] == 1
+
+
+def test_unknown_query_is_rejected_and_not_cached(server, through_server):
+    with pytest.raises(ValueError):
+        bbox_tiles.fetch_query('[out:json];node["shop"];out;')
+    assert through_server.get('[out:json];node["shop"];out;') is None
+    assert through_server.stats()["entries"] == 0
+
+
+def test_fetch_query_goes_through_the_pool(server, through_server):
+    assert bbox_tiles.fetch_query(QUERY)["elements"] == ANSWER["elements"]
+    assert through_server.stats()["entries"] == 1
+
+
+def test_record_mode_appends_exchanges(server, tmp_path):
+    record_path = str(tmp_path / "recorded.jsonl")
+    with ReplayServer(
+        record_path, port=0, record=True, upstream=server.url
+    ) as recorder:
+        fetch_answer(QUERY, url=recorder.url)
+    fixtures = load_fixtures(record_path)
+    assert [(status, query) for status, _, query in fixtures.values()] == [(200, QUERY)]
+
+
+def test_benchmark_replays_every_query(server):
+    stats = benchmark(server, rounds=2)
+    assert stats["queries"] == 2
+    assert stats["elements"] == 4
+    assert stats["errors"] == 0
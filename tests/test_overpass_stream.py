@@ -0,0 +1,89 @@
+import json
+
+import pytest
+
+from src.overpass_stream import OverpassStream, answer_to_text
+
+ANSWER = {
+    "version": 0.6,
+    "osm3s": {"timestamp_osm_base": "2023-07-01T00:00:00Z"},
+    "elements": [
+        {"type": "node", "id": 1, "lat": 52.5, "lon": 13.4, "tags": {"name": "Späti"}},
+        {
+            "type": "node",
+            "id": 2,
+            "lat": 52.6,
+            "lon": 13.5,
+            "tags": {"note": '[]{},"\\'},
+        },
+        {"type": "way", "id": 3, "nodes": [1, 2], "tags": {"name": "Straße"}},
+    ],
+    "remark": "runtime remark: nothing wrong",
+}
+BODY = json.dumps(ANSWER, indent=1, ensure_ascii=False).encode()
+
+
+def one_byte_chunks(body):
+    return (body[i : i + 1] for i in range(len(body)))
+
+
+def test_one_byte_chunks_give_every_element_header_and_remark():
+    stream = OverpassStream(one_byte_chunks(BODY))
+    assert list(stream) == ANSWER["elements"]
+    assert stream.header == {"version": 0.6, "osm3s": ANSWER["osm3s"]}
+    assert stream.remark == ANSWER["remark"]
+    assert not stream.truncated
+    assert stream.bytes_read == len(BODY)
+
+
+def test_answer_without_elements_is_parsed_whole():
+    error = {"remark": "runtime error: Query timed out"}
+    stream = OverpassStream(one_byte_chunks(json.dumps(error).encode()))
+    assert list(stream) == []
+    assert stream.remark == error["remark"]
+
+
+def test_body_ending_inside_the_elements_raises():
+    with pytest.raises(ValueError):
+        list(OverpassStream([BODY[: len(BODY) // 2]]))
+
+
+def test_element_budget_stops_early():
+    stream = OverpassStream(one_byte_chunks(BODY), max_elements=2)
+    assert [e["id"] for e in stream] == [1, 2]
+    assert stream.truncated
+    assert stream.bytes_read < len(BODY)
+
+
+def test_body_exactly_max_bytes_long_is_complete():
+    stream = OverpassStream(one_byte_chunks(BODY), max_bytes=len(BODY))
+    assert len(list(stream)) == 3
+    assert not stream.truncated
+
+
+def test_byte_budget_stops_early():
+    stream = OverpassStream(one_byte_chunks(BODY), max_bytes=len(BODY) // 2)
+    elements = list(stream)
+    assert stream.truncated
+    assert 0 < len(elements) < 3
+    assert stream.bytes_read == len(BODY) // 2
+
+
+def test_connection_is_released_when_iteration_stops():
+    closed = []
+    stream = OverpassStream([BODY], max_elements=1, on_close=lambda: closed.append(1))
+    list(stream)
+    assert closed == [1]
+
+
+def test_answer_text_fits_the_budget_and_says_so():
+    text = answer_to_text(ANSWER, max_chars=500)
+    assert len(text) <= 500
+    data = json.loads(text)
+    assert data["truncated"]
+    assert 0 < len(data["elements"]) < 3
+    assert "all of them are shown on the map" in data["note"]
+
+
+def test_answer_text_is_whole_when_it_fits():
+    assert json.loads(answer_to_text(ANSWER, max_chars=10000)) == ANSWER
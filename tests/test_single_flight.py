@@ -0,0 +1,81 @@
+import threading
+from time import sleep
+
+import pytest
+
+from src.single_flight import SingleFlight
+
+
+def test_concurrent_callers_share_one_call():
+    flight = SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        release.wait(5)
+        return {"elements": []}
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(flight.do("q", fetch)))
+    leader.start()
+    while not calls:
+        sleep(0.001)
+    followers = [
+        threading.Thread(target=lambda: results.append(flight.do("q", fetch)))
+        for _ in range(3)
+    ]
+    for thread in followers:
+        thread.start()
+    while flight.coalesced < 3:
+        sleep(0.001)
+    release.set()
+    for thread in [leader] + followers:
+        thread.join(5)
+
+    assert len(calls) == 1
+    assert len(results) == 4
+    assert all(result is results[0] for result in results)
+
+
+def test_exception_reaches_every_waiter():
+    flight = SingleFlight()
+    release = threading.Event()
+    started = threading.Event()
+
+    def fail():
+        started.set()
+        release.wait(5)
+        raise ValueError("Overpass returned 400")
+
+    errors = []
+
+    def call():
+        try:
+            flight.do("q", fail)
+        except ValueError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=call)]
+    threads[0].start()
+    started.wait(5)
+    threads += [threading.Thread(target=call) for _ in range(2)]
+    for thread in threads[1:]:
+        thread.start()
+    while flight.coalesced < 2:
+        sleep(0.001)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert len(errors) == 3
+    assert all(error is errors[0] for error in errors)
+
+
+def test_finished_calls_are_not_reused():
+    flight = SingleFlight()
+    assert flight.do("q", lambda: 1) == 1
+    assert flight.do("q", lambda: 2) == 2
+    with pytest.raises(KeyError):
+        flight.do("q", lambda: {}["missing"])
+    assert flight.coalesced == 0
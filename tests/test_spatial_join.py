@@ -0,0 +1,84 @@
+import json
+
+from src.overpass_stream import answer_to_text
+from src.spatial_join import (
+    join_summary,
+    num_dropped,
+    spatial_join,
+    summary_element,
+    with_positions,
+)
+
+
+def node(id, lat, lon):
+    return {"type": "node", "id": id, "lat": lat, "lon": lon}
+
+
+def way(id, points):
+    return {
+        "type": "way",
+        "id": id,
+        "geometry": [{"lat": lat, "lon": lon} for lat, lon in points],
+    }
+
+
+def test_queries_are_asked_for_positions():
+    assert with_positions('way["leisure"="park"];out;') == (
+        'way["leisure"="park"];out geom;'
+    )
+    assert with_positions('way["leisure"="park"];out center;') == (
+        'way["leisure"="park"];out center;'
+    )
+    assert with_positions("not a query") == "not a query"
+
+
+def test_elements_without_position_are_dropped_and_counted():
+    left = {"elements": [node(1, 52.5, 13.4), {"type": "way", "id": 2}]}
+    right = {"elements": [node(3, 52.5, 13.4001)]}
+    left_elements, right_elements, pairs = spatial_join(left, right)
+    assert [e["id"] for e in left_elements] == [1]
+    assert num_dropped(left, left_elements) == 1
+    assert num_dropped(right, right_elements) == 0
+    assert [(i, j) for i, j, _ in pairs] == [(0, 0)]
+
+
+def test_self_intersecting_polygon_can_be_joined():
+    bowtie = way(
+        1,
+        [
+            (52.50, 13.40),
+            (52.51, 13.41),
+            (52.50, 13.41),
+            (52.51, 13.40),
+            (52.50, 13.40),
+        ],
+    )
+    left = {"elements": [node(2, 52.505, 13.402), node(3, 52.6, 13.5)]}
+    right = {"elements": [bowtie]}
+    left_elements, right_elements, pairs = spatial_join(
+        left, right, predicate="intersects"
+    )
+    assert [left_elements[i]["id"] for i, _, _ in pairs] == [2]
+
+
+def test_results_keep_positions_but_not_geometries():
+    park = {
+        **way(1, [(52.50, 13.40), (52.50, 13.42), (52.52, 13.42), (52.52, 13.40)]),
+        "nodes": [1, 2, 3, 4, 1],
+        "bounds": {"minlat": 52.50, "minlon": 13.40, "maxlat": 52.52, "maxlon": 13.42},
+        "tags": {"leisure": "park"},
+    }
+    park["geometry"].append(park["geometry"][0])
+    benches = {"elements": [node(i, 52.51, 13.41 + i * 1e-5) for i in range(2, 500)]}
+    left_elements, right_elements, pairs = spatial_join(
+        {"elements": [park]}, benches, distance=50
+    )
+    matched = join_summary(left_elements, right_elements, pairs)
+    summary = summary_element(matched[0])
+    assert set(summary) == {"type", "id", "tags", "matches", "lat", "lon"}
+    assert (summary["lat"], summary["lon"]) == (52.51, 13.41)
+    assert len(summary["matches"]) == 3
+
+    many = [summary_element(node(i, 52.5, 13.4)) for i in range(500)]
+    data = json.loads(answer_to_text({"num_matched": 500, "elements": many}, 4096))
+    assert data["truncated"] and 0 < len(data["elements"]) < 500
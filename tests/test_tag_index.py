@@ -0,0 +1,55 @@
+from src.element_store import ElementStore
+from src.tag_index import TagIndex, TagStatistics
+
+ELEMENTS = [
+    {
+        "type": "node",
+        "id": 1,
+        "lat": 52.5,
+        "lon": 13.4,
+        "tags": {"amenity": "cafe", "diet:vegan": "yes", "diet:vegetarian": "yes"},
+    },
+    {
+        "type": "node",
+        "id": 2,
+        "lat": 52.5,
+        "lon": 13.5,
+        "tags": {"amenity": "cafe", "cuisine": "coffee_shop;cake", "name": "Café"},
+    },
+    {"type": "node", "id": 3, "lat": 52.6, "lon": 13.5, "tags": {}},
+    {
+        "type": "way",
+        "id": 4,
+        "center": {"lat": 52.6, "lon": 13.4},
+        "tags": {"addr:street": "Torstraße", "addr:city": "Berlin", "name": "yes"},
+    },
+]
+
+
+def test_index_from_store_matches_index_from_elements():
+    store = ElementStore.from_elements(ELEMENTS)
+    for kwargs in [{}, {"split_keys": False, "split_values": False}]:
+        expected = TagIndex(**kwargs).add_elements(ELEMENTS)
+        index = TagIndex.from_store(store, **kwargs)
+        assert index.unique_values() == expected.unique_values()
+        assert index.key_counts() == expected.key_counts()
+        for key in expected.keys():
+            assert index.value_counts(key) == expected.value_counts(key)
+        assert index.num_elements == expected.num_elements
+
+
+def test_statistics_from_store_match_statistics_from_elements():
+    stats = TagStatistics.from_store(ElementStore.from_elements(ELEMENTS))
+    expected = TagStatistics().add_elements(ELEMENTS)
+    assert stats.tag_frequency() == expected.tag_frequency()
+    assert stats.tag_frequency("amenity") == expected.tag_frequency("amenity")
+    assert stats.unique_values() == expected.unique_values()
+    assert stats.unique_count("addr") == expected.unique_count("addr") == 2
+    assert stats.value_frequency() == expected.value_frequency()
+    assert stats.num_elements == expected.num_elements
+
+
+def test_statistics_of_an_empty_store():
+    stats = TagStatistics.from_store(ElementStore.from_elements([]))
+    assert stats.tag_frequency() == {}
+    assert stats.num_elements == 0
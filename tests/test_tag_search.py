@@ -0,0 +1,30 @@
+from src.tag_index import TagIndex
+from src.tag_search import TagSearchIndex
+
+MITTE = [
+    {"type": "node", "id": 1, "tags": {"amenity": "cafe", "name": "Späti"}},
+    {"type": "node", "id": 2, "tags": {"amenity": "drinking_water"}},
+]
+PANKOW = [
+    {"type": "node", "id": 3, "tags": {"amenity": "cafe", "dance": "Capoeira"}},
+]
+
+
+def test_adding_places_matches_building_the_index_at_once():
+    search = TagSearchIndex()
+    for place in [MITTE, PANKOW]:
+        search.add_tag_index(TagIndex().add_elements(place))
+    expected = TagSearchIndex.from_tag_index(TagIndex().add_elements(MITTE + PANKOW))
+    assert search.unique_values == expected.unique_values
+    assert search.value_counts == expected.value_counts
+    assert search.key_counts == expected.key_counts
+    for words in ["spati", "cafe", "capo", "water", "amenity"]:
+        assert search.search(words) == expected.search(words)
+
+
+def test_values_added_later_are_found():
+    search = TagSearchIndex.from_tag_index(TagIndex().add_elements(MITTE))
+    assert search.search("capoeira") == {}
+    search.add_tag_index(TagIndex().add_elements(PANKOW))
+    assert search.search("capoeira") == {"dance": ["Capoeira"]}
+    assert search.search("cafe")["amenity"] == ["cafe"]
@@ -0,0 +1,60 @@
+import pytest
+
+from src.tag_search import TagSearchIndex
+from src.tag_vocabulary import TagVocabulary, write_vocabulary
+
+VOCABULARY = {
+    "amenity": (1000, {"bench": 600, "drinking_water": 150, "cafe": 250}),
+    "shop": (800, {"convenience": 500, "bakery": 300}),
+    "name": (900, {}),
+    "name:de": (100, {}),
+    "drinking_water": (50, {"yes": 40, "no": 10}),
+    "cuisine": (70, {"späti": 20, "coffee_shop": 50}),
+}
+
+
+@pytest.fixture
+def vocabulary(tmp_path):
+    path = str(tmp_path / "tag_vocabulary.bin")
+    write_vocabulary(VOCABULARY, path)
+    return TagVocabulary(path)
+
+
+def test_keys_and_values(vocabulary):
+    assert vocabulary.keys()[:3] == [("amenity", 1000), ("name", 900), ("shop", 800)]
+    assert vocabulary.values("amenity") == {
+        "bench": 600,
+        "cafe": 250,
+        "drinking_water": 150,
+    }
+    assert vocabulary.values("name") == {}
+    assert vocabulary.values("missing") == {}
+
+
+def test_search_finds_what_the_in_memory_index_finds(vocabulary):
+    index = TagSearchIndex(
+        {key: list(values) for key, (_, values) in VOCABULARY.items()},
+        {key: values for key, (_, values) in VOCABULARY.items()},
+    )
+    for words in ["water", "spati", "name", "shop", "nothing here"]:
+        expected = index.search(words)
+        matches = vocabulary.search(words)
+        assert set(matches) == set(expected)
+        for key, values in matches.items():
+            assert values == expected[key]
+
+
+def test_search_ranks_and_caps(vocabulary):
+    assert vocabulary.search("drinking water") == {
+        "amenity": ["drinking_water"],
+        "drinking_water": ["yes", "no"],
+    }
+    assert list(vocabulary.search("a", max_keys=2)) == ["amenity", "name"]
+    assert vocabulary.search("amenity", max_values=1) == {"amenity": ["bench"]}
+
+
+def test_older_files_are_rejected(tmp_path):
+    path = tmp_path / "old.bin"
+    path.write_bytes(b"NMTAGV1\0" + bytes(40))
+    with pytest.raises(ValueError, match="rebuild"):
+        len(TagVocabulary(str(path)))